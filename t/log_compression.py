@@ -24,6 +24,9 @@
 #
 # With log_compression=10K
 # With log_store_compressed=1 and log_compression=10K
+# tools/fiologreader.py reading the log_store_compressed logs the same as
+# fio --inflate-log, including a latency log with log_offset=1, log_prio=1
+# and log_issue_time=1
 
 import os
 import sys
@@ -89,6 +92,53 @@ def check_log_file(log_store_compressed):
         expected_offset += bs
     return True
 
+def run_fio_lat(fio):
+    fio_args = [
+        '--name=job',
+        '--ioengine=null',
+        '--filesize=10M',
+        '--bs=4K',
+        '--rw=randrw',
+        '--write_lat_log=test',
+        '--per_job_logs=0',
+        '--log_offset=1',
+        '--log_prio=1',
+        '--log_issue_time=1',
+        '--log_compression=4K',
+        '--log_store_compressed=1',
+        ]
+    subprocess.check_output([fio] + fio_args)
+
+    with open('test_clat.from_fz.log','wt') as f:
+        subprocess.check_call([fio, '--inflate-log=test_clat.log.fz'], stdout=f)
+
+def check_fiologreader(fz, inflated):
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../tools'))
+    import fiologreader
+
+    with open(inflated,'rt') as f:
+        expected = f.read()
+    with fiologreader.open_log(fz) as f:
+        text = f.read()
+    if text != expected:
+        print('{} read by fiologreader differs from fio --inflate-log'.format(fz))
+        return False
+
+    if not fiologreader.numpy_imported:
+        return True
+    columns = fiologreader.LogReader(fz).read_columns()
+    expected = fiologreader.LogReader(inflated).read_columns()
+    if sorted(columns) != sorted(expected):
+        print('{} decoded with columns {}, should be {}'.format(
+            fz, sorted(columns), sorted(expected)))
+        return False
+    for name in expected:
+        if columns[name].dtype != expected[name].dtype or \
+           not (columns[name] == expected[name]).all():
+            print('{} column {} decoded differently from fio --inflate-log'.format(fz, name))
+            return False
+    return True
+
 def main():
     """Entry point for this script."""
     args = parse_args()
@@ -112,6 +162,17 @@ def main():
         else:
             failed_count+=1
 
+    run_fio_lat(fio_path)
+    for fz, inflated in [('test_bw.log.fz', 'test_bw.from_fz.log'),
+                         ('test_clat.log.fz', 'test_clat.from_fz.log')]:
+        passed = check_fiologreader(fz, inflated)
+        print('Test reading {} with fiologreader {}'.format(fz,
+            'PASSED' if passed else 'FAILED'))
+        if passed:
+            passed_count+=1
+        else:
+            failed_count+=1
+
     print('{} tests passed, {} failed'.format(passed_count, failed_count))
 
     sys.exit(failed_count)
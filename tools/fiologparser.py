@@ -13,14 +13,60 @@
 # fiologparser.py -a *clat*
 #
 # to see per-interval average completion latency.
+#
+# Logs stored compressed by fio (log_store_compressed), gzip or zstd
+# compressed logs are read directly.  To avoid parsing the same large
+# logs over and over, they can be converted once with:
+#
+# fiologparser.py --export *clat*
+#
+# and the resulting .parquet, .arrow or .npz files given instead of the logs.
+#
+# fiologparser.py --start 3600000 --end 7200000 -s *bw*
+#
+# only reads the samples between 3600 and 7200 seconds into the run, using
+# an index cached next to each log to skip to them.
+#
+# to run unit tests, set UNITTEST environment variable to anything
+# if you do this, don't pass normal CLI parameters to it
+# otherwise it runs the CLI
 
 from __future__ import absolute_import
 from __future__ import print_function
 import argparse
+import bisect
+import collections
+import functools
+import heapq
 import math
-from functools import reduce
+import multiprocessing
+import os
+import sys
+import unittest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# fiologreader.py is next to this script in the fio source tree, and in
+# share/fio next to the bin directory holding it once installed
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'share', 'fio'))
+from fiologreader import LOG_FIELDS, STORE_SUFFIXES, LogReader, default_store_format, write_store
+
+numpy_imported = True
+try:
+    import numpy as np
+except ImportError:
+    numpy_imported = False
 
-def parse_args():
+def parse_ddir(ddir):
+    ddirs = {'r': 0, 'w': 1, 't': 2, '0': 0, '1': 1, '2': 2}
+    if ddir not in ddirs:
+        raise argparse.ArgumentTypeError('invalid data direction %s' % ddir)
+    return ddirs[ddir]
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--interval', required=False, type=int, default=1000, help='interval of time in seconds.')
     parser.add_argument('-d', '--divisor', required=False, type=int, default=1, help='divide the results by this value.')
@@ -29,105 +75,350 @@ def parse_args():
                         help='print all stats for each interval.')
     parser.add_argument('-a', '--average', dest='average', action='store_true', default=False, help='print the average for each interval.')
     parser.add_argument('-s', '--sum', dest='sum', action='store_true', default=False, help='print the sum for each interval.')
+    parser.add_argument('-S', '--summary', dest='summary', action='store_true', default=False,
+                        help='print the time-weighted mean of the sums, their total over time (value x seconds, '
+                             'i.e. KiB for bw logs and IOs for iops logs) and the intervals with the highest '
+                             'and lowest sums.')
+    parser.add_argument('--numpy', dest='numpy', action='store_true', default=False,
+                        help='use the NumPy columnar backend to load and bucket samples.')
+    parser.add_argument('--stream', dest='stream', action='store_true', default=False,
+                        help='merge the logs as they are read and print each interval as soon as it is complete. '
+                             'Uses memory bounded by the interval rather than the log length, '
+                             'a FILE of - reads from stdin.')
+    parser.add_argument('--sketch', dest='sketch', action='store_true', default=False,
+                        help='estimate the -A percentiles with a bounded memory quantile sketch.')
+    parser.add_argument('--sketch-error', dest='sketch_error', type=float, default=0.01,
+                        help='rank error of the --sketch percentiles, default 0.01.')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of processes parsing logs in parallel, not used with --stream.')
+    parser.add_argument('--ddir', dest='ddir', type=parse_ddir, default=None,
+                        help='only use samples of this data direction: r, w or t (or 0, 1, 2).')
+    parser.add_argument('--bs', dest='bs', type=int, default=None,
+                        help='only use samples of this block size.')
+    parser.add_argument('--prio', dest='prio', type=lambda x: int(x, 0), default=None,
+                        help='only use samples with this priority, as written in the log '
+                             '(hex with log_prio=1, otherwise 1 for RT priority I/O and 0 for the rest).')
+    parser.add_argument('--start', dest='start', type=int, default=None,
+                        help='only use the samples from this time on, in ms. Intervals start there.')
+    parser.add_argument('--end', dest='end', type=int, default=None,
+                        help='only use the samples up to this time, in ms.')
+    parser.add_argument('--export', dest='export', action='store_true', default=False,
+                        help='convert each log to a columnar file next to it instead of printing statistics. '
+                             'Converted files are read without any text parsing, '
+                             'only samples passing --ddir, --bs and --prio are kept.')
+    parser.add_argument('--export-format', dest='export_format', choices=sorted(STORE_SUFFIXES), default=None,
+                        help='format of --export: parquet (the default) or arrow, both needing pyarrow, '
+                             'or npz (the default without pyarrow).')
     parser.add_argument("FILE", help="collectl log output files to parse", nargs="+")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.start is not None and args.end is not None and args.end <= args.start:
+        parser.error('--end must be after --start')
 
     return args
 
 def get_ftime(series):
+    # logs without any sample are left out
+    return get_first_end([ts.last.end for ts in series if ts.last is not None])
+
+def get_first_end(ends):
     ftime = 0
-    for ts in series:
-        if ftime == 0 or ts.last.end < ftime:
-            ftime = ts.last.end
+    for end in ends:
+        if ftime == 0 or end < ftime:
+            ftime = end
     return ftime
 
-def print_full(ctx, series):
-    ftime = get_ftime(series)
-    start = 0 
-    end = ctx.interval
+# With --start, times are made relative to it as the logs are read, so
+# intervals are computed as if the run started there.  Only the rows are
+# shifted back when printed.
 
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
-        print("%s, %s" % (end, ', '.join(["%0.3f" % i for i in results])))
-        start += ctx.interval
-        end += ctx.interval
+def get_origin(ctx):
+    return ctx.start or 0
 
-def print_sums(ctx, series):
-    ftime = get_ftime(series)
+def get_window_end(ctx, ftime):
+    """ Cut ftime at --end """
+    if ctx.end is not None:
+        return min(ftime, ctx.end - get_origin(ctx))
+    return ftime
+
+def shift_rows(ctx, rows):
+    origin = get_origin(ctx)
+    for (start, end), results in rows:
+        yield (start + origin, end + origin), results
+
+def get_intervals(ctx, ftime):
+    """ Yield the (start, end) bounds of each output interval, the last
+        interval being cut short at ftime. """
     start = 0
     end = ctx.interval
 
     while (start < ftime):
         end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
-        print("%s, %0.3f" % (end, sum(results)))
+        yield (start, end)
         start += ctx.interval
         end += ctx.interval
 
-def print_averages(ctx, series):
-    ftime = get_ftime(series)
+def new_interval_stats(ctx):
+    return QuantileSketch(ctx.sketch_error) if ctx.sketch else ExactQuantiles()
+
+def load_series(ctx, fn):
+    if ctx.numpy:
+        return ColumnarTimeSeries(ctx, fn)
+    return TimeSeries(ctx, fn)
+
+def get_partials(ctx, ts, ftime):
+    """ Return the per-interval partial results of one series: its value
+        for each interval, or with -A its interval statistics. """
+    if not ctx.allstats:
+        return ts.get_interval_values(ctx.interval, ftime)
+    partials = []
+    for values in ts.get_interval_samples(ctx.interval, ftime):
+        stats = new_interval_stats(ctx)
+        stats.extend(values)
+        partials.append(stats)
+    return partials
+
+def get_total(ctx, ts, ftime):
+    return ts.get_total(ftime)
+
+def load_logs(ctx, files, reduce_series):
+    """ Load each log and return ftime and reduce_series(ctx, series,
+        ftime) for each of them. """
+    if ctx.jobs > 1:
+        return load_parallel_logs(ctx, files, reduce_series)
+    series = [load_series(ctx, fn) for fn in files]
+    ftime = get_window_end(ctx, get_ftime(series))
+    return ftime, [reduce_series(ctx, ts, ftime) for ts in series]
+
+def get_rows(ctx, files):
+    """ Return ((start, end), per-series partial results) for each interval. """
+    ftime, partials = load_logs(ctx, files, get_partials)
+    return zip(get_intervals(ctx, ftime), zip(*partials))
+
+# With --jobs, the logs are dealt out to that many processes, each
+# returning only the compact per-interval partials or total of its logs.
+# Every log is cut at the end of the shortest one, so each process loads
+# its logs, publishes their ends and waits for the others before reducing
+# them: every log is parsed once, and held in memory no longer than it is
+# by a single process.
+
+def reduce_job_logs(ctx, files, reduce_series, mine, ends, barrier, results):
+    """ Load the logs of indexes mine, set their ends (-1 for a log without
+        any sample) and once every process has, put (index, reduction) on
+        results for each of them, or (None, exception) on failure. """
+    try:
+        series = [load_series(ctx, files[i]) for i in mine]
+        for i, ts in zip(mine, series):
+            ends[i] = -1 if ts.last is None else ts.last.end
+        barrier.wait()
+        ftime = get_window_end(ctx, get_first_end([e for e in ends if e >= 0]))
+        for i in mine:
+            results.put((i, reduce_series(ctx, series.pop(0), ftime)))
+    except Exception as e:
+        results.put((None, e))
+        barrier.abort()
+
+def load_parallel_logs(ctx, files, reduce_series):
+    """ Parallel counterpart of load_logs(), giving the same results. """
+    jobs = min(ctx.jobs, len(files))
+    ends = multiprocessing.RawArray('q', len(files))
+    barrier = multiprocessing.Barrier(jobs)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=reduce_job_logs,
+                                     args=(ctx, files, reduce_series, list(range(j, len(files), jobs)),
+                                           ends, barrier, results))
+             for j in range(jobs)]
+    for p in procs:
+        p.start()
+    reduced = [None] * len(files)
+    done = False
+    try:
+        for k in range(len(files)):
+            # a process killed before putting its results would hang get()
+            while True:
+                try:
+                    i, result = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not any([p.is_alive() for p in procs]):
+                        raise RuntimeError('log parsing processes exited without results')
+            if i is None:
+                raise result
+            reduced[i] = result
+        done = True
+    finally:
+        for p in procs:
+            if not done:
+                p.terminate()
+            p.join()
+    return get_window_end(ctx, get_first_end([e for e in ends if e >= 0])), reduced
+
+def get_log_reader(ctx, fn):
+    """ Return a LogReader applying the --ddir, --bs and --prio filters
+        and the --start and --end window """
+    return LogReader(fn, ddir=ctx.ddir, bs=ctx.bs, prio=ctx.prio,
+                     start=ctx.start, end=ctx.end)
+
+def read_samples(ctx, fn):
+    """ Yield (start, end, value) for each sample of a log, a sample
+        spanning from the previous timestamp to its own.  A file name of
+        '-' reads the log from stdin. """
+    origin = get_origin(ctx)
+    p_time = 0
+    for (time, value) in get_log_reader(ctx, fn).samples():
+        # the row before the window only gives the start of the next sample
+        if time >= origin:
+            yield (p_time - origin, time - origin, value)
+        p_time = time
+
+def merge_samples(ctx, files, passed=None):
+    """ Lazily merge the samples of all logs by end time, yielding
+        (end, file index, start, value).  Once a log is exhausted, or has
+        a sample ending after which passed(end) is true, (last end, file
+        index, None, empty) is yielded for it and it is not read further,
+        empty telling whether the log had no sample at all. """
+    def tagged(i, fn):
+        end = 0
+        empty = True
+        for (start, end, value) in read_samples(ctx, fn):
+            empty = False
+            yield (end, i, start, value)
+            if passed is not None and passed(end):
+                break
+        yield (end, i, None, empty)
+    return heapq.merge(*[tagged(i, fn) for i, fn in enumerate(files)])
+
+def stream_rows(ctx, files, reduce_samples):
+    """ Streaming counterpart of get_value_rows() and get_sample_rows().
+        Each interval is reduced with reduce_samples(samples, start, end)
+        and yielded as soon as every log has moved past its end, so only
+        the samples of intervals that are still open are held in memory.
+        Once the first log runs out, the others are only read up to the
+        first sample ending after it.  Each log must be in time order, as
+        fio writes them. """
+    pending = [collections.deque() for fn in files]
+    latest = [0] * len(files)
+    # the end of the output, set by the first log to run out
+    ftime = [None]
     start = 0
-    end = ctx.interval
 
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
+    def passed(end):
+        return ftime[0] is not None and end > ftime[0]
+
+    def reduce_interval(start, end):
+        results = [reduce_samples(samples, start, end) for samples in pending]
+        for samples in pending:
+            while samples and samples[0].end < end:
+                samples.popleft()
+        return ((start, end), results)
+
+    for (end, i, sstart, value) in merge_samples(ctx, files, passed):
+        latest[i] = end
+        if sstart is None:
+            # a log which has run out, or gone past the end of the output,
+            # holds nothing back
+            latest[i] = None
+            if not value and ftime[0] is None:
+                ftime[0] = get_window_end(ctx, end)
+        else:
+            pending[i].append(Sample(ctx, sstart, end, value))
+
+        # the next sample of a log may still be a zero-length one ending
+        # at its latest timestamp, so only intervals ending before the
+        # slowest log are complete
+        active = [t for t in latest if t is not None]
+        if not active:
+            break
+        limit = min(active)
+        if ftime[0] is not None:
+            # the last interval is cut short at ftime
+            limit = min(limit, ftime[0])
+        while start + ctx.interval < limit:
+            yield reduce_interval(start, start + ctx.interval)
+            start += ctx.interval
+
+    for (istart, iend) in get_intervals(ctx, ftime[0] or 0):
+        if istart >= start:
+            yield reduce_interval(istart, iend)
+
+def get_stream_rows(ctx, files):
+    """ Streaming counterpart of get_rows() """
+    if not ctx.allstats:
+        return stream_rows(ctx, files,
+                           lambda samples, start, end: sum([s.get_contribution(start, end) for s in samples]))
+
+    def reduce_stats(samples, start, end):
+        stats = new_interval_stats(ctx)
+        stats.extend([s.value for s in samples if s.start >= start and s.end <= end])
+        return stats
+    return stream_rows(ctx, files, reduce_stats)
+
+def flush_rows(rows):
+    """ Push each row down the pipe as soon as it has been printed """
+    for row in rows:
+        yield row
+        sys.stdout.flush()
+
+def get_export_name(fn, fmt):
+    for suffix in ('.fz', '.gz', '.zst'):
+        if fn.endswith(suffix):
+            fn = fn[:-len(suffix)]
+            break
+    return fn + STORE_SUFFIXES[fmt]
+
+def export_log(ctx, fn):
+    """ Convert a log to a columnar file, returning its name """
+    fmt = ctx.export_format or default_store_format()
+    out = get_export_name(fn, fmt)
+    write_store(out, get_log_reader(ctx, fn).read_columns(), fmt)
+    return out
+
+def export_logs(ctx, files):
+    if ctx.jobs > 1:
+        pool = multiprocessing.Pool(ctx.jobs)
+        try:
+            names = pool.map(functools.partial(export_log, ctx), files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        names = [export_log(ctx, fn) for fn in files]
+    for fn, out in zip(files, names):
+        print('%s -> %s' % (fn, out))
+
+def print_full(ctx, rows):
+    for (start, end), results in rows:
+        print("%s, %s" % (end, ', '.join(["%0.3f" % i for i in results])))
+
+def print_sums(ctx, rows):
+    for (start, end), results in rows:
+        print("%s, %0.3f" % (end, sum(results)))
+
+def print_averages(ctx, rows):
+    for (start, end), results in rows:
         print("%s, %0.3f" % (end, float(sum(results))/len(results)))
-        start += ctx.interval
-        end += ctx.interval
 
-# FIXME: this routine is computationally inefficient
-# and has O(N^2) behavior
-# it would be better to make one pass through samples
-# to segment them into a series of time intervals, and
-# then compute stats on each time interval instead.
 # to debug this routine, use
 #   # sort -n -t ',' -k 2 small.log
 # on your input.
 
-def my_extend( vlist, val ):
-    vlist.extend(val)
-    return vlist
-
-array_collapser = lambda vlist, val:  my_extend(vlist, val) 
-
-def print_all_stats(ctx, series):
-    ftime = get_ftime(series)
-    start = 0 
-    end = ctx.interval
+def print_all_stats(ctx, rows):
     print('start-time, samples, min, avg, median, 90%, 95%, 99%, max')
-    while (start < ftime):  # for each time interval
-        end = ftime if ftime < end else end
-        sample_arrays = [ s.get_samples(start, end) for s in series ]
-        samplevalue_arrays = []
-        for sample_array in sample_arrays:
-            samplevalue_arrays.append( 
-                [ sample.value for sample in sample_array ] )
-        # collapse list of lists of sample values into list of sample values
-        samplevalues = reduce( array_collapser, samplevalue_arrays, [] )
+    for (start, end), partials in rows:
+        stats = new_interval_stats(ctx)
+        for partial in partials:
+            stats.merge(partial)
+        # intervals without any sample are left out
+        if stats.count == 0:
+            continue
         # compute all stats and print them
-        mymin = min(samplevalues)
-        myavg = sum(samplevalues) / float(len(samplevalues))
-        mymedian = median(samplevalues)
-        my90th = percentile(samplevalues, 0.90) 
-        my95th = percentile(samplevalues, 0.95)
-        my99th = percentile(samplevalues, 0.99)
-        mymax = max(samplevalues)
+        mymedian, my90th, my95th, my99th = stats.quantiles([0.5, 0.90, 0.95, 0.99])
         print( '%f, %d, %f, %f, %f, %f, %f, %f, %f' % (
-            start, len(samplevalues), 
-            mymin, myavg, mymedian, my90th, my95th, my99th, mymax))
-
-        # advance to next interval
-        start += ctx.interval
-        end += ctx.interval
-
-def median(values):
-    s=sorted(values)
-    return float(s[(len(s)-1)/2]+s[(len(s)/2)])/2
+            start, stats.count,
+            stats.min, stats.total / float(stats.count),
+            mymedian, my90th, my95th, my99th, stats.max))
 
-def percentile(values, p):
-    s = sorted(values)
+def percentile(s, p):
+    """ Interpolated percentile p (0 to 1) of the sorted list s """
     k = (len(s)-1) * p
     f = math.floor(k)
     c = math.ceil(k)
@@ -135,20 +426,163 @@ def percentile(values, p):
         return s[int(k)]
     return (s[int(f)] * (c-k)) + (s[int(c)] * (k-f))
 
-def print_default(ctx, series):
-    ftime = get_ftime(series)
-    start = 0
-    end = ctx.interval
+class IntervalStats(object):
+    """ Count, total, min and max of the values seen in an interval """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def update(self, count, total, mn, mx):
+        if not count:
+            return
+        self.count += count
+        self.total += total
+        self.min = mn if self.min is None else min(self.min, mn)
+        self.max = mx if self.max is None else max(self.max, mx)
+
+    def update_from(self, values):
+        if len(values):
+            self.update(len(values), sum(values), min(values), max(values))
+
+class ExactQuantiles(IntervalStats):
+    """ Keeps every value, sorting them once to read all quantiles """
+    def __init__(self):
+        IntervalStats.__init__(self)
+        self.values = []
+
+    def extend(self, values):
+        self.values.extend(values)
+        self.update_from(values)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+        self.update(other.count, other.total, other.min, other.max)
+
+    def quantiles(self, ps):
+        s = sorted(self.values)
+        return [percentile(s, p) for p in ps]
+
+class QuantileSketch(IntervalStats):
+    """ Mergeable KLL style quantile sketch.  Values are held in a stack
+        of compactors, an item at level h standing for 2^h values.  A full
+        level is sorted and every other item promoted to the next level,
+        keeping O(log(n) / error) items with a normalized rank error of
+        about the given error.  count, total, min and max are exact. """
+    def __init__(self, error=0.01):
+        IntervalStats.__init__(self)
+        self.k = max(8, int(math.ceil(2.0 / error)))
+        self.compactors = [[]]
+        self.size = 0
+        # alternate which half of a compactor is kept instead of picking
+        # it at random, so the output is reproducible
+        self.odd = False
+
+    def extend(self, values):
+        self.compactors[0].extend(values)
+        self.size += len(values)
+        self.update_from(values)
+        self.compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.size += other.size
+        self.update(other.count, other.total, other.min, other.max)
+        self.compress()
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2.0 / 3) ** depth)))
+
+    def compress(self):
+        while self.size >= sum([self.capacity(h) for h in range(len(self.compactors))]):
+            for h, items in enumerate(self.compactors):
+                if len(items) >= self.capacity(h):
+                    break
+            if h + 1 == len(self.compactors):
+                self.compactors.append([])
+            items.sort()
+            # an odd item out stays behind, so the total weight is unchanged
+            keep = items[-1:] if len(items) % 2 else []
+            promoted = items[int(self.odd):len(items) - len(keep):2]
+            self.odd = not self.odd
+            self.compactors[h + 1].extend(promoted)
+            self.compactors[h] = keep
+            self.size -= len(items) - len(keep) - len(promoted)
+
+    def quantiles(self, ps):
+        """ Interpolated like percentile() between the two ranks around
+            p, on the sorted values the items stand for, an item at level
+            h being repeated 2^h times, except for the exact min and max.
+            Until anything is compacted this is exactly
+            ExactQuantiles.quantiles(). """
+        weighted = sorted([(v, 1 << h) for h, items in enumerate(self.compactors) for v in items])
+        values = [v for v, w in weighted]
+        # ends[i] is the rank following the copies of values[i]
+        ends = []
+        seen = 0
+        for v, w in weighted:
+            seen += w
+            ends.append(seen)
+
+        def at_rank(rank):
+            return values[min(bisect.bisect_right(ends, rank), len(values) - 1)]
+
+        results = []
+        for p in ps:
+            k = (seen - 1) * p
+            f = math.floor(k)
+            c = math.ceil(k)
+            # min and max are kept exactly
+            if p <= 0 or p >= 1:
+                results.append(self.min if p <= 0 else self.max)
+            elif f == c:
+                results.append(at_rank(k))
+            else:
+                results.append(at_rank(f) * (c-k) + at_rank(c) * (k-f))
+        return results
+
+def print_summary(ctx, rows):
+    total = 0
+    duration = 0
+    peak = None
+    trough = None
+    for (start, end), results in rows:
+        value = sum(results)
+        total += value * (end - start)
+        duration += end - start
+        if peak is None or value > peak[1]:
+            peak = (end, value)
+        if trough is None or value < trough[1]:
+            trough = (end, value)
+    # nothing to report without any sample
+    if not duration:
+        return
+    print('mean, %0.3f' % (float(total) / duration))
+    print('total, %0.3f' % (total / 1000.0))
+    print('peak, %s, %0.3f' % peak)
+    print('trough, %s, %0.3f' % trough)
+
+def print_mean(ctx, ftime, totals):
+    """ Closed-form print_default(): the time integral of the sum of all
+        logs over the run, divided by its length. """
+    if not ftime:
+        return
+    print('%0.3f' % (sum(totals)/ftime))
+
+def print_default(ctx, rows):
     averages = []
     weights = []
 
-    while (start < ftime):
-        end = ftime if ftime < end else end
-        results = [ts.get_value(start, end) for ts in series]
+    for (start, end), results in rows:
         averages.append(sum(results)) 
         weights.append(end-start)
-        start += ctx.interval
-        end += ctx.interval
+    if not weights:
+        return
 
     total = 0
     for i in range(0, len(averages)):
@@ -163,15 +597,11 @@ class TimeSeries(object):
         self.read_data(fn)
 
     def read_data(self, fn):
-        f = open(fn, 'r')
-        p_time = 0
-        for line in f:
-            (time, value) = line.rstrip('\r\n').rsplit(', ')[:2]
-            self.add_sample(p_time, int(time), int(value))
-            p_time = int(time)
+        for (start, end, value) in read_samples(self.ctx, fn):
+            self.add_sample(start, end, value)
  
     def add_sample(self, start, end, value):
-        sample = Sample(ctx, start, end, value)
+        sample = Sample(self.ctx, start, end, value)
         if not self.last or self.last.end < end:
             self.last = sample
         self.samples.append(sample)
@@ -189,6 +619,51 @@ class TimeSeries(object):
             value += sample.get_contribution(start, end)
         return value
 
+    def get_total(self, ftime):
+        """ Return the sum of get_value() times the interval length over
+            every interval up to ftime: each sample weighted by how much of
+            it is before ftime, without going through the intervals. """
+        total = 0.0
+        for s in self.samples:
+            total += s.value * max(0, min(s.end, ftime) - max(s.start, 0))
+        return total/self.ctx.divisor
+
+    # Instead of scanning every sample for every output interval, the
+    # interval (or two, at a boundary) holding each end of a sample can be
+    # computed directly from its timestamps.  This lets a single pass over
+    # the samples fill in every interval, O(samples + intervals) overall.
+
+    def get_interval_range(self, interval, ftime, first, last):
+        """ Return the range of interval indexes which may satisfy
+            istart <= first and iend >= last. """
+        count = (ftime + interval - 1) // interval
+        lo = max(0, (last + interval - 1) // interval - 1)
+        hi = min(count - 1, first // interval)
+        return range(lo, hi + 1)
+
+    def get_interval_values(self, interval, ftime):
+        """ Return get_value() for every interval up to ftime. """
+        values = [0.0] * ((ftime + interval - 1) // interval)
+        for sample in self.samples:
+            for i in self.get_interval_range(interval, ftime, sample.end, sample.start):
+                istart = i * interval
+                iend = min(istart + interval, ftime)
+                if iend < sample.start or istart > sample.end:
+                    continue
+                values[i] += sample.get_contribution(istart, iend)
+        return values
+
+    def get_interval_samples(self, interval, ftime):
+        """ Return the values of get_samples() for every interval up to ftime. """
+        values = [[] for i in range((ftime + interval - 1) // interval)]
+        for sample in self.samples:
+            for i in self.get_interval_range(interval, ftime, sample.start, sample.end):
+                istart = i * interval
+                iend = min(istart + interval, ftime)
+                if sample.start >= istart and sample.end <= iend:
+                    values[i].append(sample.value)
+        return values
+
 class Sample(object):
     def __init__(self, ctx, start, end, value):
        self.ctx = ctx
@@ -204,21 +679,549 @@ class Sample(object):
        sbound = self.start if start < self.start else start
        ebound = self.end if end > self.end else end
        ratio = float(ebound-sbound) / (end-start) 
-       return self.value*ratio/ctx.divisor
+       return self.value*ratio/self.ctx.divisor
+
+# Columnar alternative to TimeSeries.  Rather than one Sample object per
+# log line, every field is held in a typed NumPy array, the log is parsed
+# a block at a time and interval contributions are computed with array
+# operations.  It needs about 30 bytes per sample instead of several hundred.
+
+class ColumnarTimeSeries(object):
+    def __init__(self, ctx, fn):
+        self.ctx = ctx
+        self.read_data(fn)
+        self.start = np.concatenate((np.zeros(1, dtype=np.int64), self.time))[:-1]
+        if ctx.start:
+            self.cut_window(ctx.start)
+        self.last = None
+        if self.time.size:
+            i = int(np.argmax(self.time))
+            self.last = Sample(ctx, int(self.start[i]), int(self.time[i]), int(self.value[i]))
+
+    def read_data(self, fn):
+        # columns the log does not have are left as None
+        for name in LOG_FIELDS:
+            setattr(self, name, None)
+        for name, column in get_log_reader(self.ctx, fn).read_columns().items():
+            setattr(self, name, column)
+
+    def cut_window(self, origin):
+        """ Make times relative to origin, dropping the row before it
+            once it has given the start of the first sample. """
+        keep = self.time >= origin
+        for name in LOG_FIELDS + ('start',):
+            column = getattr(self, name)
+            if column is not None:
+                setattr(self, name, column[keep])
+        self.time = self.time - origin
+        self.start = self.start - origin
+
+    def get_interval_span(self, interval, ftime, first, last):
+        """ Array version of TimeSeries.get_interval_range(), returning the
+            first candidate interval of each sample and how many follow. """
+        count = (ftime + interval - 1) // interval
+        lo = np.maximum(0, (last + interval - 1) // interval - 1)
+        hi = np.minimum(count - 1, first // interval)
+        return lo, hi - lo
+
+    def get_interval_candidates(self, interval, ftime, first, last):
+        """ Yield (sample index, interval index) arrays for every candidate
+            interval of every sample.  The set of samples shrinks on every
+            step, so this is linear in the number of (sample, interval) pairs. """
+        lo, span = self.get_interval_span(interval, ftime, first, last)
+        idx = np.nonzero(span >= 0)[0]
+        j = 0
+        while idx.size > 0:
+            yield idx, lo[idx] + j
+            j += 1
+            idx = idx[span[idx] >= j]
+
+    # Sums are accumulated one sample at a time in log order, as TimeSeries
+    # does, so that both backends give the same floats: np.cumsum() and
+    # np.bincount() add sequentially, unlike np.dot() or np.sum().
+
+    def get_total(self, ftime):
+        span = np.minimum(self.time, ftime) - np.maximum(self.start, 0)
+        products = (self.value * np.maximum(span, 0)).astype(float)
+        total = float(np.cumsum(products)[-1]) if products.size else 0.0
+        return total/self.ctx.divisor
+
+    def get_interval_values(self, interval, ftime):
+        samples = []
+        bins = []
+        contribs = []
+        for idx, k in self.get_interval_candidates(interval, ftime, self.time, self.start):
+            start, end, value = self.start[idx], self.time[idx], self.value[idx]
+            istart = k * interval
+            iend = np.minimum(istart + interval, ftime)
+            sel = ~((iend < start) | (istart > end))
+            sbound = np.maximum(start[sel], istart[sel])
+            ebound = np.minimum(end[sel], iend[sel])
+            ratio = (ebound - sbound).astype(float) / (iend[sel] - istart[sel])
+            samples.append(idx[sel])
+            bins.append(k[sel])
+            contribs.append(value[sel] * ratio / self.ctx.divisor)
+        empty = [np.zeros(0, dtype=np.int64)]
+        order = np.argsort(np.concatenate(samples + empty), kind='stable')
+        bins = np.concatenate(bins + empty)[order]
+        contribs = np.concatenate(contribs + [np.zeros(0)])[order]
+        return np.bincount(bins, weights=contribs, minlength=(ftime + interval - 1) // interval)
+
+    def get_interval_samples(self, interval, ftime):
+        count = (ftime + interval - 1) // interval
+        members = []
+        bins = []
+        for idx, k in self.get_interval_candidates(interval, ftime, self.start, self.time):
+            istart = k * interval
+            iend = np.minimum(istart + interval, ftime)
+            sel = (self.start[idx] >= istart) & (self.time[idx] <= iend)
+            members.append(idx[sel])
+            bins.append(k[sel])
+        empty = [np.zeros(0, dtype=np.int64)]
+        members = np.concatenate(members + empty)
+        bins = np.concatenate(bins + empty)
+        order = np.lexsort((members, bins))
+        values = self.value[members[order]]
+        splits = np.searchsorted(bins[order], np.arange(1, count))
+        return np.split(values, splits)
+
+
+##### below are unit tests ##############
+
+import contextlib
+import gzip
+import io
+import shutil
+import struct
+import tempfile
+import zlib
+from os.path import join
+import fiologreader
+
+zstandard_imported = True
+try:
+    import zstandard
+except ImportError:
+    zstandard_imported = False
+
+class Test(unittest.TestCase):
+    tempdir = None
+
+    @classmethod
+    def setUpClass(cls):
+        Test.tempdir = tempfile.mkdtemp()
+
+    # remove anything left by unit test environment
+    # unless user sets UNITTEST_LEAVE_FILES environment variable
+
+    @classmethod
+    def tearDownClass(cls):
+        if not os.getenv("UNITTEST_LEAVE_FILES"):
+            shutil.rmtree(cls.tempdir)
+
+    def write_log(self, name, rows):
+        """ Write a log of (time, value) rows, returning its name """
+        fn = join(Test.tempdir, name)
+        with open(fn, 'w') as f:
+            for i, (time, value) in enumerate(rows):
+                f.write('%d, %d, %d, 4096, 0\n' % (time, value, i % 2))
+        return fn
+
+    def ramp_log(self, name, count, step):
+        return self.write_log(name, [((i + 1) * step, 1000 + i % 7) for i in range(count)])
+
+    def mixed_rows(self, count):
+        """ (time, value, ddir, bs, prio) rows mixing data directions, block
+            sizes and priorities """
+        return [(i * 10 + i % 3, 1000 + (i * 31) % 97, i % 3, (4096, 65536)[i % 2], (i // 5) % 2)
+                for i in range(1, count + 1)]
+
+    def write_mixed_log(self, name, rows):
+        fn = join(Test.tempdir, name)
+        with open(fn, 'w') as f:
+            f.writelines(['%d, %d, %d, %d, %d\n' % row for row in rows])
+        return fn
+
+    def assert_same_log(self, fn, expected):
+        """ Check that fn reads as the text log expected """
+        with open(expected) as f:
+            text = f.read()
+        with fiologreader.open_log(fn) as f:
+            self.assertEqual(f.read(), text)
+        self.assertEqual(list(LogReader(fn).rows()), list(LogReader(expected).rows()))
+        self.assertEqual(list(LogReader(fn, ddir=1, bs=4096).samples()),
+                         list(LogReader(expected, ddir=1, bs=4096).samples()))
+        if numpy_imported:
+            got = LogReader(fn, prio=1).read_columns()
+            want = LogReader(expected, prio=1).read_columns()
+            self.assertEqual(sorted(got), sorted(want))
+            for name in want:
+                self.assertEqual(got[name].tolist(), want[name].tolist())
+        self.assertEqual([(r[0], list(r[1])) for r in get_rows(parse_args(['-s', fn]), [fn])],
+                         [(r[0], list(r[1])) for r in get_rows(parse_args(['-s', expected]), [expected])])
+
+    def backends(self):
+        return [[], ['--jobs', '2']] + ([['--numpy']] if numpy_imported else [])
+
+    def output(self, printer, *args):
+        """ Return what printer(*args) prints """
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            printer(*args)
+        return out.getvalue()
+
+    def test_a0_single_pass_engine(self):
+        # samples spanning several intervals, ending on interval
+        # boundaries and zero-length ones
+        fn = self.write_log('engine', [(t, (t * 7919) % 1009) for t in
+                                       (0, 130, 250, 250, 999, 1000, 1001, 3100, 3105, 4000, 4350)])
+        for opts in ([], ['-d', '3'], ['--start', '900', '--end', '3500']):
+            ctx = parse_args(opts + ['-i', '250', fn])
+            ts = TimeSeries(ctx, fn)
+            ftime = get_window_end(ctx, get_ftime([ts]))
+            intervals = list(get_intervals(ctx, ftime))
+            # the same sums as scanning every sample for every interval
+            self.assertEqual(ts.get_interval_values(ctx.interval, ftime),
+                             [ts.get_value(start, end) for (start, end) in intervals])
+            self.assertEqual(ts.get_interval_samples(ctx.interval, ftime),
+                             [[s.value for s in ts.get_samples(start, end)] for (start, end) in intervals])
+            self.assertAlmostEqual(ts.get_total(ftime),
+                                   sum([ts.get_value(start, end) * (end - start) for (start, end) in intervals]))
+
+    def test_a1_stream_unequal_logs(self):
+        files = [self.ramp_log('long1', 5000, 100), self.ramp_log('short', 20, 130),
+                 self.ramp_log('long2', 3000, 70)]
+        for opt in ('-s', '-A'):
+            ctx = parse_args(['--stream', opt, '-i', '300'] + files)
+            # count the samples read from each log
+            read = collections.Counter()
+            def counted(ctx, fn, read_samples=read_samples):
+                for sample in read_samples(ctx, fn):
+                    read[fn] += 1
+                    yield sample
+            globals()['read_samples'], saved = counted, read_samples
+            try:
+                rows = list(get_stream_rows(ctx, files))
+            finally:
+                globals()['read_samples'] = saved
+            expected = list(get_rows(parse_args([opt, '-i', '300'] + files), files))
+            self.assertEqual([r[0] for r in rows], [r[0] for r in expected])
+            if opt == '-s':
+                self.assertEqual([r[1] for r in rows], [list(r[1]) for r in expected])
+            else:
+                self.assertEqual([[(p.count, p.total) for p in r[1]] for r in rows],
+                                 [[(p.count, p.total) for p in r[1]] for r in expected])
+            # the longer logs are not read past the end of the shorter one
+            self.assertEqual(rows[-1][0][1], 20 * 130)
+            self.assertTrue(read[files[0]] <= 20 * 130 // 100 + 1)
+            self.assertTrue(read[files[2]] <= 20 * 130 // 70 + 1)
+
+    @unittest.skipUnless(numpy_imported, 'needs numpy')
+    def test_b1_numpy_backend(self):
+        # irregular timestamps and values, so that sums are inexact
+        files = [self.write_log('jitter%d' % j, [(i * 97 + (i * i * (j + 3)) % 89, (i * 7919 + j) % 100003)
+                                                  for i in range(1, 2000)]) for j in range(3)]
+        for opts in (['-a'], ['-s', '-i', '333'], ['-f', '-d', '7'], ['-A'], [],
+                     ['-a', '--start', '20000', '--end', '150000']):
+            for backend in ([], ['--jobs', '2']):
+                ctx = parse_args(opts + backend + files)
+                expected = load_logs(ctx, files, get_total if not opts else get_partials)
+                ctx = parse_args(['--numpy'] + opts + backend + files)
+                got = load_logs(ctx, files, get_total if not opts else get_partials)
+                self.assertEqual(got[0], expected[0])
+                if opts == ['-A']:
+                    for a, b in zip(got[1], expected[1]):
+                        self.assertEqual([(p.count, p.total, p.min, p.max, p.quantiles([0.5, 0.99])) for p in a],
+                                         [(p.count, p.total, p.min, p.max, p.quantiles([0.5, 0.99])) for p in b])
+                else:
+                    # the same floats, not just close ones
+                    self.assertEqual([list(p) if opts else p for p in got[1]],
+                                     [list(p) if opts else p for p in expected[1]])
+
+    def test_b2_jobs_match_serial(self):
+        files = [self.write_log('jobs%d' % j, [(i * 97 + (i * i * (j + 3)) % 89, (i * 7919 + j) % 100003)
+                                                for i in range(1, 1000 + 300 * j)]) for j in range(3)]
+        for opts in (['-s', '-i', '333'], ['-A'], [], ['-a', '--start', '20000', '--end', '50000']):
+            reduce_series = get_partials if opts else get_total
+            expected = load_logs(parse_args(opts + files), files, reduce_series)
+            for jobs in ('2', '4'):
+                got = load_logs(parse_args(['-j', jobs] + opts + files), files, reduce_series)
+                self.assertEqual(got[0], expected[0])
+                if opts == ['-A']:
+                    for a, b in zip(got[1], expected[1]):
+                        self.assertEqual([(p.count, p.total, p.min, p.max, p.quantiles([0.5, 0.99])) for p in a],
+                                         [(p.count, p.total, p.min, p.max, p.quantiles([0.5, 0.99])) for p in b])
+                else:
+                    self.assertEqual([list(p) if opts else p for p in got[1]],
+                                     [list(p) if opts else p for p in expected[1]])
+        # a log failing to load does not leave the other processes waiting
+        with self.assertRaises(IOError):
+            load_logs(parse_args(['-j', '2', '-s'] + files + [join(Test.tempdir, 'missing')]),
+                      files + [join(Test.tempdir, 'missing')], get_partials)
+
+    def test_c1_sketch_quantiles(self):
+        ps = [0.0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 0.999, 1.0]
+        # nothing compacted yet, exactly the interpolated percentiles
+        values = [(i * 7919) % 1009 for i in range(150)]
+        exact = ExactQuantiles()
+        exact.extend(values)
+        sketch = QuantileSketch(0.01)
+        sketch.extend(values)
+        self.assertEqual(sketch.quantiles(ps), exact.quantiles(ps))
+
+        # the rank of each estimate is within the error, and estimates are
+        # not all on the low side, extending and merging sketches
+        error = 0.01
+        values = [((i * 2654435761) % 2**32) % 100000 for i in range(100000)]
+        exact = sorted(values)
+        merged = QuantileSketch(error)
+        for part in range(4):
+            sketch = QuantileSketch(error)
+            for i in range(part * 25000, (part + 1) * 25000, 1000):
+                sketch.extend(values[i:i + 1000])
+            merged.merge(sketch)
+        self.assertEqual((merged.count, merged.total, merged.min, merged.max),
+                         (len(values), sum(values), exact[0], exact[-1]))
+        deviations = []
+        for p, q in zip(ps, merged.quantiles(ps)):
+            rank = (bisect.bisect_left(exact, q) + bisect.bisect_right(exact, q)) / 2.0
+            deviations.append((rank - p * (len(exact) - 1)) / len(exact))
+        self.assertTrue(max([abs(d) for d in deviations]) <= error, deviations)
+        self.assertTrue(abs(sum(deviations) / len(deviations)) <= error / 4, deviations)
+        self.assertEqual(merged.quantiles([0.0, 1.0]), [exact[0], exact[-1]])
+
+    def test_c2_default_mean(self):
+        files = [self.write_log('mean%d' % j, [(i * 97 + (i * i * (j + 3)) % 89, (i * 7919 + j) % 100003)
+                                                for i in range(1, 1000 + 300 * j)]) for j in range(3)]
+        for opts in ([], ['-d', '7'], ['--start', '20000', '--end', '50000'], ['-i', '333']):
+            for backend in self.backends():
+                ctx = parse_args(opts + backend + files)
+                # the closed form gives the mean of the interval sums
+                self.assertEqual(self.output(print_mean, ctx, *load_logs(ctx, files, get_total)),
+                                 self.output(print_default, ctx, get_rows(ctx, files)))
+
+    def test_c3_summary(self):
+        fn = self.write_log('summary', [(1000, 10), (2000, 20), (3000, 40), (4000, 30), (4500, 50)])
+        ctx = parse_args(['-S', fn])
+        self.assertEqual(self.output(print_summary, ctx, get_rows(ctx, [fn])),
+                         'mean, 27.778\n'      # (10 + 20 + 40 + 30 + 50 / 2) x 1000 / 4500
+                         'total, 125.000\n'    # value x seconds
+                         # the last interval is cut short at 4500, holding a sum of 50
+                         'peak, 4500, 50.000\n'
+                         'trough, 1000, 10.000\n')
+        # the same mean as the default output
+        self.assertEqual(self.output(print_summary, ctx, get_rows(ctx, [fn])).splitlines()[0],
+                         'mean, ' + self.output(print_mean, ctx, *load_logs(ctx, [fn], get_total)).strip())
+
+    def test_d1_filters(self):
+        rows = self.mixed_rows(3000)
+        fn = self.write_mixed_log('mixed', rows)
+        for opts, keep in ((['--ddir', 'w'], lambda r: r[2] == 1),
+                           (['--ddir', '2'], lambda r: r[2] == 2),
+                           (['--bs', '65536'], lambda r: r[3] == 65536),
+                           (['--prio', '1'], lambda r: r[4] == 1),
+                           (['--ddir', 'r', '--bs', '4096', '--prio', '0'],
+                            lambda r: r[2] == 0 and r[3] == 4096 and r[4] == 0)):
+            # the same as a log of the rows passing the filters
+            filtered = self.write_mixed_log('filtered', [r for r in rows if keep(r)])
+            expected = list(get_rows(parse_args(['-s', '-i', '500', filtered]), [filtered]))
+            self.assertTrue(len(expected) > 40)
+            for backend in self.backends():
+                ctx = parse_args(opts + backend + ['-s', '-i', '500', fn])
+                self.assertEqual([(r[0], list(r[1])) for r in get_rows(ctx, [fn])],
+                                 [(r[0], list(r[1])) for r in expected])
+                self.assertEqual([r for r in get_stream_rows(ctx, [fn])],
+                                 [(r[0], list(r[1])) for r in expected])
+
+    def test_d2_log_schemas(self):
+        # the columns of each layout flush_samples() may write
+        rows = [(i * 10, 500 + i, 900 + i, i % 2, 4096 * (1 + i % 3), 8192 * i, 0x2000 * (i % 2) + 4, 3 * i)
+                for i in range(1, 201)]
+        for columns, prio in ((('time', 'value', 'ddir', 'bs', 'prio'), '%d'),
+                              (('time', 'value', 'max', 'ddir', 'bs', 'offset', 'prio'), '%d'),
+                              (('time', 'value', 'ddir', 'bs', 'offset', 'prio', 'issue_time'), '0x%04x'),
+                              (('time', 'value', 'max', 'ddir', 'bs', 'prio', 'issue_time'), '0x%04x'),
+                              (('time', 'value', 'ddir', 'bs'), None)):
+            expected = []
+            fn = join(Test.tempdir, 'schema_' + '_'.join(columns))
+            with open(fn, 'w') as f:
+                for row in rows:
+                    entry = dict(zip(LOG_FIELDS, row))
+                    if prio == '%d':
+                        entry['prio'] = int(entry['prio'] >> 13 == 1)
+                    f.write(', '.join([(prio if name == 'prio' else '%d') % entry[name]
+                                       for name in columns]) + '\n')
+                    expected.append(tuple([entry[name] if name in columns else None for name in LOG_FIELDS]))
+            reader = LogReader(fn)
+            self.assertEqual([tuple(r) for r in reader.rows()], expected)
+            self.assertEqual(tuple(reader.schema.columns), columns)
+            if numpy_imported:
+                got = LogReader(fn).read_columns()
+                self.assertEqual(sorted(got), sorted(columns))
+                for name in columns:
+                    self.assertEqual(got[name].tolist(), [e[LOG_FIELDS.index(name)] for e in expected])
+
+    def test_e1_window_index(self):
+        count = 10 * fiologreader.INDEX_LINES
+        rows = self.mixed_rows(count)
+        fn = self.write_mixed_log('window', rows)
+        # only the first and last rows are writes
+        sparse_rows = [r[:2] + ((1 if i < 100 or i >= count - 100 else 0),) + r[3:]
+                       for i, r in enumerate(rows)]
+        sparse = self.write_mixed_log('sparse', sparse_rows)
+        for (log, ddir, start, end) in ((fn, None, 40000, 80000), (fn, 0, 40001, 80003),
+                                        (fn, None, 0, 5000), (fn, None, 99000, None),
+                                        (fn, None, 200000, None), (sparse, 1, 50000, 90000)):
+            got = list(LogReader(log, ddir=ddir, start=start, end=end).samples())
+            # the last row before start, then the rows up to the first one at or
+            # after end, nothing if no row is at or after start
+            times = [(r[0], r[1]) for r in (sparse_rows if log == sparse else rows)
+                     if ddir is None or r[2] == ddir]
+            after = [i for i, (t, v) in enumerate(times) if t >= start]
+            expected = []
+            for (t, v) in times[max(0, after[0] - 1):] if after else []:
+                expected.append((t, v))
+                if end is not None and t >= end:
+                    break
+            self.assertEqual(got, expected)
+            if numpy_imported:
+                columns = LogReader(log, ddir=ddir, start=start, end=end).read_columns()
+                self.assertEqual(list(zip(columns['time'].tolist(), columns['value'].tolist())), expected)
+        # the index is cached next to the log, and rebuilt when it changes
+        with open(fn + fiologreader.INDEX_SUFFIX) as f:
+            self.assertEqual(f.readline().strip(), fiologreader.get_index_stamp(fn))
+            self.assertEqual(len(f.readlines()), 10)
+        with open(fn, 'a') as f:
+            f.write('%d, 1, 0, 4096, 0\n' % (rows[-1][0] + 10))
+        self.assertEqual(list(LogReader(fn, start=rows[-1][0] + 1).samples())[-1], (rows[-1][0] + 10, 1))
+        with open(fn + fiologreader.INDEX_SUFFIX) as f:
+            self.assertEqual(f.readline().strip(), fiologreader.get_index_stamp(fn))
+
+        # intervals within the window are those of the whole log
+        full = list(get_rows(parse_args(['-s', '-i', '1000', fn]), [fn]))
+        for backend in self.backends():
+            ctx = parse_args(backend + ['-s', '-i', '1000', '--start', '30000', '--end', '70000', fn])
+            got = list(shift_rows(ctx, get_rows(ctx, [fn])))
+            self.assertEqual([(r[0], list(r[1])) for r in got],
+                             [(r[0], list(r[1])) for r in full if r[0][0] >= 30000 and r[0][1] <= 70000])
+
+    @unittest.skipUnless(numpy_imported, 'needs numpy')
+    def test_f1_export_round_trip(self):
+        rows = self.mixed_rows(5000)
+        fn = self.write_mixed_log('export.log', rows)
+        formats = ['npz'] + (['parquet', 'arrow'] if fiologreader.import_pyarrow() else [])
+        # small row groups, so that windows are read from a few of them
+        saved = fiologreader.ROW_GROUP_ROWS
+        fiologreader.ROW_GROUP_ROWS = 512
+        try:
+            for fmt in formats:
+                out = export_log(parse_args(['--export', '--export-format', fmt, fn]), fn)
+                self.assertEqual(out, fn + STORE_SUFFIXES[fmt])
+                self.assertEqual(fiologreader.get_store_format(out), fmt)
+                store = fiologreader.ColumnStore(out)
+                self.assertEqual(len(store.groups), -(-len(rows) // 512))
+                for opts in ([], ['--ddir', 'w', '--prio', '1'], ['--start', '12000', '--end', '20000'],
+                             ['--bs', '4096', '--start', '100', '--end', '33333']):
+                    ctx = parse_args(opts + [fn])
+                    expected = get_log_reader(ctx, fn).read_columns()
+                    got = get_log_reader(ctx, out).read_columns()
+                    self.assertEqual(sorted(got), sorted(expected))
+                    for name in expected:
+                        self.assertEqual(got[name].dtype, expected[name].dtype)
+                        self.assertEqual(got[name].tolist(), expected[name].tolist())
+                    self.assertEqual(list(get_log_reader(ctx, out).samples()),
+                                     list(get_log_reader(ctx, fn).samples()))
+                    self.assertEqual([(r[0], list(r[1])) for r in get_rows(parse_args(['-s'] + opts + [out]), [out])],
+                                     [(r[0], list(r[1])) for r in get_rows(parse_args(['-s'] + opts + [fn]), [fn])])
+                # only the rows passing the filters are exported
+                out = export_log(parse_args(['--export', '--export-format', fmt, '--ddir', 'r', fn]), fn)
+                self.assertEqual(LogReader(out).read_columns()['ddir'].tolist(),
+                                 [r[2] for r in rows if r[2] == 0])
+        finally:
+            fiologreader.ROW_GROUP_ROWS = saved
+
+    def test_g1_gzip_log(self):
+        fn = self.write_mixed_log('gzip.log', self.mixed_rows(3000))
+        with open(fn, 'rb') as f, gzip.open(fn + '.gz', 'wb') as out:
+            out.write(f.read())
+        self.assert_same_log(fn + '.gz', fn)
+
+    @unittest.skipUnless(zstandard_imported, 'needs zstandard')
+    def test_g2_zstd_log(self):
+        fn = self.write_mixed_log('zstd.log', self.mixed_rows(3000))
+        with open(fn, 'rb') as f, open(fn + '.zst', 'wb') as out:
+            out.write(zstandard.ZstdCompressor().compress(f.read()))
+        self.assert_same_log(fn + '.zst', fn)
+
+    def test_g3_stored_log(self):
+        # io_sample records as fio stores them with log_store_compressed,
+        # a zlib stream per flush, in the layouts of some log options
+        rt = fiologreader.IOPRIO_CLASS_RT << fiologreader.IOPRIO_CLASS_SHIFT
+        for flags, fmt in ((0, '%d, %d, %d, %d, %d\n'),
+                           (fiologreader.LOG_OFFSET_SAMPLE_BIT | fiologreader.LOG_PRIO_SAMPLE_BIT |
+                            fiologreader.LOG_ISSUE_TIME_SAMPLE_BIT, '%d, %d, %d, %d, %d, 0x%04x, %d\n'),
+                           (fiologreader.LOG_AVG_MAX_SAMPLE_BIT, '%d, %d, %d, %d, %d, %d\n')):
+            records = []
+            text = []
+            for (time, value, ddir, bs, prio) in self.mixed_rows(3000):
+                ioprio = (rt if prio else 0) | time % 8
+                records.append(fiologreader.IO_SAMPLE.pack(time, value, value * 2, ddir | flags, ioprio, bs))
+                if flags & fiologreader.LOG_OFFSET_SAMPLE_BIT:
+                    records.append(struct.pack('=QQ', time * 4096, time - 3))
+                    text.append(fmt % (time, value, ddir, bs, time * 4096, ioprio, time - 3))
+                elif flags & fiologreader.LOG_AVG_MAX_SAMPLE_BIT:
+                    text.append(fmt % (time, value, value * 2, ddir, bs, prio))
+                else:
+                    text.append(fmt % (time, value, ddir, bs, prio))
+            fz = join(Test.tempdir, 'stored%x.log.fz' % flags)
+            with open(fz, 'wb') as f:
+                for i in range(0, len(records), 700):
+                    f.write(zlib.compress(b''.join(records[i:i + 700])))
+            fn = join(Test.tempdir, 'stored%x.log' % flags)
+            with open(fn, 'w') as f:
+                f.writelines(text)
+            self.assertTrue(fiologreader.is_stored_log(fz))
+            self.assert_same_log(fz, fn)
+            # records and streams split across read blocks
+            with open(fz, 'rb') as f:
+                stored = ''.join([fiologreader.format_samples(schema, buf) for (schema, buf) in
+                                  fiologreader.read_stored_samples(f, block_size=1000)])
+            self.assertEqual(stored, ''.join(text))
 
 
 if __name__ == '__main__':
+    if os.getenv('UNITTEST'):
+        sys.exit(unittest.main())
     ctx = parse_args()
-    series = []
-    for fn in ctx.FILE:
-       series.append(TimeSeries(ctx, fn)) 
+    if ctx.numpy and not numpy_imported:
+        sys.stderr.write('WARNING: numpy not found, using the pure Python backend.\n')
+        ctx.numpy = False
+    if ctx.export:
+        if not numpy_imported:
+            sys.exit('ERROR: --export needs numpy.')
+        if '-' in ctx.FILE:
+            sys.exit('ERROR: --export cannot convert stdin.')
+        export_logs(ctx, ctx.FILE)
+        sys.exit(0)
+    if not (ctx.stream or ctx.sum or ctx.average or ctx.full or ctx.allstats or ctx.summary):
+        # the default output only needs the total of each log
+        print_mean(ctx, *load_logs(ctx, ctx.FILE, get_total))
+        sys.exit(0)
+    if ctx.stream:
+        rows = flush_rows(get_stream_rows(ctx, ctx.FILE))
+    else:
+        rows = get_rows(ctx, ctx.FILE)
+    if ctx.start:
+        rows = shift_rows(ctx, rows)
     if ctx.sum:
-        print_sums(ctx, series)
+        print_sums(ctx, rows)
     elif ctx.average:
-        print_averages(ctx, series)
+        print_averages(ctx, rows)
     elif ctx.full:
-        print_full(ctx, series)
+        print_full(ctx, rows)
     elif ctx.allstats:
-        print_all_stats(ctx, series)
+        print_all_stats(ctx, rows)
+    elif ctx.summary:
+        print_summary(ctx, rows)
     else:
-        print_default(ctx, series)
+        print_default(ctx, rows)
@@ -0,0 +1,858 @@
+"""
+    Reading of fio log files, shared by fiologparser.py and
+    fiologparser_hist.py.
+
+    open_log() opens a log however it was stored and inflates it on the
+    fly, so there is no need to run fio --inflate-log into a temporary
+    file first:
+
+      - plain text logs
+      - logs stored by fio with log_store_compressed=1 (*.log.fz), zlib
+        chunks of binary samples which are decoded into the text fio
+        --inflate-log would print.  Histogram logs stored that way cannot
+        be read back, their bins are not in the file.
+      - gzip (*.gz)
+      - zstd (*.zst), if the zstandard module is installed
+
+    LogReader reads bw/iops/lat/clat/slat logs with every column that
+    flush_samples() in iolog.c may write:
+
+        time, value, [max,] ddir, bs, [offset,] prio, [issue_time]
+
+    max is present with log_avg_max, offset with log_offset and issue_time
+    with log_issue_time.  prio is written in hex with log_prio, otherwise
+    it is 1 for real time priority I/O and 0 for anything else.  Which
+    columns a log has is detected from its first lines.
+
+    write_store() converts the columns of a log to Parquet or Arrow IPC
+    (with pyarrow) or NumPy .npz files.  LogReader reads those directly,
+    without any text parsing, and ColumnStore can read just the row groups
+    overlapping a time window.
+
+    When only a time window of a plain text log is wanted, a sparse index
+    of the byte offset of every INDEX_LINES-th line is built once and kept
+    next to the log (log + '.idx'), so later reads can seek to the window
+    rather than parse everything before it.
+"""
+import collections
+import gzip
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+import zlib
+
+numpy_imported = True
+try:
+    import numpy as np
+except ImportError:
+    numpy_imported = False
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# fio compresses each chunk with deflateInit(), so every chunk starts with
+# a zlib header using the default 32K window
+ZLIB_CMF = 0x78
+
+# With log_store_compressed=1, fio does not write text but deflates the
+# struct io_sample records of iolog.h as they are in memory, one zlib stream
+# per batch of samples flushed.  Each record is time, data.val.val0 (the
+# value), data.val.val1 (the max with log_avg_max), __ddir, priority and
+# bs, followed by aux[] with the offset and issue time when they are
+# logged.  Flag bits in __ddir tell which columns the log has.
+IO_SAMPLE = struct.Struct('=QqqIH2xQ')
+LOG_OFFSET_SAMPLE_BIT = 0x80000000
+LOG_PRIO_SAMPLE_BIT = 0x40000000
+LOG_AVG_MAX_SAMPLE_BIT = 0x20000000
+LOG_ISSUE_TIME_SAMPLE_BIT = 0x10000000
+LOG_SAMPLE_BITS = (LOG_OFFSET_SAMPLE_BIT | LOG_PRIO_SAMPLE_BIT |
+                   LOG_AVG_MAX_SAMPLE_BIT | LOG_ISSUE_TIME_SAMPLE_BIT)
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_RT = 1
+
+
+def inflate_chunks(fp, block_size):
+    """ Inflate a file of back to back zlib streams a block at a time, the
+        way iolog_file_inflate() in iolog.c does.  Yields (data, end), end
+        being true for the last data of each stream. """
+    stream = None
+    data = b''
+    while True:
+        if not data:
+            data = fp.read(block_size)
+        if not data:
+            if stream is not None:
+                raise ValueError("truncated compressed log")
+            return
+        if stream is None:
+            stream = zlib.decompressobj()
+        out = stream.decompress(data)
+        if stream.eof:
+            data = stream.unused_data
+            stream = None
+            yield out, True
+        else:
+            data = b''
+            yield out, False
+
+
+def get_stored_schema(ddir):
+    """ Return the LogSchema of a stored log from the __ddir of a sample """
+    return LogSchema(avg_max=bool(ddir & LOG_AVG_MAX_SAMPLE_BIT),
+                     offset=bool(ddir & LOG_OFFSET_SAMPLE_BIT),
+                     issue_time=bool(ddir & LOG_ISSUE_TIME_SAMPLE_BIT),
+                     prio_hex=bool(ddir & LOG_PRIO_SAMPLE_BIT))
+
+
+def get_stored_sample_size(schema):
+    """ __log_entry_sz() in iolog.h """
+    return IO_SAMPLE.size + 8 * (int(schema.offset) + int(schema.issue_time))
+
+
+def read_stored_samples(fp, block_size=1024 * 1024):
+    """ Yield (schema, buf) for the samples of a log stored with
+        log_store_compressed, buf holding whole io_sample records.  As in
+        flush_samples(), the layout of the records of a stream is given by
+        the flag bits of its first sample. """
+    schema = None
+    tail = b''
+    for data, end in inflate_chunks(fp, block_size):
+        buf = tail + data
+        tail = b''
+        if schema is None and len(buf) >= IO_SAMPLE.size:
+            schema = get_stored_schema(IO_SAMPLE.unpack_from(buf)[3])
+        if schema is not None:
+            cut = len(buf) - len(buf) % get_stored_sample_size(schema)
+            buf, tail = buf[:cut], buf[cut:]
+            if buf:
+                yield schema, buf
+        else:
+            tail = buf
+        if end:
+            if tail:
+                raise ValueError("truncated sample in compressed log")
+            schema = None
+
+
+def is_class_rt(prio):
+    """ ioprio_value_is_class_rt() """
+    return int(prio >> IOPRIO_CLASS_SHIFT == IOPRIO_CLASS_RT)
+
+
+def format_samples(schema, buf):
+    """ Return io_sample records as the text flush_samples() prints """
+    size = get_stored_sample_size(schema)
+    lines = []
+    for pos in range(0, len(buf), size):
+        time, value, mx, ddir, prio, bs = IO_SAMPLE.unpack_from(buf, pos)
+        aux = pos + IO_SAMPLE.size
+        fields = [time, value]
+        if schema.avg_max:
+            fields.append(mx)
+        fields.extend([ddir & ~LOG_SAMPLE_BITS, bs])
+        if schema.offset:
+            fields.append(struct.unpack_from('=Q', buf, aux)[0])
+            aux += 8
+        fields = ['%d' % f for f in fields]
+        fields.append('0x%04x' % prio if schema.prio_hex else '%d' % is_class_rt(prio))
+        if schema.issue_time:
+            fields.append('%d' % struct.unpack_from('=Q', buf, aux)[0])
+        lines.append(', '.join(fields) + '\n')
+    return ''.join(lines)
+
+
+def get_stored_dtype(schema):
+    """ NumPy dtype of the io_sample records of a stored log """
+    names = ['time', 'value', 'max', 'ddir', 'prio', 'bs']
+    formats = ['u8', 'i8', 'i8', 'u4', 'u2', 'u8']
+    offsets = [0, 8, 16, 24, 28, 32]
+    for name in ('offset', 'issue_time'):
+        if getattr(schema, name):
+            names.append(name)
+            formats.append('u8')
+            offsets.append(IO_SAMPLE.size + 8 * (len(offsets) - 6))
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': get_stored_sample_size(schema)})
+
+
+def decode_samples(schema, buf):
+    """ Array version of format_samples(), returning a dict of the columns
+        of schema typed as LOG_DTYPES """
+    records = np.frombuffer(buf, dtype=get_stored_dtype(schema))
+    columns = {}
+    for name in schema.columns:
+        column = records[name]
+        if name == 'ddir':
+            column = column & ~np.uint32(LOG_SAMPLE_BITS)
+        elif name == 'prio' and not schema.prio_hex:
+            column = (column >> IOPRIO_CLASS_SHIFT) == IOPRIO_CLASS_RT
+        columns[name] = column.astype(LOG_DTYPES[name])
+    return columns
+
+
+class StoredLogReader(io.RawIOBase):
+    """ Raw reader turning a log stored with log_store_compressed back
+        into text, as fio --inflate-log does.  Compressed data is read and
+        inflated a block at a time, so memory use does not depend on the
+        size of the log. """
+    def __init__(self, fp, block_size=1024 * 1024):
+        self.fp = fp
+        self.samples = read_stored_samples(fp, block_size)
+        self.buf = b''
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        """ Decode samples until there is output or the file is exhausted. """
+        while self.pos == len(self.buf):
+            for schema, buf in self.samples:
+                break
+            else:
+                return False
+            self.buf = format_samples(schema, buf).encode()
+            self.pos = 0
+        return True
+
+    def readinto(self, b):
+        if not self.fill():
+            return 0
+        n = min(len(b), len(self.buf) - self.pos)
+        b[:n] = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.fp.close()
+        io.RawIOBase.close(self)
+
+
+def is_zlib_header(magic):
+    return (len(magic) >= 2 and magic[0] == ZLIB_CMF and
+            ((magic[0] << 8) | magic[1]) % 31 == 0)
+
+
+def open_zstd(fp):
+    try:
+        import zstandard
+    except ImportError:
+        fp.close()
+        raise RuntimeError("the zstandard module is needed to read zstd "
+                           "compressed logs")
+    return zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True,
+                                                      closefd=True)
+
+
+def get_compression(magic):
+    """ Return 'gzip', 'zstd' or 'zlib' for the first bytes of a
+        compressed log, None for anything else. """
+    magic = bytearray(magic)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if is_zlib_header(magic):
+        return 'zlib'
+    return None
+
+
+def is_stored_log(fn):
+    """ Tell whether fn is a log stored by fio with log_store_compressed """
+    if fn == '-':
+        return False
+    with open(fn, 'rb') as fp:
+        return get_compression(fp.read(4)) == 'zlib'
+
+
+def open_log(fn, mode='r', offset=0):
+    """ Open a fio log for reading, inflating it if it is compressed.
+        The format is detected from the first bytes of the file rather
+        than its name.  mode is 'r' for text or 'rb' for bytes, and a
+        file name of '-' reads stdin.  A plain text log can be opened at
+        a byte offset.  A log stored with log_store_compressed reads as
+        the text fio --inflate-log would print. """
+    if fn == '-':
+        return sys.stdin.buffer if 'b' in mode else sys.stdin
+
+    fp = open(fn, 'rb')
+    compression = get_compression(fp.peek(4)[:4])
+    if offset and compression:
+        fp.close()
+        raise ValueError("cannot seek in compressed log %s" % fn)
+    if compression == 'gzip':
+        fp.close()
+        raw = gzip.open(fn, 'rb')
+    elif compression == 'zstd':
+        raw = io.BufferedReader(open_zstd(fp))
+    elif compression == 'zlib':
+        raw = io.BufferedReader(StoredLogReader(fp))
+    else:
+        fp.seek(offset)
+        raw = fp
+
+    if 'b' in mode:
+        return raw
+    return io.TextIOWrapper(raw)
+
+
+LOG_FIELDS = ('time', 'value', 'max', 'ddir', 'bs', 'offset', 'prio', 'issue_time')
+
+LOG_DTYPES = {'time': 'int64', 'value': 'int64', 'max': 'int64',
+              'ddir': 'uint8', 'bs': 'uint32', 'offset': 'uint64',
+              'prio': 'uint16', 'issue_time': 'uint64'}
+
+LogEntry = collections.namedtuple('LogEntry', LOG_FIELDS)
+
+# how many lines are looked at to work out the columns of a log
+SCHEMA_LINES = 100
+
+
+class LogSchema(object):
+    """ The columns present in a log, see flush_samples() in iolog.c """
+    def __init__(self, avg_max=False, offset=False, issue_time=False,
+                 prio=True, prio_hex=False):
+        self.avg_max = avg_max
+        self.offset = offset
+        self.issue_time = issue_time
+        self.prio = prio
+        self.prio_hex = prio_hex
+        columns = ['time', 'value']
+        if avg_max:
+            columns.append('max')
+        columns.extend(['ddir', 'bs'])
+        if offset:
+            columns.append('offset')
+        if prio:
+            columns.append('prio')
+        if issue_time:
+            columns.append('issue_time')
+        self.columns = columns
+        self.index = dict([(name, i) for i, name in enumerate(columns)])
+
+    def parse_field(self, name, field):
+        if name == 'prio':
+            return int(field, 16 if self.prio_hex else 10)
+        return int(field)
+
+    def fits(self, rows):
+        """ Check that rows split on commas could have this layout """
+        for fields in rows:
+            if len(fields) != len(self.columns):
+                return False
+            if int(fields[self.index['ddir']]) not in (0, 1, 2):
+                return False
+            if self.prio:
+                prio = fields[self.index['prio']].strip()
+                if self.prio_hex != prio.startswith('0x'):
+                    return False
+                if not self.prio_hex and prio not in ('0', '1'):
+                    return False
+            if self.avg_max and int(fields[2]) < int(fields[1]):
+                return False
+        return True
+
+
+# layouts to try for a given number of columns, the more common first
+SCHEMA_CANDIDATES = [
+    dict(),
+    dict(offset=True),
+    dict(avg_max=True),
+    dict(issue_time=True),
+    dict(avg_max=True, offset=True),
+    dict(offset=True, issue_time=True),
+    dict(avg_max=True, issue_time=True),
+    dict(avg_max=True, offset=True, issue_time=True),
+    # fio versions before the priority column
+    dict(prio=False),
+    dict(prio=False, offset=True),
+]
+
+
+def detect_schema(lines):
+    """ Work out the LogSchema of a log from some of its first lines. """
+    rows = [l.split(',') for l in lines if l.strip()]
+    if not rows:
+        return LogSchema()
+    prio_hex = '0x' in ','.join(rows[0])
+    for candidate in SCHEMA_CANDIDATES:
+        schema = LogSchema(prio_hex=prio_hex, **candidate)
+        if schema.fits(rows):
+            return schema
+    raise ValueError("unrecognized fio log format: %s" % ','.join(rows[0]).strip())
+
+
+PARQUET_MAGIC = b'PAR1'
+ARROW_MAGIC = b'ARROW1'
+NPZ_MAGIC = b'PK\x03\x04'
+
+STORE_SUFFIXES = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}
+
+# rows per row group of a converted log
+ROW_GROUP_ROWS = 1024 * 1024
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def default_store_format():
+    return 'parquet' if import_pyarrow() else 'npz'
+
+
+def get_store_format(fn):
+    """ Return the format of a log converted by write_store(), or None for
+        a text log. """
+    if fn == '-':
+        return None
+    with open(fn, 'rb') as fp:
+        magic = fp.read(len(ARROW_MAGIC))
+    if magic.startswith(PARQUET_MAGIC):
+        return 'parquet'
+    if magic.startswith(ARROW_MAGIC):
+        return 'arrow'
+    if magic.startswith(NPZ_MAGIC):
+        return 'npz'
+    return None
+
+
+def get_row_groups(time):
+    """ Return (first row, min time, max time) for each group of
+        ROW_GROUP_ROWS rows. """
+    starts = np.arange(0, time.size, ROW_GROUP_ROWS)
+    if not starts.size:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.column_stack((starts, np.minimum.reduceat(time, starts),
+                            np.maximum.reduceat(time, starts)))
+
+
+def write_store(fn, columns, fmt=None):
+    """ Write the columns of a log, as returned by LogReader.read_columns(),
+        to fn as 'parquet', 'arrow' or 'npz'.  Rows are stored in groups of
+        ROW_GROUP_ROWS and the min and max time of each group is kept:
+        Parquet has these statistics itself, Arrow files carry them in
+        their schema metadata and .npz files in a row_groups array. """
+    fmt = fmt or default_store_format()
+    groups = get_row_groups(columns['time'])
+    if fmt == 'npz':
+        # each row group is its own member, loaded only when asked for
+        arrays = {'row_groups': groups,
+                  'columns': np.array([name for name in LOG_FIELDS if name in columns])}
+        bounds = list(groups[:, 0]) + [columns['time'].size]
+        for name, column in columns.items():
+            for i in range(len(groups)):
+                arrays['%s.%d' % (name, i)] = column[bounds[i]:bounds[i + 1]]
+        with open(fn, 'wb') as fp:
+            np.savez(fp, **arrays)
+        return
+
+    pa = import_pyarrow()
+    if pa is None:
+        raise RuntimeError("the pyarrow module is needed to write %s files" % fmt)
+    names = [name for name in LOG_FIELDS if name in columns]
+    table = pa.table([columns[name] for name in names], names=names)
+    if fmt == 'parquet':
+        pa.parquet.write_table(table, fn, row_group_size=ROW_GROUP_ROWS)
+    elif fmt == 'arrow':
+        metadata = {b'fio.row_groups': json.dumps(groups[:, 1:].tolist()).encode()}
+        table = table.replace_schema_metadata(metadata)
+        with pa.ipc.new_file(fn, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=ROW_GROUP_ROWS):
+                writer.write_batch(batch)
+    else:
+        raise ValueError("unknown log store format %s" % fmt)
+
+
+class ColumnStore(object):
+    """ Reader of a log converted by write_store().  Only the row groups
+        whose time range overlaps the requested window are read, Parquet
+        and Arrow files being memory mapped. """
+    def __init__(self, fn, fmt=None):
+        self.fn = fn
+        self.format = fmt or get_store_format(fn)
+        if self.format == 'npz':
+            self.file = np.load(fn)
+            self.names = self.file['columns'].tolist()
+            self.groups = self.file['row_groups'][:, 1:].tolist()
+            return
+
+        self.pa = import_pyarrow()
+        if self.pa is None:
+            raise RuntimeError("the pyarrow module is needed to read %s files" % self.format)
+        if self.format == 'parquet':
+            self.file = self.pa.parquet.ParquetFile(fn, memory_map=True)
+            self.names = self.file.schema_arrow.names
+            t = self.names.index('time')
+            self.groups = []
+            for i in range(self.file.metadata.num_row_groups):
+                stats = self.file.metadata.row_group(i).column(t).statistics
+                if stats is None or not stats.has_min_max:
+                    self.groups.append((None, None))
+                else:
+                    self.groups.append((stats.min, stats.max))
+        else:
+            self.file = self.pa.ipc.open_file(self.pa.memory_map(fn))
+            self.names = self.file.schema.names
+            self.groups = json.loads(self.file.schema.metadata[b'fio.row_groups'].decode())
+
+    def get_row_groups(self, start=None, end=None):
+        """ Return the index of each row group which may have rows with
+            start <= time <= end. """
+        selected = []
+        for i, (lo, hi) in enumerate(self.groups):
+            if lo is not None and ((start is not None and hi < start) or
+                                   (end is not None and lo > end)):
+                continue
+            selected.append(i)
+        return selected
+
+    def read(self, names=None, start=None, end=None):
+        """ Return a dict of NumPy arrays holding the row groups which
+            overlap [start, end], so rows outside it may be included. """
+        return self.read_row_groups(self.get_row_groups(start, end), names)
+
+    def read_row_groups(self, selected, names=None):
+        """ Return a dict of NumPy arrays holding the given row groups """
+        names = names or self.names
+        if self.format == 'npz':
+            columns = dict([(name, [self.file['%s.%d' % (name, i)] for i in selected])
+                            for name in names])
+        else:
+            if self.format == 'parquet':
+                table = self.file.read_row_groups(selected, columns=names)
+            else:
+                batches = [self.file.get_batch(i) for i in selected]
+                table = self.pa.Table.from_batches(batches, schema=self.file.schema)
+            columns = dict([(name, [table.column(name).to_numpy()]) for name in names])
+        return dict([(name, np.concatenate(arrs + [np.zeros(0, dtype=LOG_DTYPES[name])]))
+                     for name, arrs in columns.items()])
+
+
+INDEX_LINES = 1024
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = 'fio-log-index'
+
+
+def is_indexable(fn):
+    """ Only plain text logs can be seeked into """
+    if fn == '-':
+        return False
+    with open(fn, 'rb') as fp:
+        magic = fp.read(len(ARROW_MAGIC))
+    return not get_compression(magic) and not get_store_format(fn)
+
+
+def build_index(fn, every=INDEX_LINES):
+    """ Return (time, byte offset) of every every-th line of a log """
+    index = []
+    offset = 0
+    with open(fn, 'rb') as f:
+        for i, line in enumerate(f):
+            if i % every == 0 and line.strip():
+                index.append((int(line.split(b',', 1)[0]), offset))
+            offset += len(line)
+    return index
+
+
+def get_index_stamp(fn):
+    st = os.stat(fn)
+    return '%s %d %d %d' % (INDEX_MAGIC, INDEX_LINES, st.st_size, int(st.st_mtime * 1e9))
+
+
+def load_index(fn):
+    """ Return the sparse index of a plain text log, reusing the one cached
+        in fn + INDEX_SUFFIX if the log has not changed since it was built,
+        otherwise building and caching it. """
+    stamp = get_index_stamp(fn)
+    try:
+        with open(fn + INDEX_SUFFIX) as f:
+            if f.readline().strip() == stamp:
+                return [tuple([int(x) for x in line.split()]) for line in f]
+    except (IOError, OSError, ValueError):
+        pass
+
+    index = build_index(fn)
+    # write a temporary file first, as other processes may be reading it
+    tmp = '%s%s.%d' % (fn, INDEX_SUFFIX, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            f.write(stamp + '\n')
+            f.writelines(['%d %d\n' % entry for entry in index])
+        os.rename(tmp, fn + INDEX_SUFFIX)
+    except (IOError, OSError):
+        # the log may be in a read-only directory, it is only a cache
+        pass
+    return index
+
+
+class LogReader(object):
+    """ Typed reader for a fio bw/iops/lat/clat/slat log.
+
+        Rows can be filtered on data direction, block size and priority.
+        The filters are applied as each line or block is parsed, so rows
+        which are dropped are never built.  Logs converted by write_store()
+        are read from their columns, which needs numpy.
+
+        With start and/or end, only a time window of the log is read: from
+        the last row before start (the start of the first sample in the
+        window) to the first row at or after end.  Logs are expected to be
+        in time order, as fio writes them. """
+
+    read_block_size = 16 * 1024 * 1024
+
+    def __init__(self, fn, ddir=None, bs=None, prio=None, schema=None,
+                 start=None, end=None):
+        self.fn = fn
+        self.schema = schema
+        self.filters = [(name, want) for name, want in
+                        (('ddir', ddir), ('bs', bs), ('prio', prio))
+                        if want is not None]
+        self.start = start
+        self.end = end
+        self.store_format = get_store_format(fn)
+
+    def get_offsets(self):
+        """ Return the byte offsets to try reading a window from, latest
+            first.  An offset is too late when filters leave no row before
+            start after it, so earlier and earlier ones are tried, ending
+            with the start of the log. """
+        if self.start is None or not is_indexable(self.fn):
+            return [0]
+        offsets = [offset for (time, offset) in load_index(self.fn)
+                   if time < self.start and offset]
+        offsets.reverse()
+        return [offsets[(1 << i) - 1] for i in range(len(offsets).bit_length())] + [0]
+
+    def lines(self, offset=0):
+        """ Yield the non-empty lines of the log from a byte offset,
+            detecting its schema from the first of them if it was not
+            given. """
+        with open_log(self.fn, offset=offset) as f:
+            head = list(itertools.islice(f, SCHEMA_LINES))
+            if self.schema is None:
+                self.schema = detect_schema(head)
+            for line in itertools.chain(head, f):
+                if line.strip():
+                    yield line
+
+    def get_filters(self):
+        return [(self.schema.index[name], name, want) for name, want in self.filters]
+
+    def window(self, read):
+        """ Yield the rows of read(offset) which are within the time
+            window, rows being tuples starting with the time. """
+        if self.start is None and self.end is None:
+            return read(0)
+        return self.read_window(read)
+
+    def read_window(self, read):
+        for offset in self.get_offsets():
+            started = False
+            prev = None
+            for row in read(offset):
+                if not started:
+                    if self.start is not None and row[0] < self.start:
+                        prev = row
+                        continue
+                    if prev is None and offset:
+                        # the last row before start is further back
+                        break
+                    started = True
+                    if prev is not None:
+                        yield prev
+                yield row
+                if self.end is not None and row[0] >= self.end:
+                    return
+            else:
+                return
+
+    def rows(self):
+        """ Yield a LogEntry for each row, None standing for a column
+            the log does not have. """
+        if self.store_format:
+            columns = self.read_columns()
+            fields = [columns[name].tolist() if name in columns else itertools.repeat(None)
+                      for name in LOG_FIELDS]
+            for values in zip(*fields):
+                yield LogEntry(*values)
+            return
+
+        for row in self.window(self.parse_rows):
+            yield row
+
+    def parse_rows(self, offset):
+        filters = None
+        for line in self.lines(offset):
+            if filters is None:
+                filters = self.get_filters()
+                columns = self.schema.columns
+            values = dict(zip(columns, [self.schema.parse_field(name, f)
+                                        for name, f in zip(columns, line.split(','))]))
+            if any([values[name] != want for i, name, want in filters]):
+                continue
+            yield LogEntry(*[values.get(name) for name in LOG_FIELDS])
+
+    def samples(self):
+        """ Yield (time, value) for each row.  Only the fields which are
+            needed are converted, which is much quicker than rows(). """
+        if self.store_format:
+            columns = self.read_columns()
+            for sample in zip(columns['time'].tolist(), columns['value'].tolist()):
+                yield sample
+            return
+
+        for sample in self.window(self.parse_samples):
+            yield sample
+
+    def parse_samples(self, offset):
+        filters = None
+        for line in self.lines(offset):
+            if filters is None:
+                filters = self.get_filters()
+            fields = line.split(',')
+            if filters and any([self.schema.parse_field(name, fields[i]) != want
+                                for i, name, want in filters]):
+                continue
+            yield (int(fields[0]), int(fields[1]))
+
+    def read_blocks(self, f):
+        """ Yield the file in large blocks, each ending on a line boundary. """
+        tail = b''
+        while True:
+            buf = f.read(self.read_block_size)
+            if not buf:
+                break
+            buf = tail + buf
+            cut = buf.rfind(b'\n') + 1
+            tail = buf[cut:]
+            if buf[:cut].strip():
+                yield buf[:cut]
+        if tail.strip():
+            yield tail
+
+    def parse_block(self, buf):
+        """ Parse a block of whole lines into a rows x columns array. """
+        ncols = len(self.schema.columns)
+        if self.schema.prio_hex:
+            # fromstring cannot parse the hex priorities of log_prio=1
+            rows = buf.decode().splitlines()
+            conv = {self.schema.index['prio']: lambda x: int(x, 16)}
+            arr = np.loadtxt(rows, delimiter=',', dtype=np.int64, converters=conv, ndmin=2)
+        else:
+            arr = np.fromstring(buf.replace(b',', b' ').decode(), dtype=np.int64, sep=' ')
+        return arr.reshape((-1, ncols))
+
+    def filter_columns(self, columns):
+        if not self.filters:
+            return columns
+        keep = np.ones(columns['time'].size, dtype=bool)
+        for name, want in self.filters:
+            keep &= columns[name] == want
+        return dict([(name, column[keep]) for name, column in columns.items()])
+
+    def trim_columns(self, columns, at_top):
+        """ Array version of read_window(), returning None if the last
+            row before start was not read. """
+        time = columns['time']
+        lo, hi = 0, time.size
+        if self.start is not None:
+            after = np.nonzero(time >= self.start)[0]
+            if not after.size:
+                lo = hi
+            elif after[0] == 0 and not at_top:
+                return None
+            else:
+                lo = max(0, after[0] - 1)
+        if self.end is not None:
+            past = np.nonzero(time[lo:] >= self.end)[0]
+            if past.size:
+                hi = lo + past[0] + 1
+        if lo == 0 and hi == time.size:
+            return columns
+        return dict([(name, column[lo:hi]) for name, column in columns.items()])
+
+    def read_columns(self):
+        """ Read the whole log, or its time window, into a dict of typed
+            NumPy arrays, one per column.  The log is parsed a block at a
+            time with array operations, rows being filtered out block by
+            block.  Needs numpy. """
+        if self.store_format:
+            return self.read_store_window(ColumnStore(self.fn, self.store_format))
+
+        for offset in self.get_offsets():
+            columns = self.parse_columns(offset)
+            if self.start is None and self.end is None:
+                return columns
+            columns = self.trim_columns(columns, offset == 0)
+            if columns is not None:
+                return columns
+
+    def read_store_window(self, store):
+        """ Read the row groups of a converted log overlapping the window,
+            adding neighbouring ones until the filtered rows reach past
+            both of its ends. """
+        count = len(store.groups)
+        groups = store.get_row_groups(self.start, self.end)
+        if groups:
+            first, last = groups[0], groups[-1] + 1
+        else:
+            # the window may still be within a single sample
+            first = last = len([hi for (lo, hi) in store.groups if lo is not None and hi < self.start])
+        while True:
+            columns = self.filter_columns(store.read_row_groups(list(range(first, last))))
+            time = columns['time']
+            if first > 0 and self.start is not None and not (time < self.start).any():
+                first -= 1
+            elif last < count and self.end is not None and not (time >= self.end).any():
+                last += 1
+            else:
+                return self.trim_columns(columns, True)
+
+    def parse_text_blocks(self, f):
+        """ Yield the columns of each block of a text log """
+        for buf in self.read_blocks(f):
+            if self.schema is None:
+                head = buf.split(b'\n', SCHEMA_LINES)[:SCHEMA_LINES]
+                self.schema = detect_schema([l.decode() for l in head])
+            arr = self.parse_block(buf)
+            yield dict([(name, arr[:, self.schema.index[name]].astype(LOG_DTYPES[name]))
+                        for name in self.schema.columns])
+
+    def decode_stored_blocks(self, f):
+        """ Yield the columns of each block of samples of a log stored
+            with log_store_compressed, decoded without going through text """
+        for schema, buf in read_stored_samples(f):
+            if self.schema is None:
+                self.schema = schema
+            yield decode_samples(schema, buf)
+
+    def parse_columns(self, offset):
+        columns = None
+        stored = is_stored_log(self.fn)
+        with (open(self.fn, 'rb') if stored else open_log(self.fn, 'rb', offset=offset)) as f:
+            blocks = self.decode_stored_blocks(f) if stored else self.parse_text_blocks(f)
+            for block in blocks:
+                if columns is None:
+                    columns = dict([(name, []) for name in self.schema.columns])
+                block = self.filter_columns(block)
+                for name, column in block.items():
+                    columns[name].append(column)
+                # the rest of the log is past the window
+                if self.end is not None and (block['time'] >= self.end).any():
+                    break
+
+        if columns is None:
+            if self.schema is None:
+                self.schema = LogSchema()
+            return dict([(name, np.zeros(0, dtype=LOG_DTYPES[name])) for name in self.schema.columns])
+        return dict([(name, np.concatenate(arrs)) for name, arrs in columns.items()])
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 # module to parse fio histogram log files, not using pandas
+# histograms are aligned with numpy
 # runs in python v2 or v3
 # to get help with the CLI: $ python fio-histo-log-pctiles.py -h
+# --output-format csv|json|npy writes plain CSV, JSON Lines or a NumPy array
+# without the parameters printed before the default text output
 # this can be run standalone as a script but is callable
 # assumes all threads run for same time duration
 # assumes all threads are doing the same thing for the entire run
@@ -21,10 +24,16 @@
 # if you do this, don't pass normal CLI parameters to it
 # otherwise it runs the CLI
 
-import sys, os, math, copy, time
-from copy import deepcopy
+import sys, os, math, time, itertools, json
+import multiprocessing
 import argparse
 from functools import reduce
+import numpy as np
+
+# fiohistbins.py is next to this script in the fio source tree, and in
+# share/fio next to the bin directory holding it once installed
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'share', 'fio'))
+from fiohistbins import get_bin_edges
 
 unittest2_imported = True
 try:
@@ -58,109 +67,206 @@ def myabort(msg):
 def exception_suffix( record_num, pathname ):
     return 'in histogram record %d file %s' % (record_num+1, pathname)
 
+# check one histogram record and convert it to a list of ints
+# raises FioHistoLogExc if it is not valid
+# previous_ts holds the last timestamp seen for each direction
+
+def parse_hist_record(r, k, logfn, buckets_per_interval, previous_ts):
+    tokens = r.split(',')
+    try:
+        int_tokens = [ int(t) for t in tokens ]
+    except ValueError as e:
+        raise FioHistoLogExc('non-integer value %s' % exception_suffix(k+1, logfn))
+
+    neg_ints = list([tk for tk in int_tokens if tk < 0])
+    if len(neg_ints) > 0:
+        raise FioHistoLogExc('negative integer value %s' % exception_suffix(k+1, logfn))
+
+    if len(int_tokens) < 3:
+        raise FioHistoLogExc('too few numbers %s' % exception_suffix(k+1, logfn))
+
+    direction = int_tokens[1]
+    if direction != direction_read and direction != direction_write:
+        raise FioHistoLogExc('invalid I/O direction %s' % exception_suffix(k+1, logfn))
+
+    time_ms = int_tokens[0]
+    if direction == direction_read:
+        if time_ms < previous_ts[direction_read]:
+            raise FioHistoLogExc('read timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
+    elif direction == direction_write:
+        if time_ms < previous_ts[direction_write]:
+            raise FioHistoLogExc('write timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
+    previous_ts[direction] = time_ms
+
+    bsz = int_tokens[2]
+    if bsz > (1 << 24):
+        raise FioHistoLogExc('block size too large %s' % exception_suffix(k+1, logfn))
+
+    buckets = int_tokens[3:]
+    if len(buckets) != buckets_per_interval:
+        raise FioHistoLogExc('%d buckets per interval but %d expected in %s' % 
+                (len(buckets), buckets_per_interval, exception_suffix(k+1, logfn)))
+    return int_tokens
+
+# same checks as parse_hist_record() on a records x columns matrix
+# of records with the expected number of buckets, record_nums holding
+# their line index in the log
+# the first invalid record is reported, with the first check it fails
+
+def check_hist_records(m, record_nums, logfn, previous_ts):
+    (times, directions, bszs) = (m[:,0], m[:,1], m[:,2])
+
+    # previous timestamp of the same direction for each record
+    previous = times.copy()
+    for d in (direction_read, direction_write):
+        rows = np.flatnonzero(directions == d)
+        previous[rows] = np.concatenate(([previous_ts[d]], times[rows][:-1]))
+    decreased = times < previous
+
+    checks = [
+        ((m < 0).any(axis=1), 'negative integer value %s'),
+        ((directions != direction_read) & (directions != direction_write), 'invalid I/O direction %s'),
+        (decreased & (directions == direction_read), 'read timestamp in column 1 decreased %s'),
+        (decreased & (directions == direction_write), 'write timestamp in column 1 decreased %s'),
+        (bszs > (1 << 24), 'block size too large %s') ]
+    bad = np.vstack([ c for (c, _) in checks ])
+    if bad.any():
+        k = np.flatnonzero(bad.any(axis=0))[0]
+        msg = [ msg for (c, msg) in checks if c[k] ][0]
+        raise FioHistoLogExc(msg % exception_suffix(record_nums[k]+1, logfn))
+
+    for d in (direction_read, direction_write):
+        rows = np.flatnonzero(directions == d)
+        if len(rows) > 0:
+            previous_ts[d] = times[rows[-1]]
+
+# records are parsed this many buckets at a time
+
+parse_block_buckets = 1 << 20
+
 # log file parser raises FioHistoLogExc exceptions
-# it returns histogram buckets in whatever unit fio uses
+# it reads the log a block of records at a time and yields
+# (times, directions, block sizes, buckets) numpy arrays for each block,
+# buckets being a records x buckets integer matrix in whatever unit fio uses
+# records are checked as they are read, see parse_hist_record()
+# inputs:
+#  logfn: pathname to histogram log file
+#  buckets_per_interval - how many histogram buckets to expect
+
+def read_hist_records(logfn, buckets_per_interval):
+    previous_ts = { direction_read: -1, direction_write: -1 }
+    last_record = (-1, -1)
+    block_records = max(1, parse_block_buckets // (buckets_per_interval + 3))
+    record_num = 0
+    with open(logfn, 'r') as f:
+        while True:
+            lines = list(itertools.islice(f, block_records))
+            if not lines:
+                break
+            records = [ (record_num + k, l.strip()) for (k, l) in enumerate(lines) ]
+            records = [ (k, r) for (k, r) in records if r != '' ]
+            record_num += len(lines)
+            if not records:
+                continue
+
+            # records numpy cannot parse as a whole are checked one by one
+            # to report the first error
+            try:
+                m = np.loadtxt([ r for (_, r) in records ], delimiter=',', dtype=np.int64, ndmin=2)
+            except (ValueError, OverflowError):
+                m = None
+            if m is None or m.shape[1] != buckets_per_interval + 3:
+                m = np.array([ parse_hist_record(r, k, logfn, buckets_per_interval, previous_ts)
+                               for (k, r) in records ], dtype=np.int64)
+            else:
+                check_hist_records(m, [ k for (k, _) in records ], logfn, previous_ts)
+
+            # hack to filter out records with the same timestamp
+            # we should not have to do this if fio logs histogram records correctly
+
+            last_times = np.concatenate(([last_record[0]], m[:-1,0]))
+            last_directions = np.concatenate(([last_record[1]], m[:-1,1]))
+            last_record = (m[-1,0], m[-1,1])
+            m = m[(m[:,0] != last_times) | (m[:,1] != last_directions)]
+            if len(m) > 0:
+                yield (m[:,0], m[:,1], m[:,2], m[:,3:])
+
+# estimate when the test started from the first records of a log
+
+def get_log_start_time(logfn, first_timestamp, second_timestamp, log_hist_msec):
+    if first_timestamp < 1000000:
+        return 0    # assume log_unix_epoch = 0
+    elif log_hist_msec != None:
+        return first_timestamp - log_hist_msec
+    elif second_timestamp != None:
+        return first_timestamp - (second_timestamp - first_timestamp)
+    else:
+        raise FioHistoLogExc('no way to estimate test start time')
+
+# convert histogram log file into a list of
+# (time_ms, direction, bsz, buckets) tuples, see read_hist_records()
 # inputs:
 #  logfn: pathname to histogram log file
 #  buckets_per_interval - how many histogram buckets to expect
 #  log_hist_msec - if not None, expected time interval between histogram records
 
 def parse_hist_file(logfn, buckets_per_interval, log_hist_msec):
-    previous_ts_ms_read = -1
-    previous_ts_ms_write = -1
- 
-    with open(logfn, 'r') as f:
-        records = [ l.strip() for l in f.readlines() ]
     intervals = []
-    last_time_ms = -1
-    last_direction = -1
-    for k, r in enumerate(records):
-        if r == '':
-            continue
-        tokens = r.split(',')
-        try:
-            int_tokens = [ int(t) for t in tokens ]
-        except ValueError as e:
-            raise FioHistoLogExc('non-integer value %s' % exception_suffix(k+1, logfn))
-
-        neg_ints = list([tk for tk in int_tokens if tk < 0])
-        if len(neg_ints) > 0:
-            raise FioHistoLogExc('negative integer value %s' % exception_suffix(k+1, logfn))
-
-        if len(int_tokens) < 3:
-            raise FioHistoLogExc('too few numbers %s' % exception_suffix(k+1, logfn))
-
-        direction = int_tokens[1]
-        if direction != direction_read and direction != direction_write:
-            raise FioHistoLogExc('invalid I/O direction %s' % exception_suffix(k+1, logfn))
-
-        time_ms = int_tokens[0]
-        if direction == direction_read:
-            if time_ms < previous_ts_ms_read:
-                raise FioHistoLogExc('read timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
-            previous_ts_ms_read = time_ms
-        elif direction == direction_write:
-            if time_ms < previous_ts_ms_write:
-                raise FioHistoLogExc('write timestamp in column 1 decreased %s' % exception_suffix(k+1, logfn))
-            previous_ts_ms_write = time_ms
-
-        bsz = int_tokens[2]
-        if bsz > (1 << 24):
-            raise FioHistoLogExc('block size too large %s' % exception_suffix(k+1, logfn))
-
-        buckets = int_tokens[3:]
-        if len(buckets) != buckets_per_interval:
-            raise FioHistoLogExc('%d buckets per interval but %d expected in %s' % 
-                    (len(buckets), buckets_per_interval, exception_suffix(k+1, logfn)))
-
-        # hack to filter out records with the same timestamp
-        # we should not have to do this if fio logs histogram records correctly
-
-        if time_ms == last_time_ms and direction == last_direction:
-            continue
-        last_time_ms = time_ms
-        last_direction = direction
-
-        intervals.append((time_ms, direction, bsz, buckets))
+    for (times, directions, bszs, buckets) in read_hist_records(logfn, buckets_per_interval):
+        intervals.extend(zip(times.tolist(), directions.tolist(), bszs.tolist(), buckets.tolist()))
     if len(intervals) == 0:
         raise FioHistoLogExc('no records in %s' % logfn)
     (first_timestamp, _, _, _) = intervals[0]
-    if first_timestamp < 1000000:
-        start_time = 0    # assume log_unix_epoch = 0
-    elif log_hist_msec != None:
-        start_time = first_timestamp - log_hist_msec
-    elif len(intervals) > 1:
-        (second_timestamp, _, _, _) = intervals[1]
-        start_time = first_timestamp - (second_timestamp - first_timestamp)
-    else:
-        raise FioHistoLogExc('no way to estimate test start time')
+    second_timestamp = intervals[1][0] if len(intervals) > 1 else None
+    start_time = get_log_start_time(logfn, first_timestamp, second_timestamp, log_hist_msec)
     (end_timestamp, _, _, _) = intervals[-1]
 
     return (intervals, start_time, end_timestamp)
 
+# return the (start time, end timestamp) of a log as parse_hist_file() does,
+# only looking at the first 2 columns so the whole log is not parsed twice
+# if they are not valid, the parser reports what is wrong with the log
+
+def get_hist_file_span(logfn, buckets_per_interval, log_hist_msec):
+    timestamps = []
+    last_record = None
+    try:
+        with open(logfn, 'r') as f:
+            for l in f:
+                tokens = l.split(',', 2)
+                if len(tokens) < 3:
+                    if l.strip() == '':
+                        continue
+                    raise ValueError(l)
+                record = (int(tokens[0]), int(tokens[1]))
+                if record == last_record:
+                    continue
+                last_record = record
+                if len(timestamps) < 2:
+                    timestamps.append(record[0])
+    except ValueError:
+        for _ in read_hist_records(logfn, buckets_per_interval):
+            pass
+        raise
+    if len(timestamps) == 0:
+        raise FioHistoLogExc('no records in %s' % logfn)
+    second_timestamp = timestamps[1] if len(timestamps) > 1 else None
+    start_time = get_log_start_time(logfn, timestamps[0], second_timestamp, log_hist_msec)
+    return (start_time, last_record[0])
+
 
 # compute time range for each bucket index in histogram record
 # see comments in https://github.com/axboe/fio/blob/master/stat.h
 # for description of bucket groups and buckets
 # fio v3 bucket ranges are in nanosec (since response times are measured in nanosec)
 # but we convert fio v3 nanosecs to floating-point microseconds
+# the bucket edges themselves come from fiohistbins, shared with fiologparser_hist.py
 
 def time_ranges(groups, counters_per_group, fio_version=3):
-    bucket_width = 1
-    bucket_base = 0
-    bucket_intervals = []
-    for g in range(0, groups):
-        for b in range(0, counters_per_group):
-            rmin = float(bucket_base)
-            rmax = rmin + bucket_width
-            if fio_version == 3:
-                rmin /= nsec_per_usec
-                rmax /= nsec_per_usec
-            bucket_intervals.append( [rmin, rmax] )
-            bucket_base += bucket_width
-        if g != 0:
-            bucket_width *= 2
-    return bucket_intervals
+    bucket_bits = counters_per_group.bit_length() - 1
+    divisor = nsec_per_usec if fio_version == 3 else 1
+    (lower, upper) = get_bin_edges(groups, bits=bucket_bits, divisor=divisor)
+    return [ [ float(rmin), float(rmax) ] for (rmin, rmax) in zip(lower, upper) ]
 
 
 # compute number of time quantum intervals in the test
@@ -189,82 +295,164 @@ def get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms):
 # so the contribution of this bucket to this time quantum is
 # 515 x 0.99 = 509.85
 
-def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp_ms, max_timestamp_ms):
+# the raw records are held as a (times, directions, buckets) tuple of numpy
+# arrays, buckets being a records x buckets integer matrix
+# the weights of the records in the quanta make up a sparse
+# quanta x records matrix, kept as (quantum, record, weight) triplets
+# sorted by quantum, so the aligned histograms are its product with buckets
+
+def histo_log_matrix(raw_histogram_log):
+    times = np.array([ r[0] for r in raw_histogram_log ], dtype=np.int64)
+    directions = np.array([ r[1] for r in raw_histogram_log ], dtype=np.int64)
+    buckets = np.array([ r[3] for r in raw_histogram_log ], dtype=np.int64)
+    return (times, directions, buckets)
+
+# find next record with same direction to get end-time
+# for fio randrw workload,
+# we have read and write records on same time interval
+# sometimes read and write records are in opposite order
+# assertion checks that next read/write record
+# can be separated by at most 2 other records
+# records with no such record after them end at end_time_ms
+
+def record_end_times(times, directions, end_time_ms):
+    n = len(times)
+    time_msec_end = np.full(n, end_time_ms, dtype=np.int64)
+    found = np.zeros(n, dtype=bool)
+    for k in range(1, 4):
+        if n <= k:
+            break
+        same = (directions[k:] == directions[:-k]) & ~found[:-k]
+        time_msec_end[:-k][same] = times[k:][same]
+        found[:-k] |= same
+    assert found[:max(n - 3, 0)].all()
+    return time_msec_end
 
-    # slice up test time int intervals of time_quantum seconds
+# compute the (quantum, record, weight) triplets of the quanta
+# overlapping each record's time interval
+# quanta before min_timestamp_ms or past the end of the test are left out
 
+def record_quantum_weights(times, directions, time_quantum, min_timestamp_ms, max_timestamp_ms):
     (end_time, time_interval_count) = get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms)
     time_qtm_ms = time_quantum * msec_per_sec
-    end_time_ms = end_time * msec_per_sec
-    aligned_intervals = []
-    for j in range(0, time_interval_count):
-        aligned_intervals.append((
-            min_timestamp_ms + (j * time_qtm_ms),
-            [ 0.0 for j in range(0, bucket_count) ] ))
-
-    log_record_count = len(raw_histogram_log)
-    for k, record in enumerate(raw_histogram_log):
-
-        # find next record with same direction to get end-time
-        # have to avoid going past end of array
-        # for fio randrw workload, 
-        # we have read and write records on same time interval
-        # sometimes read and write records are in opposite order
-        # assertion checks that next read/write record 
-        # can be separated by at most 2 other records
-
-        (time_msec, direction, sz, interval_buckets) = record
-        if k+1 < log_record_count:
-            (time_msec_end, direction2, _, _) = raw_histogram_log[k+1]
-            if direction2 != direction:
-                if k+2 < log_record_count:
-                    (time_msec_end, direction2, _, _) = raw_histogram_log[k+2]
-                    if direction2 != direction:
-                        if k+3 < log_record_count:
-                            (time_msec_end, direction2, _, _) = raw_histogram_log[k+3]
-                            assert direction2 == direction
-                        else:
-                            time_msec_end = end_time_ms
-                else:
-                    time_msec_end = end_time_ms
-        else:
-            time_msec_end = end_time_ms
-
-        # calculate first quantum that overlaps this histogram record 
-
-        offset_from_min_ts = time_msec - min_timestamp_ms
-        qtm_start_ms = min_timestamp_ms + (offset_from_min_ts // time_qtm_ms) * time_qtm_ms
-        qtm_end_ms = min_timestamp_ms + ((offset_from_min_ts + time_qtm_ms) // time_qtm_ms) * time_qtm_ms
-        qtm_index = offset_from_min_ts // time_qtm_ms
-
-        # for each quantum that overlaps this histogram record's time interval
-
-        while qtm_start_ms < time_msec_end:  # while quantum overlaps record
-
-            # some histogram logs may be longer than others
-
-            if len(aligned_intervals) <= qtm_index:
-                break
-
-            # calculate fraction of time that this quantum 
-            # overlaps histogram record's time interval
-            
-            overlap_start = max(qtm_start_ms, time_msec)
-            overlap_end = min(qtm_end_ms, time_msec_end)
-            weight = float(overlap_end - overlap_start)
-            weight /= (time_msec_end - time_msec)
-            (_,aligned_histogram) = aligned_intervals[qtm_index]
-            for bx, b in enumerate(interval_buckets):
-                weighted_bucket = weight * b
-                aligned_histogram[bx] += weighted_bucket
+    time_msec_end = record_end_times(times, directions, end_time * msec_per_sec)
+
+    # first and last quantum that overlaps each histogram record
+
+    first_qtm = (times - min_timestamp_ms) // time_qtm_ms
+    last_qtm = (time_msec_end - min_timestamp_ms - 1) // time_qtm_ms
+    qtm_count = np.maximum(last_qtm - first_qtm + 1, 0)
+
+    record = np.repeat(np.arange(len(times)), qtm_count)
+    first_of_record = np.repeat(np.cumsum(qtm_count) - qtm_count, qtm_count)
+    qtm_index = first_qtm[record] + (np.arange(len(record)) - first_of_record)
+    keep = (qtm_index >= 0) & (qtm_index < time_interval_count)
+    record, qtm_index = record[keep], qtm_index[keep]
+
+    # fraction of time that the quantum
+    # overlaps histogram record's time interval
+
+    qtm_start_ms = min_timestamp_ms + qtm_index * time_qtm_ms
+    overlap_start = np.maximum(qtm_start_ms, times[record])
+    overlap_end = np.minimum(qtm_start_ms + time_qtm_ms, time_msec_end[record])
+    weight = (overlap_end - overlap_start) / (time_msec_end[record] - times[record]).astype(float)
+
+    order = np.argsort(qtm_index, kind='stable')
+    return (qtm_index[order], record[order], weight[order])
+
+# rows x buckets of the weighted buckets are summed at a time
+# to bound the memory used
+
+align_block_buckets = 1 << 20
+
+# multiply the sparse quanta x records weight matrix by the records x buckets
+# matrix and add the result to aligned:
+# the weighted records of each quantum are added up with reduceat
+
+def weighted_sum(qtm_index, record, weight, buckets, aligned):
+    step = max(1, align_block_buckets // max(1, buckets.shape[1]))
+    for i in range(0, len(qtm_index), step):
+        q = qtm_index[i:i+step]
+        weighted = buckets[record[i:i+step]] * weight[i:i+step, np.newaxis]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(q)) + 1))
+        aligned[q[starts]] += np.add.reduceat(weighted, starts, axis=0)
+
+# align a histogram log as it is read and add it to aligned, 
+# its quanta x buckets histograms
+# the end time of a record comes from up to 3 records after it,
+# so the last 3 records of each block are aligned with the next one
+
+def align_hist_file(logfn, buckets_per_interval, time_quantum, min_timestamp_ms, max_timestamp_ms,
+                    aligned):
+    held = None
+    for (times, directions, _, buckets) in read_hist_records(logfn, buckets_per_interval):
+        if held is not None:
+            (times, directions, buckets) = [ np.concatenate((h, r)) for (h, r) in 
+                                             zip(held, (times, directions, buckets)) ]
+        done = max(len(times) - 3, 0)
+        (qtm_index, record, weight) = record_quantum_weights(
+                times, directions, time_quantum, min_timestamp_ms, max_timestamp_ms)
+        keep = record < done
+        weighted_sum(qtm_index[keep], record[keep], weight[keep], buckets, aligned)
+        held = (times[done:], directions[done:], buckets[done:])
+    if held is not None:
+        (times, directions, buckets) = held
+        (qtm_index, record, weight) = record_quantum_weights(
+                times, directions, time_quantum, min_timestamp_ms, max_timestamp_ms)
+        weighted_sum(qtm_index, record, weight, buckets, aligned)
+
+# align a histogram log into histograms of its own and return them
+# task is a tuple so that the pool can run it
+
+def align_hist_task(task):
+    (logfn, buckets_per_interval, time_quantum, min_timestamp_ms, max_timestamp_ms) = task
+    (_, time_interval_count) = get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms)
+    aligned = np.zeros((time_interval_count, buckets_per_interval))
+    align_hist_file(logfn, buckets_per_interval, time_quantum,
+                    min_timestamp_ms, max_timestamp_ms, aligned)
+    return aligned
+
+# align histogram logs and return the sum of their
+# quanta x buckets histograms, see align_hist_file()
+# each log is aligned on its own and the histograms of the logs are added
+# up in the order they are listed, so that the sums come out the same
+# whatever the number of processes
+# with jobs > 1, a pool of that many processes aligns the logs,
+# their histograms are added up as they come back in order
+
+def align_hist_files(logfns, buckets_per_interval, time_quantum, min_timestamp_ms, max_timestamp_ms,
+                     jobs=1):
+    (_, time_interval_count) = get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms)
+    aligned = np.zeros((time_interval_count, buckets_per_interval))
+    tasks = [ (logfn, buckets_per_interval, time_quantum, min_timestamp_ms, max_timestamp_ms)
+              for logfn in logfns ]
+    jobs = max(1, min(jobs, len(logfns)))
+    if jobs == 1:
+        for task in tasks:
+            aligned += align_hist_task(task)
+        return aligned
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for histograms in pool.imap(align_hist_task, tasks):
+            aligned += histograms
+    finally:
+        pool.terminate()
+    return aligned
 
-            # advance to the next time quantum
+def align_histo_log(raw_histogram_log, time_quantum, bucket_count, min_timestamp_ms, max_timestamp_ms):
 
-            qtm_start_ms += time_qtm_ms
-            qtm_end_ms += time_qtm_ms
-            qtm_index += 1
+    # slice up test time int intervals of time_quantum seconds
 
-    return aligned_intervals
+    (end_time, time_interval_count) = get_time_intervals(time_quantum, min_timestamp_ms, max_timestamp_ms)
+    time_qtm_ms = time_quantum * msec_per_sec
+    (times, directions, buckets) = histo_log_matrix(raw_histogram_log)
+    (qtm_index, record, weight) = record_quantum_weights(
+            times, directions, time_quantum, min_timestamp_ms, max_timestamp_ms)
+    aligned = np.zeros((time_interval_count, bucket_count))
+    weighted_sum(qtm_index, record, weight, buckets.reshape((len(times), bucket_count)), aligned)
+    return [ (min_timestamp_ms + (j * time_qtm_ms), aligned[j].tolist())
+             for j in range(0, time_interval_count) ]
 
 # add histogram in "source" to histogram in "target"
 # it is assumed that the 2 histograms are precisely time-aligned
@@ -288,71 +476,169 @@ def get_samples(buckets):
 # returns None if no I/O reported.
 # otherwise we would be dividing by zero
 # think of buckets as probability distribution function
-# and this loop is integrating to get cumulative distribution function
+# and the cumulative sum is the cumulative distribution function
+# see get_pctiles_batch()
 
 def get_pctiles(buckets, wanted, time_ranges):
-
-    # get total of IO requests done
-    total_ios = 0
-    for io_count in buckets:
-        total_ios += io_count
-
-    # don't return percentiles if no I/O was done during interval
-    if total_ios == 0.0:
+    (_, pctiles) = get_pctiles_batch(np.asarray(buckets, dtype=float)[np.newaxis], wanted, time_ranges)
+    if np.isnan(pctiles[0]).all():
         return None
+    return dict(zip(wanted, pctiles[0].tolist()))
+
+# no one is interested in percentiles bigger than this but not 100.0
+# this prevents floating-point error from missing the max latency
+
+almost_100 = 99.9999
+
+# quanta x buckets of the histograms are looked at a time
+# to bound the memory used
+
+pctile_block_buckets = 1 << 20
+
+# compute percentiles of a quanta x buckets matrix of histograms at once
+# returns (samples, pctiles) where samples is the total of each histogram
+# and pctiles is a quanta x wanted matrix, NaN for quanta without I/O
+# the percentile is in the first non-empty bucket b where 
+# the cumulative percentile pct goes past it (for the 100-percentile, 
+# max latency case, no bucket exceeds it so reaches almost_100), 
+# and interpolated between the min and max time of the bucket 
+# according to where it falls between pct and last_pct, the percentile
+# corresponding to all I/O requests up to, but not including, bucket b
+# a percentile is never in a bucket before the one of the percentile
+# wanted before it
+
+def get_pctiles_batch(histograms, wanted, time_ranges):
+    ranges = np.asarray(time_ranges, dtype=float)
+    (range_min_time, range_max_time) = (ranges[:,0], ranges[:,1])
+    (quanta, bucket_count) = histograms.shape
+    samples = np.zeros(quanta)
+    pctiles = np.full((quanta, len(wanted)), np.nan)
+
+    step = max(1, pctile_block_buckets // max(1, bucket_count))
+    for i in range(0, quanta, step):
+        h = histograms[i:i+step]
+        total_so_far = np.cumsum(h, axis=1)
+        total_ios = total_so_far[:, -1]
+        samples[i:i+step] = total_ios
+        # don't return percentiles if no I/O was done during interval
+        io = total_ios != 0.0
+        if not io.any():
+            continue
+        (h, total_so_far, total_ios) = (h[io], total_so_far[io], total_ios[io])
+        pct = 100.0 * total_so_far / total_ios[:, np.newaxis]
+        # the cumulative sum does not change over empty buckets, so the
+        # percentile before bucket b is the one of bucket b - 1
+        last_pct = np.concatenate((np.zeros((len(h), 1)), pct[:, :-1]), axis=1)
+        nonzero = h != 0
+
+        rows = np.arange(len(h))
+        b = np.zeros(len(h), dtype=np.int64)
+        result = np.empty((len(h), len(wanted)))
+        for j, next_pctile in enumerate(wanted):
+            if next_pctile == 100.0:
+                reached = nonzero & (pct >= almost_100)
+            else:
+                reached = nonzero & (pct > next_pctile)
+            assert reached.any(axis=1).all()
+            b = np.maximum(b, np.argmax(reached, axis=1))
+            offset_frac = (next_pctile - last_pct[rows, b])/(pct[rows, b] - last_pct[rows, b])
+            result[:, j] = range_min_time[b] + (offset_frac*(range_max_time[b] - range_min_time[b]))
+        pctiles[np.flatnonzero(io) + i] = result
+    return (samples, pctiles)
+
+
+# output sinks
+# each writes the percentiles of every time quantum to an open file:
+#   t_msec: msec since start of each quantum
+#   samples: total I/O requests in each quantum
+#   pctiles: quanta x percentiles matrix, in increasing percentile order,
+#            NaN for quanta without I/O
+#   names: name of each percentile column, see pctile_name()
+#   wanted: percentiles in the order they were asked for
+# rows are formatted and written a block at a time
+
+sink_block_rows = 4096
+
+# percentiles other than min, median and max are named after their exact
+# value so that, say, 99.99 and 99.999 get columns of their own, the
+# legacy text header keeps rounding them to one decimal
+
+def pctile_name(p, legacy=False):
+    if p == 0.:
+        return 'min'
+    elif p == 100.:
+        return 'max'
+    elif p == 50.:
+        return 'median'
+    elif legacy:
+        return '%3.1f' % p
+    else:
+        return repr(float(p))
 
-    pctile_count = len(wanted)
-
-    # results returned as dictionary keyed by percentile
-    pctile_result = {}
-
-    # index of next percentile in list
-    pctile_index = 0
-
-    # next percentile
-    next_pctile = wanted[pctile_index]
+# write blocks of lines to f, line(t) returning the line of quantum t
 
-    # no one is interested in percentiles bigger than this but not 100.0
-    # this prevents floating-point error from preventing loop exit
-    almost_100 = 99.9999
+def write_lines(f, count, line):
+    for i in range(0, count, sink_block_rows):
+        f.write(''.join([ line(t) for t in range(i, min(i + sink_block_rows, count)) ]))
 
-    # pct is the percentile corresponding to 
-    # all I/O requests up through bucket b
-    pct = 0.0
-    total_so_far = 0
-    for b, io_count in enumerate(buckets):
-        if io_count == 0:
-            continue
-        total_so_far += io_count
-        # last_pct_lt is the percentile corresponding to 
-        # all I/O requests up to, but not including, bucket b
-        last_pct = pct
-        pct = 100.0 * float(total_so_far) / total_ios
-        # a single bucket could satisfy multiple pctiles
-        # so this must be a while loop
-        # for 100-percentile (max latency) case, no bucket exceeds it 
-        # so we must stop there.
-        while ((next_pctile == 100.0 and pct >= almost_100) or
-               (next_pctile < 100.0  and pct > next_pctile)):
-            # interpolate between min and max time for bucket time interval
-            # we keep the time_ranges access inside this loop, 
-            # even though it could be above the loop,
-            # because in many cases we will not be even entering 
-            # the loop so we optimize out these accesses
-            range_max_time = time_ranges[b][1]
-            range_min_time = time_ranges[b][0]
-            offset_frac = (next_pctile - last_pct)/(pct - last_pct)
-            interpolation = range_min_time + (offset_frac*(range_max_time - range_min_time))
-            pctile_result[next_pctile] = interpolation
-            pctile_index += 1
-            if pctile_index == pctile_count:
-                break
-            next_pctile = wanted[pctile_index]
-        if pctile_index == pctile_count:
-            break
-    assert pctile_index == pctile_count
-    return pctile_result
+# the CSV printed by the first versions of this tool,
+# header columns are in the order the percentiles were wanted
 
+def write_text_sink(f, t_msec, samples, pctiles, names, wanted, output_unit):
+    header = 'msec-since-start, samples, '
+    for p in wanted:
+        header += '%s, ' % pctile_name(p, legacy=True)
+    f.write('time (millisec), percentiles in increasing order with values in ' + output_unit + '\n')
+    f.write(header + '\n')
+
+    empty = ', ' * len(wanted)
+    values = pctiles.tolist()
+    def line(t):
+        record = '%8d, %8d, ' % (t_msec[t], samples[t])
+        if np.isnan(pctiles[t]).all():
+            return record + empty + '\n'
+        return record + ', '.join([ str(v) for v in values[t] ]) + '\n'
+    write_lines(f, len(t_msec), line)
+
+# plain CSV: a header and a line per quantum, percentiles empty without I/O
+
+def write_csv_sink(f, t_msec, samples, pctiles, names, wanted, output_unit):
+    f.write(','.join([ 'msec-since-start', 'samples' ] + names) + '\n')
+    values = [ [ '' if math.isnan(v) else repr(v) for v in row ] for row in pctiles.tolist() ]
+    def line(t):
+        return '%d,%r,%s\n' % (t_msec[t], float(samples[t]), ','.join(values[t]))
+    write_lines(f, len(t_msec), line)
+
+# JSON Lines: an object per quantum, percentiles null without I/O
+
+def write_json_sink(f, t_msec, samples, pctiles, names, wanted, output_unit):
+    keys = [ json.dumps(n) for n in names ]
+    values = [ [ 'null' if math.isnan(v) else repr(v) for v in row ] for row in pctiles.tolist() ]
+    def line(t):
+        fields = [ '"msec-since-start": %d' % t_msec[t], '"samples": %r' % float(samples[t]) ]
+        fields.extend([ '%s: %s' % kv for kv in zip(keys, values[t]) ])
+        return '{' + ', '.join(fields) + '}\n'
+    write_lines(f, len(t_msec), line)
+
+# a NumPy .npy file holding a structured array with a record per quantum:
+# msec-since-start (int64), samples and the percentiles (float64, NaN without I/O)
+
+def write_npy_sink(f, t_msec, samples, pctiles, names, wanted, output_unit):
+    dtype = [ ('msec-since-start', '<i8'), ('samples', '<f8') ] + [ (n, '<f8') for n in names ]
+    out = np.empty(len(t_msec), dtype=dtype)
+    out['msec-since-start'] = t_msec
+    out['samples'] = samples
+    for j, n in enumerate(names):
+        out[n] = pctiles[:, j]
+    np.save(f, out)
+
+# output format -> (sink, whether it writes bytes)
+
+output_sinks = {
+    'text': (write_text_sink, False),
+    'csv': (write_csv_sink, False),
+    'json': (write_json_sink, False),
+    'npy': (write_npy_sink, True) }
 
 # this is really the main program
 
@@ -375,9 +661,19 @@ def compute_percentiles_from_logs():
     parser.add_argument("--log-hist-msec", dest="log_hist_msec", 
         type=int, default=None,
         help="log_hist_msec value in fio job file")
+    parser.add_argument("-j", "--jobs", dest="jobs",
+        default=1, type=int,
+        help="number of processes parsing and aligning logs in parallel (default=1)")
     parser.add_argument("--output-unit", dest="output_unit", 
         default="usec", type=str,
         help="Latency percentile output unit: msec|usec|nsec (default usec)")
+    parser.add_argument("--output-format", dest="output_format",
+        default="text", choices=sorted(output_sinks.keys()),
+        help="text (default) prints the parameters then CSV, "
+             "csv is plain CSV, json is JSON Lines, npy is a NumPy structured array")
+    parser.add_argument("--output", dest="output",
+        default="-", type=str,
+        help="file the percentiles are written to (default - is stdout)")
     parser.add_argument("file_list", nargs='+', 
         help='list of files, preceded by " -- " if necessary')
     args = parser.parse_args()
@@ -386,38 +682,37 @@ def compute_percentiles_from_logs():
     if args.fio_version == 2:
         args.bucket_groups = 19
 
-    # print parameters
+    # print parameters, only along with the text output
 
-    print('fio version = %d' % args.fio_version)
-    print('bucket groups = %d' % args.bucket_groups)
-    print('bucket bits = %d' % args.bucket_bits)
-    print('time quantum = %d sec' % args.time_quantum)
-    print('percentiles = %s' % ','.join([ str(p) for p in args.pctiles_wanted ]))
+    def info(msg):
+        if args.output_format == 'text':
+            print(msg)
+
+    info('fio version = %d' % args.fio_version)
+    info('bucket groups = %d' % args.bucket_groups)
+    info('bucket bits = %d' % args.bucket_bits)
+    info('time quantum = %d sec' % args.time_quantum)
+    info('percentiles = %s' % ','.join([ str(p) for p in args.pctiles_wanted ]))
     buckets_per_group = 1 << args.bucket_bits
-    print('buckets per group = %d' % buckets_per_group)
+    info('buckets per group = %d' % buckets_per_group)
     buckets_per_interval = buckets_per_group * args.bucket_groups
-    print('buckets per interval = %d ' % buckets_per_interval)
-    bucket_index_range = range(0, buckets_per_interval)
+    info('buckets per interval = %d ' % buckets_per_interval)
     if args.log_hist_msec != None:
-        print('log_hist_msec = %d' % args.log_hist_msec)
+        info('log_hist_msec = %d' % args.log_hist_msec)
     if args.time_quantum == 0:
         print('ERROR: time-quantum must be a positive number of seconds')
-    print('output unit = ' + args.output_unit)
+    info('output unit = ' + args.output_unit)
     if args.output_unit == 'msec':
         time_divisor = float(msec_per_sec)
     elif args.output_unit == 'usec':
         time_divisor = 1.0
 
-    # construct template for each histogram bucket array with buckets all zeroes
-    # we just copy this for each new histogram
-
-    zeroed_buckets = [ 0.0 for r in bucket_index_range ]
-
     # calculate response time interval associated with each histogram bucket
 
     bucket_times = time_ranges(args.bucket_groups, buckets_per_group, fio_version=args.fio_version)
 
-    # parse the histogram logs
+    # find when each histogram log starts and ends, 
+    # they are parsed when they are aligned below
     # assumption: each bucket has a monotonically increasing time
     # assumption: time ranges do not overlap for a single thread's records
     # (exception: if randrw workload, then there is a read and a write 
@@ -425,10 +720,13 @@ def compute_percentiles_from_logs():
 
     test_start_time = 0
     test_end_time = 1.0e18
-    hist_files = {}
+    hist_files = []
     for fn in args.file_list:
+        if fn in hist_files:
+            continue
+        hist_files.append(fn)
         try:
-            (hist_files[fn], log_start_time, log_end_time)  = parse_hist_file(fn, buckets_per_interval, args.log_hist_msec)
+            (log_start_time, log_end_time) = get_hist_file_span(fn, buckets_per_interval, args.log_hist_msec)
         except FioHistoLogExc as e:
             myabort(str(e))
         # we consider the test started when all threads have started logging
@@ -439,55 +737,41 @@ def compute_percentiles_from_logs():
     if test_start_time >= test_end_time:
         raise FioHistoLogExc('no time interval when all threads logs overlapped')
     if test_start_time > 0:
-        print('all threads running as of unix epoch time %d = %s' % (
+        info('all threads running as of unix epoch time %d = %s' % (
                test_start_time/float(msec_per_sec), 
                time.ctime(test_start_time/1000.0)))
 
     (end_time, time_interval_count) = get_time_intervals(args.time_quantum, test_start_time, test_end_time)
-    all_threads_histograms = [ ((j*args.time_quantum*msec_per_sec), deepcopy(zeroed_buckets))
-                               for j in range(0, time_interval_count) ]
-
-    for logfn in hist_files.keys():
-        aligned_per_thread = align_histo_log(hist_files[logfn], 
-                                             args.time_quantum, 
-                                             buckets_per_interval, 
-                                             test_start_time,
-                                             test_end_time)
-        for t in range(0, time_interval_count):
-            (_, all_threads_histo_t) = all_threads_histograms[t]
-            (_, log_histo_t) = aligned_per_thread[t]
-            add_to_histo_from( all_threads_histo_t, log_histo_t )
 
-    # calculate percentiles across aggregate histogram for all threads
-    # print CSV header just like fiologparser_hist does
+    # align each log as it is parsed and add it to the histograms of all
+    # threads, only a block of its records is held at a time
+    # with --jobs, that many processes align the logs, see align_hist_files()
 
-    header = 'msec-since-start, samples, '
-    for p in args.pctiles_wanted:
-        if p == 0.:
-            next_pctile_header = 'min'
-        elif p == 100.:
-            next_pctile_header = 'max'
-        elif p == 50.:
-            next_pctile_header = 'median'
-        else:
-            next_pctile_header = '%3.1f' % p
-        header += '%s, ' % next_pctile_header
-
-    print('time (millisec), percentiles in increasing order with values in ' + args.output_unit)
-    print(header)
-
-    for (t_msec, all_threads_histo_t) in all_threads_histograms:
-        samples = get_samples(all_threads_histo_t)
-        record = '%8d, %8d, ' % (t_msec, samples)
-        pct = get_pctiles(all_threads_histo_t, args.pctiles_wanted, bucket_times)
-        if not pct:
-            for w in args.pctiles_wanted:
-                record += ', '
-        else:
-            pct_keys = [ k for k in pct.keys() ]
-            pct_values = [ str(pct[wanted]/time_divisor) for wanted in sorted(pct_keys) ]
-            record += ', '.join(pct_values)
-        print(record)
+    try:
+        aligned = align_hist_files(hist_files, buckets_per_interval, args.time_quantum,
+                                   test_start_time, test_end_time, args.jobs)
+    except FioHistoLogExc as e:
+        myabort(str(e))
+
+    # calculate percentiles across aggregate histogram for all threads
+    # and write them out in increasing order, a percentile wanted twice once
+
+    (samples, pctiles) = get_pctiles_batch(aligned, args.pctiles_wanted, bucket_times)
+    pct_columns = [ max([ j for (j, w) in enumerate(args.pctiles_wanted) if w == wanted ])
+                    for wanted in sorted(set(args.pctiles_wanted)) ]
+    pctiles = pctiles[:, pct_columns] / time_divisor
+    names = [ pctile_name(args.pctiles_wanted[j]) for j in pct_columns ]
+    t_msec = np.arange(time_interval_count) * (args.time_quantum * msec_per_sec)
+
+    (sink, binary) = output_sinks[args.output_format]
+    if args.output == '-':
+        sys.stdout.flush()
+        f = getattr(sys.stdout, 'buffer', sys.stdout) if binary else sys.stdout
+        sink(f, t_msec, samples, pctiles, names, args.pctiles_wanted, args.output_unit)
+        f.flush()
+    else:
+        with open(args.output, 'wb' if binary else 'w') as f:
+            sink(f, t_msec, samples, pctiles, names, args.pctiles_wanted, args.output_unit)
 
 
 
@@ -624,6 +908,56 @@ if unittest2_imported:
         except FioHistoLogExc as e:
             self.A(str(e).__contains__('buckets per interval'))
 
+    # a log read a few records at a time, with blank lines and repeated
+    # records across blocks, gives the records of a log read line by line
+
+    def test_b10_parse_blocks(self):
+        global parse_block_buckets
+        rng = np.random.RandomState(10)
+        lines = []
+        t = 0
+        for k in range(100):
+            t += rng.randint(500, 1500)
+            line = '%d, %d, 4096, %s' % (t, k % 2, ', '.join([ str(b) for b in rng.randint(0, 100, size=4) ]))
+            lines.append(line)
+            if k % 7 == 0:
+                lines.append(line)
+            if k % 11 == 0:
+                lines.append('')
+        with open(self.fn, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        previous_ts = { direction_read: -1, direction_write: -1 }
+        expected = []
+        for (k, l) in enumerate(lines):
+            if l == '':
+                continue
+            r = parse_hist_record(l, k, self.fn, 4, previous_ts)
+            if expected and expected[-1][:2] == tuple(r[:2]):
+                continue
+            expected.append((r[0], r[1], r[2], r[3:]))
+        whole = parse_hist_file(self.fn, 4, None)
+        self.A(whole[0] == expected)
+        saved = parse_block_buckets
+        try:
+            for parse_block_buckets in [ 1, 7 * 5, 20 * 7 ]:
+                self.A(parse_hist_file(self.fn, 4, None) == whole)
+                self.A(get_hist_file_span(self.fn, 4, None) == whole[1:])
+                # the weighted records of a quantum are added up block by block
+                aligned = align_histo_log(whole[0], 1, 4, whole[1], whole[2])
+                self.A(np.allclose(align_hist_files([ self.fn ], 4, 1, whole[1], whole[2]),
+                                   [ h for (_, h) in aligned ], rtol=1e-12, atol=0))
+            # an invalid record past the first block is reported at its line
+            with open(self.fn, 'a') as f:
+                f.write('1, 0, 4096, 1, 2, 3, 4\n')
+            try:
+                parse_hist_file(self.fn, 4, None)
+                self.A(False)
+            except FioHistoLogExc as e:
+                self.A(str(e) == 'read timestamp in column 1 decreased %s' %
+                       exception_suffix(len(lines) + 1, self.fn))
+        finally:
+            parse_block_buckets = saved
+
     def test_c1_time_ranges(self):
         ranges = time_ranges(3, 2)  # fio_version defaults to 3
         expected_ranges = [ # fio_version 3 is in nanoseconds
@@ -724,6 +1058,23 @@ if unittest2_imported:
         self.A(time_ms1 == 0    and self.is_close(h1, expect1))
         self.A(time_ms2 == 5000 and self.is_close(h2, expect2))
 
+    # randrw records: the end of a record is the next one with the same direction,
+    # even when reads and writes are logged in opposite order
+
+    def test_d3_align_randrw_histo_log(self):
+        with open(self.fn, 'w') as f:
+            f.write('1000, 0, 4096, 1, 0, 0, 0\n')
+            f.write('1000, 1, 4096, 0, 2, 0, 0\n')
+            f.write('2000, 1, 4096, 0, 0, 3, 0\n')
+            f.write('2000, 0, 4096, 0, 0, 0, 4\n')
+            f.write('3000, 0, 4096, 5, 0, 0, 0\n')
+            f.write('3000, 1, 4096, 0, 6, 0, 0\n')
+        (raw_histo_log, min_timestamp_ms, max_timestamp_ms) = parse_hist_file(self.fn, 4, None)
+        aligned_log = align_histo_log(raw_histo_log, 1, 4, min_timestamp_ms, max_timestamp_ms)
+        self.A(len(aligned_log) == 4)
+        self.A([ h for (_, h) in aligned_log ] == [
+                [0., 0., 0., 0.], [1., 2., 0., 0.], [0., 0., 3., 4.], [5., 6., 0., 0.]])
+
     # what to expect if histogram buckets are all equal
     def test_e1_get_pctiles_flat_histo(self):
         with open(self.fn, 'w') as f:
@@ -762,6 +1113,141 @@ if unittest2_imported:
         pct = get_pctiles( histo, [ 100.0 ], time_intervals )
         self.A(pct == expected_pctiles)
 
+    # percentiles of a histogram the way they were computed before
+    # get_pctiles_batch(), a bucket at a time
+
+    def loop_pctiles(self, buckets, wanted, time_ranges):
+        total_ios = sum(buckets)
+        if total_ios == 0.0:
+            return None
+        result = {}
+        j = 0
+        pct = 0.0
+        total_so_far = 0
+        for b, io_count in enumerate(buckets):
+            if io_count == 0:
+                continue
+            total_so_far += io_count
+            last_pct = pct
+            pct = 100.0 * float(total_so_far) / total_ios
+            while j < len(wanted) and ((wanted[j] == 100.0 and pct >= almost_100) or
+                                       (wanted[j] < 100.0 and pct > wanted[j])):
+                offset_frac = (wanted[j] - last_pct)/(pct - last_pct)
+                (range_min_time, range_max_time) = time_ranges[b]
+                result[wanted[j]] = range_min_time + (offset_frac*(range_max_time - range_min_time))
+                j += 1
+            if j == len(wanted):
+                break
+        assert j == len(wanted)
+        return result
+
+    # all quanta at once, a few at a time, give the percentiles of each one,
+    # including quanta without I/O, sparse ones and a single I/O request
+
+    def test_e3_get_pctiles_batch(self):
+        global pctile_block_buckets
+        rng = np.random.RandomState(3)
+        histograms = rng.randint(0, 50, size=(40, 128)).astype(float)
+        histograms[rng.rand(40, 128) < 0.8] = 0.
+        histograms[5] = 0.
+        histograms[6] = 0.
+        histograms[6, 100] = 1.
+        histograms[7] *= 0.37
+        wanted = [ 0., 1., 50., 90., 99., 99.99, 99.9999, 100. ]
+        ranges = time_ranges(4, 32)
+        expected = [ self.loop_pctiles(h.tolist(), wanted, ranges) for h in histograms ]
+        saved = pctile_block_buckets
+        try:
+            for pctile_block_buckets in [ 1 << 20, 128, 128 * 3 ]:
+                (samples, pctiles) = get_pctiles_batch(histograms, wanted, ranges)
+                self.A(samples.tolist() == histograms.sum(axis=1).tolist())
+                for (q, e) in enumerate(expected):
+                    if e is None:
+                        self.A(np.isnan(pctiles[q]).all())
+                    else:
+                        self.A(np.allclose(pctiles[q], [ e[w] for w in wanted ], rtol=1e-12, atol=0))
+        finally:
+            pctile_block_buckets = saved
+        for (h, e) in zip(histograms, expected):
+            p = get_pctiles(h.tolist(), wanted, ranges)
+            self.A(p is None if e is None else np.allclose([ p[w] for w in wanted ], [ e[w] for w in wanted ],
+                                                           rtol=1e-12, atol=0))
+
+    # logs aligned by a pool of processes add up to the same histograms
+
+    def test_d4_align_hist_files_jobs(self):
+        rng = np.random.RandomState(4)
+        logfns = []
+        for j in range(5):
+            logfn = '%s.%d' % (self.fn, j)
+            with open(logfn, 'w') as f:
+                t = 0
+                for k in range(300):
+                    t += rng.randint(500, 1500)
+                    buckets = rng.randint(0, 100, size=16)
+                    f.write('%d, %d, 4096, %s\n' % (t, k % 2, ', '.join([ str(b) for b in buckets ])))
+            logfns.append(logfn)
+        serial = align_hist_files(logfns, 16, 1, 1000, 150000)
+        self.A(serial.shape == (150, 16) and (serial.sum(axis=1) > 0).all())
+        for jobs in [ 2, 3, 8 ]:
+            parallel = align_hist_files(logfns, 16, 1, 1000, 150000, jobs)
+            self.A(np.array_equal(parallel, serial))
+
+    # percentiles of 3 quanta of 4 buckets, the second one without I/O,
+    # written by an output sink and read back from self.fn
+
+    sink_wanted = [ 0., 50., 99.99, 99.999, 100. ]
+
+    def write_sink(self, output_format):
+        histograms = np.array([ [ 1., 2., 3., 4. ], [ 0., 0., 0., 0. ], [ 0., 5., 0., 1. ] ])
+        (samples, pctiles) = get_pctiles_batch(histograms, self.sink_wanted, time_ranges(1, 4))
+        names = [ pctile_name(p) for p in self.sink_wanted ]
+        t_msec = np.arange(3) * msec_per_sec
+        (sink, binary) = output_sinks[output_format]
+        with open(self.fn, 'wb' if binary else 'w') as f:
+            sink(f, t_msec, samples, pctiles, names, self.sink_wanted, 'usec')
+        return (t_msec, samples, pctiles, names)
+
+    def test_f1_pctile_names(self):
+        self.A([ pctile_name(p) for p in self.sink_wanted ] ==
+               [ 'min', 'median', '99.99', '99.999', 'max' ])
+        self.A(pctile_name(99.99, legacy=True) == '100.0')
+
+    def test_f2_csv_sink(self):
+        (t_msec, samples, pctiles, names) = self.write_sink('csv')
+        with open(self.fn) as f:
+            lines = f.read().splitlines()
+        self.A(lines[0].split(',') == [ 'msec-since-start', 'samples' ] + names)
+        self.A(len(lines) == 4)
+        for (t, l) in enumerate(lines[1:]):
+            fields = l.split(',')
+            self.A(int(fields[0]) == t_msec[t] and float(fields[1]) == samples[t])
+            if t == 1:
+                self.A(fields[2:] == [ '' ] * len(names))
+            else:
+                self.A([ float(v) for v in fields[2:] ] == pctiles[t].tolist())
+
+    def test_f3_json_sink(self):
+        (t_msec, samples, pctiles, names) = self.write_sink('json')
+        with open(self.fn) as f:
+            records = [ json.loads(l) for l in f ]
+        self.A(len(records) == 3)
+        for (t, r) in enumerate(records):
+            self.A(len(r) == 2 + len(names))
+            self.A(r['msec-since-start'] == t_msec[t] and r['samples'] == samples[t])
+            if t == 1:
+                self.A([ r[n] for n in names ] == [ None ] * len(names))
+            else:
+                self.A([ r[n] for n in names ] == pctiles[t].tolist())
+
+    def test_f4_npy_sink(self):
+        (t_msec, samples, pctiles, names) = self.write_sink('npy')
+        out = np.load(self.fn)
+        self.A(list(out.dtype.names) == [ 'msec-since-start', 'samples' ] + names)
+        self.A((out['msec-since-start'] == t_msec).all() and (out['samples'] == samples).all())
+        for (j, n) in enumerate(names):
+            self.A(np.array_equal(out[n], pctiles[:, j], equal_nan=True))
+
 # we are using this module as a standalone program
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+"""
+    Latency bins of fio histogram logs, shared by fiologparser_hist.py and
+    fio-histo-log-pctiles.py.
+
+    fio keeps FIO_IO_U_PLAT_GROUP_NR groups of 1 << FIO_IO_U_PLAT_BITS bins
+    (see stat.h).  The bins of the first two groups are one unit wide, and
+    every following group doubles the width.  With log_hist_coarseness, each
+    logged bin is the sum of 1 << coarseness consecutive bins.
+
+    The edges of the bins are computed once per (groups, bits, coarseness,
+    divisor) and shared by all callers, as NumPy arrays if numpy is
+    installed and lists otherwise.
+"""
+
+numpy_imported = True
+try:
+    import numpy as np
+except ImportError:
+    numpy_imported = False
+
+FIO_IO_U_PLAT_BITS = 6
+
+_bin_edges = {}
+
+
+def plat_idx_to_lower(idx, bits=FIO_IO_U_PLAT_BITS):
+    """ Lower edge of bin idx, like plat_idx_to_val() in stat.c without
+        the half bin.  idx may be a NumPy array of indexes. """
+    val = 1 << bits
+    if numpy_imported and isinstance(idx, np.ndarray):
+        error_bits = np.maximum((idx >> bits) - 1, 0)
+        return np.where(idx < (val << 1), idx,
+                        (1 << (error_bits + bits)) + ((idx % val) << error_bits))
+
+    # MSB <= (FIO_IO_U_PLAT_BITS-1), cannot be rounded off. Use
+    # all bits of the sample as index
+    if idx < (val << 1):
+        return idx
+    error_bits = (idx >> bits) - 1
+    return (1 << (error_bits + bits)) + ((idx % val) << error_bits)
+
+
+def plat_idx_to_legacy_upper(idx, bits=FIO_IO_U_PLAT_BITS):
+    """ Upper edge fiologparser_hist.py has always given the fine bin
+        before idx: idx itself in the first two groups, and the upper edge
+        of bin idx, i.e. one fine bin too high, above them. """
+    val = 1 << bits
+    if numpy_imported and isinstance(idx, np.ndarray):
+        return np.where(idx < (val << 1), idx, plat_idx_to_lower(idx + 1, bits))
+    if idx < (val << 1):
+        return idx
+    return plat_idx_to_lower(idx + 1, bits)
+
+
+def compute_bin_edges(groups, bits, coarseness, divisor, legacy):
+    nr = groups << bits
+    stride = 1 << coarseness
+    if nr % stride:
+        raise ValueError("%d bins cannot be merged %d at a time" % (nr, stride))
+
+    # edge i is the lower edge of bin i, and the upper edge of bin i - 1
+    upper_edge = plat_idx_to_legacy_upper if legacy else plat_idx_to_lower
+    if numpy_imported:
+        idx = np.arange(0, nr + 1, stride)
+        lower = plat_idx_to_lower(idx[:-1], bits) / float(divisor)
+        upper = upper_edge(idx[1:], bits) / float(divisor)
+        lower.flags.writeable = False
+        upper.flags.writeable = False
+    else:
+        lower = [plat_idx_to_lower(i, bits) / float(divisor) for i in range(0, nr, stride)]
+        upper = [upper_edge(i, bits) / float(divisor) for i in range(stride, nr + 1, stride)]
+    return lower, upper
+
+
+def get_bin_edges(groups, bits=FIO_IO_U_PLAT_BITS, coarseness=0, divisor=1, legacy=False):
+    """ Return the (lower, upper) edges of the bins of a histogram log with
+        groups groups of 1 << bits bins, merged 1 << coarseness at a time.
+        Edges are in the unit of the log (ns since fio 2.99, us before)
+        divided by divisor.  The arrays are shared and read-only.
+
+        With legacy, the upper edges are those fiologparser_hist.py has
+        always printed its max, and computed its bin mid-points, from
+        (see plat_idx_to_legacy_upper()), so that its output is unchanged. """
+    key = (groups, bits, coarseness, divisor, legacy)
+    if key not in _bin_edges:
+        _bin_edges[key] = compute_bin_edges(groups, bits, coarseness, divisor, legacy)
+    return _bin_edges[key]
+
+
+def get_bin_values(groups, bits=FIO_IO_U_PLAT_BITS, coarseness=0, divisor=1, legacy=False):
+    """ Return the mid-points of the bins, see get_bin_edges().  Needs
+        numpy. """
+    key = ('mid', groups, bits, coarseness, divisor, legacy)
+    if key not in _bin_edges:
+        lower, upper = get_bin_edges(groups, bits, coarseness, divisor, legacy)
+        mid = (lower + upper) / 2.0
+        mid.flags.writeable = False
+        _bin_edges[key] = mid
+    return _bin_edges[key]
@@ -10,15 +10,59 @@
             2000, 43, 152, 1642.368, 1714.099, 1816.659, 1845.552, 1888.131, 1888.000
             4000, 39, 1152, 1546.962, 1545.785, 1627.192, 1640.019, 1691.204, 1744
             ...
+
+    gzip or zstd compressed histogram logs are read directly.  Histogram
+    logs stored by fio with log_store_compressed=1 cannot be read, fio does
+    not store their bins.
+
+    With --merged-output, the merged histograms of the intervals are saved
+    too, and that file can be given back as input to print other
+    percentiles quickly.
+
+    With --job-shares, the share of each log in the samples above a
+    percentile is printed along with the statistics of each interval.
+
+    With --spikes, the windows of intervals whose tail latency jumps above
+    its rolling baseline are printed instead, with the jobs behind them.
+
+    To run unit tests, set the UNITTEST environment variable to anything
+    and don't pass normal CLI parameters.
     
     @author Karl Cronburg <karl.cronburg@gmail.com>
 """
+import collections
+import contextlib
+import functools
+import heapq
+import io
+import itertools
+import multiprocessing
 import os
 import sys
-import pandas
 import re
+import struct
 import numpy as np
 
+# np.loadtxt is written in C from NumPy 1.23 on and is then the quickest way
+# to read the logs.  Before that pandas is used if installed, it is not
+# imported otherwise as that alone takes about a second.
+fast_loadtxt = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+pandas_imported = False
+if not fast_loadtxt:
+    try:
+        import pandas
+        pandas_imported = True
+    except ImportError:
+        pass
+
+# fiologreader.py lives one directory up in the fio source tree, and
+# fiohistbins.py next to this script.  Once installed, both are in share/fio
+# next to the bin directory holding it.
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'share', 'fio'))
+from fiologreader import is_indexable, is_stored_log, load_index, open_log
+from fiohistbins import FIO_IO_U_PLAT_BITS, get_bin_edges, get_bin_values
+
 runascmd = False
 
 err = sys.stderr.write
@@ -31,7 +75,7 @@ class HistFileRdr():
         get next bin array.
     """
     def __init__(self, file):
-        self.fp = open(file, 'r')
+        self.fp = open_log(file)
         self.data = self.nextData()
 
     def close(self):
@@ -120,12 +164,19 @@ def gen_output_columns(ctx):
     strpercs = re.split('[,:]', ctx.percentiles)
     percs = [50.0]  # always print 50% in 'median' column
     percs.extend(list(map(float,strpercs)))
+    if ctx.spikes:
+        columns = ["start-time", "end-time", "dir", "intervals", "samples", "peak", "baseline", "jobs"]
+        if not ctx.directions:
+            columns.remove("dir")
+        return
     if ctx.directions:
         columns = ["end-time", "dir", "samples", "min", "avg", "median"]
     else:
         columns = ["end-time", "samples", "min", "avg", "median"]
     columns.extend(list([x+'%' for x in strpercs]))
     columns.append("max")
+    if ctx.job_shares is not None:
+        columns.extend([os.path.basename(f) for f in ctx.FILE])
 
 def fmt_float_list(ctx, num=1):
   """ Return a comma separated list of float formatters to the required number
@@ -140,103 +191,175 @@ def fmt_float_list(ctx, num=1):
 __HIST_COLUMNS = 1216
 __NON_HIST_COLUMNS = 3
 __TOTAL_COLUMNS = __HIST_COLUMNS + __NON_HIST_COLUMNS
+__MAX_COLUMNS = __HIST_COLUMNS # without coarseness
+
+def read_int_chunks(fp, sz):
+    """ Yield the rows of a CSV file of integers in 2-D arrays of up to sz
+        rows. """
+    if pandas_imported and not fast_loadtxt:
+        # pandas hands out a column major array, make it row major so rows
+        # are cheap to take out of it
+        for df in pandas.read_csv(fp, dtype=int, header=None, chunksize=sz):
+            yield np.ascontiguousarray(df.values)
+        return
 
-def read_chunk(rdr, sz):
-    """ Read the next chunk of size sz from the given reader. """
-    try:
-        """ StopIteration occurs when the pandas reader is empty, and AttributeError
-            occurs if rdr is None due to the file being empty. """
-        new_arr = rdr.read().values
-    except (StopIteration, AttributeError):
-        return None
-
-    # Let's leave the array as is, and let later code ignore the block size
-    return new_arr
-
-    #""" Extract array of the times, directions wo times, and histograms matrix without times column. """
-    #times, rws, szs = new_arr[:,0], new_arr[:,1], new_arr[:,2]
-    #hists = new_arr[:,__NON_HIST_COLUMNS:]
-    #times = times.reshape((len(times),1))
-    #dirs  = rws.reshape((len(rws),1))
-    #arr = np.append(times, hists, axis=1)
-    #return arr
-
-def get_min(fps, arrs):
-    """ Find the file with the current first row with the smallest start time """
-    return min([fp for fp in fps if not arrs[fp] is None], key=lambda fp: arrs.get(fp)[0][0])
-
-def histogram_generator(ctx, fps, sz):
-    
-    # Create a chunked pandas reader for each of the files:
-    rdrs = {}
-    for fp in fps:
-        try:
-            rdrs[fp] = pandas.read_csv(fp, dtype=int, header=None, chunksize=sz)
-        except ValueError as e:
-            if e.message == 'No columns to parse from file':
-                if ctx.warn: sys.stderr.write("WARNING: Empty input file encountered.\n")
-                rdrs[fp] = None
-            else:
-                raise(e)
-
-    # Initial histograms from disk:
-    arrs = {fp: read_chunk(rdr, sz) for fp,rdr in rdrs.items()}
     while True:
-
-        try:
-            """ ValueError occurs when nothing more to read """
-            fp = get_min(fps, arrs)
-        except ValueError:
+        lines = list(itertools.islice(fp, sz))
+        if not lines:
             return
-        arr = arrs[fp]
-        arri = np.insert(arr[0], 1, fps.index(fp))
-        yield arri
-        arrs[fp] = arr[1:]
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            continue
+        if fast_loadtxt:
+            yield np.loadtxt(lines, delimiter=',', dtype=np.int64, ndmin=2)
+        else:
+            arr = np.fromstring(''.join(lines).replace(',', ' '), dtype=np.int64, sep=' ')
+            if arr.size % len(lines):
+                raise ValueError("rows with different numbers of columns")
+            yield arr.reshape((len(lines), -1))
+
+def read_chunk(rdr):
+    """ Read the next chunk from the given reader, None at its end. """
+    return next(rdr, None)
+
+class HistBuffer():
+    """ Preallocated store of the histogram rows buffered for weighting,
+        in time order.  The live rows are kept contiguous in arr[head:tail]
+        so they can be handed to process_weighted_interval() as a view.
+        Appending writes after the last row, moving the live rows back to
+        the front or doubling the capacity once the end is reached, and
+        expired rows are dropped by advancing head, so both are amortized
+        O(1) per row.
+    """
+    def __init__(self, ncols, capacity):
+        self.arr = np.empty(shape=(max(1, capacity), ncols), dtype=int)
+        self.head = 0
+        self.tail = 0
 
-        if arrs[fp].shape[0] == 0:
-            arrs[fp] = read_chunk(rdrs[fp], sz)
+    def __len__(self):
+        return self.tail - self.head
 
-def _plat_idx_to_val(idx, edge=0.5, FIO_IO_U_PLAT_BITS=6, FIO_IO_U_PLAT_VAL=64):
-    """ Taken from fio's stat.c for calculating the latency value of a bin
-        from that bin's index.
-        
-            idx  : the value of the index into the histogram bins
-            edge : fractional value in the range [0,1]** indicating how far into
-            the bin we wish to compute the latency value of.
-        
-        ** edge = 0.0 and 1.0 computes the lower and upper latency bounds
-           respectively of the given bin index. """
+    @property
+    def rows(self):
+        return self.arr[self.head:self.tail]
+
+    @property
+    def last_time(self):
+        return self.arr[self.tail - 1][0]
+
+    def upto(self, ts):
+        """ Return the rows up to and including the first one at or
+            after time ts. """
+        rows = self.rows
+        return rows[:np.searchsorted(rows[:,0], ts) + 1]
+
+    def reserve(self, n):
+        """ Make room for n more rows after the last one. """
+        if self.tail + n <= len(self.arr):
+            return
+        live = len(self)
+        if live + n > len(self.arr) // 2:
+            capacity = len(self.arr)
+            while live + n > capacity // 2:
+                capacity *= 2
+            arr = np.empty(shape=(capacity, self.arr.shape[1]), dtype=self.arr.dtype)
+            arr[:live] = self.rows
+            self.arr = arr
+        else:
+            self.arr[:live] = self.rows
+        self.head, self.tail = 0, live
+
+    def append(self, rows):
+        """ Append one row or a 2-D block of rows. """
+        rows = rows.reshape((-1, self.arr.shape[1]))
+        self.reserve(len(rows))
+        self.arr[self.tail:self.tail + len(rows)] = rows
+        self.tail += len(rows)
+
+    def expire(self, end):
+        """ Drop the rows ending at or before end. """
+        self.head += np.searchsorted(self.rows[:,0], end, side='right')
+
+def merge_rows(bufs, horizon):
+    """ Take the rows of every file which come before horizon, a (time,
+        file index) pair, out of bufs, and return them in (time, file
+        index) order with the file index inserted as the second column.
+        Rows from the same file keep their order.
+    """
+    ts, k = horizon
+    parts = []
+    for i, arr in enumerate(bufs):
+        if arr is None:
+            continue
+        n = np.searchsorted(arr[:,0], ts, side='right' if i < k else 'left')
+        if n:
+            parts.append((i, arr[:n]))
+            bufs[i] = arr[n:]
+    if not parts:
+        return None
 
-    # MSB <= (FIO_IO_U_PLAT_BITS-1), cannot be rounded off. Use
-    # all bits of the sample as index
-    if (idx < (FIO_IO_U_PLAT_VAL << 1)):
-        return idx 
+    # Sort the (time, file index) keys only, then copy every row straight
+    # to its place in the block
+    times = np.concatenate([arr[:,0] for i, arr in parts])
+    ids = np.concatenate([np.full(len(arr), i) for i, arr in parts])
+    dest = np.empty(len(times), dtype=int)
+    dest[np.lexsort((ids, times))] = np.arange(len(times))
+    block = np.empty((len(times), parts[0][1].shape[1] + 1), dtype=int)
+    pos = 0
+    for i, arr in parts:
+        rows = dest[pos:pos + len(arr)]
+        block[rows, 0] = arr[:,0]
+        block[rows, 1] = i
+        block[rows, 2:] = arr[:,1:]
+        pos += len(arr)
+    return block
 
-    # Find the group and compute the minimum value of that group
-    error_bits = (idx >> FIO_IO_U_PLAT_BITS) - 1 
-    base = 1 << (error_bits + FIO_IO_U_PLAT_BITS)
+def histogram_generator(ctx, fps, sz):
+    """ Merge the rows of all files in time order, ties going to the file
+        listed first, and yield them in 2-D blocks with the index of the
+        file in fps as the second column.
+
+        A heap keeps, for every file with more to read, the time of the
+        last row read from it.  Rows before the smallest of these cannot
+        be preceded by anything still unread, so they are merged and
+        yielded as one block, and the file at the top of the heap is read
+        further.
+    """
 
-    # Find its bucket number of the group
-    k = idx % FIO_IO_U_PLAT_VAL
+    # Create a chunked reader for each of the files:
+    rdrs = [read_int_chunks(fp, sz) for fp in fps]
 
-    # Return the mean (if edge=0.5) of the range of the bucket
-    return base + ((k + edge) * (1 << error_bits))
-    
-def plat_idx_to_val_coarse(idx, coarseness, edge=0.5):
-    """ Converts the given *coarse* index into a non-coarse index as used by fio
-        in stat.h:plat_idx_to_val(), subsequently computing the appropriate
-        latency value for that bin.
-        """
-
-    # Multiply the index by the power of 2 coarseness to get the bin
-    # bin index with a max of 1536 bins (FIO_IO_U_PLAT_GROUP_NR = 24 in stat.h)
-    stride = 1 << coarseness
-    idx = idx * stride
-    lower = _plat_idx_to_val(idx, edge=0.0)
-    upper = _plat_idx_to_val(idx + stride, edge=1.0)
-    return lower + (upper - lower) * edge
-
-def print_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
+    # Initial histograms from disk:
+    bufs = [read_chunk(rdr) for rdr in rdrs]
+    if ctx.warn and any([arr is None for arr in bufs]):
+        sys.stderr.write("WARNING: Empty input file encountered.\n")
+    heap = [(arr[-1][0], i) for i, arr in enumerate(bufs) if arr is not None]
+    heapq.heapify(heap)
+    while heap:
+        ts, i = heapq.heappop(heap)
+        block = merge_rows(bufs, (ts, i))
+        if block is not None:
+            yield block
+
+        arr = read_chunk(rdrs[i])
+        if arr is not None:
+            bufs[i] = np.concatenate((bufs[i], arr))
+            heapq.heappush(heap, (bufs[i][-1][0], i))
+
+    # Every file has been read, flush what is left
+    block = merge_rows(bufs, (np.inf, len(bufs)))
+    if block is not None:
+        yield block
+
+def tail_by_file(file_hists, hist, perc):
+    """ Number of samples of each file from the bin holding the perc
+        percentile of hist on, file_hists being the files x bins array of
+        histograms summing up to hist. """
+    cdf = 100.0 * hist.cumsum() / hist.sum()
+    first = min(np.searchsorted(cdf, perc), len(cdf) - 1)
+    return file_hists[:, first:].sum(axis=1)
+
+def print_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir, file_hists=None):
     ps = weighted_percentile(percs, vs, ws)
 
     avg = weighted_average(vs, ws)
@@ -254,14 +377,197 @@ def print_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
         # max and min are decimal values if no divisor
         fmt = fmt + "%d, " + fmt_float_list(ctx, len(percs)+1) + ", %d"
 
+    # Share of each file in the samples above the --job-shares percentile
+    if file_hists is not None and ctx.job_shares is not None:
+        tail = tail_by_file(file_hists, ws, ctx.job_shares)
+        total = tail.sum()
+        shares = 100.0 * tail / total if total > 0 else np.zeros(len(tail))
+        row = row + list(shares)
+        fmt = fmt + ", " + fmt_float_list(ctx, len(shares))
+
     print (fmt % tuple(row))
 
+def report_interval(ctx, end, dir, mn, ss_cnt, hist, mx, file_hists=None):
+    """ Print the statistics of an interval, or hand it to the spike
+        detector with --spikes, and save its histogram with
+        --merged-output.  file_hists holds the histogram of the interval
+        for each input file, when they are kept. """
+    if merged_out is not None:
+        write_merged_hist(merged_out, end, dir, ss_cnt, mn, mx, hist)
+    if spikes is not None:
+        spikes.add(end, dir, ss_cnt, hist, file_hists)
+    else:
+        print_all_stats(ctx, end, mn, ss_cnt, bin_vals, hist, mx, dir=dir, file_hists=file_hists)
+
+class SpikeDetector():
+    """ Find the spikes of a tail latency percentile in a single pass over
+        the intervals.  An interval is flagged when its --spike-percentile
+        is more than --spike-factor times the baseline, the median or mean
+        of that percentile over the last --spike-window intervals which
+        were not flagged.  There is no baseline until half the window is
+        filled.  Consecutive flagged intervals make up a spike window,
+        printed as soon as it is over, along with the share of each job in
+        the samples above the percentile when the per-file histograms are
+        known.  Only the baseline values and the open windows are kept.
+    """
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.history = {}
+        self.windows = {}
+
+    def get_baseline(self, history):
+        if len(history) < max(1, self.ctx.spike_window // 2):
+            return None
+        if self.ctx.spike_baseline == 'mean':
+            return np.mean(history)
+        return np.median(history)
+
+    def add(self, end, dir, ss_cnt, hist, file_hists):
+        ctx = self.ctx
+        value = weighted_percentile([ctx.spike_percentile], bin_vals, hist)[0]
+        history = self.history.setdefault(dir, collections.deque(maxlen=ctx.spike_window))
+        window = self.windows.get(dir)
+        if window is not None and window['end'] + ctx.interval != end:
+            self.close(dir)
+            window = None
+
+        baseline = self.get_baseline(history)
+        if baseline is None or value <= ctx.spike_factor * baseline:
+            if window is not None:
+                self.close(dir)
+            history.append(value)
+            return
+
+        if window is None:
+            window = {'start': end - ctx.interval, 'baseline': baseline, 'peak': value,
+                      'intervals': 0, 'samples': 0, 'jobs': None}
+            self.windows[dir] = window
+        window['end'] = end
+        window['intervals'] += 1
+        window['samples'] += ss_cnt
+        window['peak'] = max(window['peak'], value)
+        if file_hists is not None:
+            tail = tail_by_file(file_hists, hist, ctx.spike_percentile)
+            window['jobs'] = tail if window['jobs'] is None else window['jobs'] + tail
+
+    def close(self, dir):
+        ctx = self.ctx
+        window = self.windows.pop(dir)
+        jobs = '-'
+        tails = window['jobs']
+        if tails is not None and tails.sum() > 0:
+            shares = 100.0 * tails / tails.sum()
+            top = [i for i in np.argsort(-shares, kind='stable')[:ctx.spike_jobs] if shares[i] > 0]
+            jobs = ' '.join(['%s:%.1f%%' % (os.path.basename(ctx.FILE[i]), shares[i]) for i in top])
+
+        if ctx.directions:
+            row = [window['start'], window['end'], dir]
+            fmt = "%d, %d, %s, "
+        else:
+            row = [window['start'], window['end']]
+            fmt = "%d, %d, "
+        row += [window['intervals'], window['samples'],
+                float(window['peak']) / ctx.divisor, float(window['baseline']) / ctx.divisor, jobs]
+        fmt += "%d, %d, " + fmt_float_list(ctx, 2) + ", %s"
+        print(fmt % tuple(row))
+        sys.stdout.flush()
+
+    def finish(self):
+        """ Print the windows still open at the end of the input """
+        for dir in sorted(self.windows):
+            self.close(dir)
+
+spikes = None
+
+# With --merged-output, the merged histogram of every interval printed is
+# also written to a binary file, which can be given back as input to print
+# other percentiles without reading the histogram logs again.  The file is a
+# header followed by a record per interval and direction, each holding the
+# indexes and weighted counts of its non-empty bins:
+#
+#   header: magic, version, # bins, # bins without coarseness, directions
+#   record: end time, direction, samples, min, max, # non-empty bins,
+#           then the bin indexes (uint32) and counts (float64)
+
+MERGED_MAGIC = b'fiohist\0'
+MERGED_VERSION = 1
+MERGED_HEADER = struct.Struct('<8sIII4s')
+MERGED_RECORD = struct.Struct('<qcqddI')
+
+merged_out = None
+
+def is_merged_file(fn):
+    with open(fn, 'rb') as fp:
+        return fp.read(len(MERGED_MAGIC)) == MERGED_MAGIC
+
+def write_merged_header(fp, hist_cols, max_cols, dirs):
+    fp.write(MERGED_HEADER.pack(MERGED_MAGIC, MERGED_VERSION, hist_cols, max_cols,
+                                ''.join(sorted(dirs)).encode()))
+
+def read_merged_header(fp, fn):
+    """ Return the number of bins, the number of bins without coarseness
+        and the directions of a merged histogram file. """
+    magic, version, hist_cols, max_cols, dirs = MERGED_HEADER.unpack(fp.read(MERGED_HEADER.size))
+    if magic != MERGED_MAGIC:
+        raise RuntimeError("%s: not a merged histogram file" % fn)
+    if version != MERGED_VERSION:
+        raise RuntimeError("%s: unsupported merged histogram version %d" % (fn, version))
+    return hist_cols, max_cols, dirs.rstrip(b'\0').decode()
+
+def write_merged_hist(fp, end, dir, ss_cnt, mn, mx, hist):
+    idxs = np.flatnonzero(hist)
+    fp.write(MERGED_RECORD.pack(int(end), dir.encode(), int(ss_cnt), mn, mx, len(idxs)))
+    fp.write(idxs.astype('<u4').tobytes())
+    fp.write(np.asarray(hist, dtype='<f8')[idxs].tobytes())
+
+def read_merged_hists(fn):
+    """ Yield (end, dir, samples, min, max, histogram) for each record of
+        a merged histogram file. """
+    with open(fn, 'rb') as fp:
+        hist_cols, max_cols, dirs = read_merged_header(fp, fn)
+        while True:
+            rec = fp.read(MERGED_RECORD.size)
+            if not rec:
+                return
+            end, dir, ss_cnt, mn, mx, n = MERGED_RECORD.unpack(rec)
+            idxs = np.frombuffer(fp.read(4 * n), dtype='<u4')
+            hist = np.zeros(hist_cols, dtype=float)
+            hist[idxs] = np.frombuffer(fp.read(8 * n), dtype='<f8')
+            yield end, dir.decode(), ss_cnt, mn, mx, hist
+
+def output_merged_data(ctx, printdirs):
+    """ Print the statistics of merged histogram files, as saved with
+        --merged-output. """
+    for fn in ctx.FILE:
+        with open(fn, 'rb') as fp:
+            hist_cols, max_cols, dirs = read_merged_header(fp, fn)
+        missing = ''.join(sorted(set(printdirs) - set(dirs)))
+        if hist_cols != __HIST_COLUMNS:
+            errmsg = "Merged histogram file '%s' has %d bins, not %d.\n" % (fn, hist_cols, __HIST_COLUMNS)
+        elif missing:
+            errmsg = ("Merged histogram file '%s' only holds directions '%s', not '%s'.\n"
+                      % (fn, dirs, missing))
+        else:
+            continue
+        if runascmd:
+            err(errmsg)
+            exit(1)
+        else:
+            raise RuntimeError(errmsg)
+
+    print(', '.join(columns))
+
+    for fn in ctx.FILE:
+        for (end, dir, ss_cnt, mn, mx, hist) in read_merged_hists(fn):
+            if dir in printdirs:
+                report_interval(ctx, end, dir, mn, ss_cnt, hist, mx)
+
 def update_extreme(val, fncn, new_val):
     """ Calculate min / max in the presence of None values """
     if val is None: return new_val
     else: return fncn(val, new_val)
 
-# See beginning of main() for how bin_vals are computed
+# See init_globals() for how bin_vals are computed
 bin_vals = []
 lower_bin_vals = [] # lower edge of each bin
 upper_bin_vals = [] # upper edge of each bin 
@@ -281,54 +587,108 @@ def process_interval(ctx, iHist, iEnd, dir):
         mn_bin_val = bin_vals[idxs[0]]
         mx_bin_val = bin_vals[idxs[-1]]
 
-    if ss_cnt > 0: print_all_stats(ctx, iEnd, mn_bin_val, ss_cnt, bin_vals, iHist, mx_bin_val, dir=dir)
+    if ss_cnt > 0: report_interval(ctx, iEnd, dir, mn_bin_val, ss_cnt, iHist, mx_bin_val)
 
 
 dir_map = ['r', 'w', 't']  # map of directional value in log to textual representation
+
+# Number of histogram bins (rows x bins) weighted at once by
+# process_weighted_interval(), bounding the size of its temporary arrays.
+WEIGHT_BLOCK_BINS = 1 << 20
+
+def weigh_histograms(ctx, end_times, hists, iStart, iEnd):
+    """ Vectorized counterpart of weights() over a block of histogram rows.
+        Only the bins which started before the end of the interval are
+        looked at, i.e. a suffix of the bins as bin values increase, and
+        bins which are empty in every row are skipped altogether.
+
+        end_times :: Array of end times of the rows
+        hists     :: Rows x bins array of histograms
+        return    :: (indexes of the bins kept, weighted histograms of
+                     these bins, number of samples looked at, whether any
+                     is non-zero, lower and upper bound of the non-zero
+                     bins) for each row
+    """
+    active = np.nonzero(np.any(hists, axis=0))[0]
+    hs = hists[:, active]
+    end_times = end_times[:, np.newaxis]
+    start_times = (end_times - 0.5 * ctx.interval) - bin_vals[active] / ctx.time_divisor
+    before = start_times < iEnd
+
+    sbounds = np.maximum(start_times, iStart).astype(float)
+    ebounds = np.minimum(end_times, iEnd).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ws = (ebounds - sbounds) / (end_times - start_times)
+    nans = np.isnan(ws)
+    if np.any(nans & before):
+        err("WARNING: zero-length sample(s) detected. Log file corrupt"
+            " / bad time values? Ignoring these samples.\n")
+    ws[nans | ~before] = 0.0
+
+    hs = np.where(before, hs, 0)
+    nonzero = hs != 0
+    found = nonzero.any(axis=1)
+    if not active.size:
+        return active, ws, hs.sum(axis=1), found, np.zeros(0), np.zeros(0)
+
+    # The bound of a row is taken from the bin next to its first or last
+    # non-empty one, if that bin was looked at
+    first = active[np.argmax(nonzero, axis=1)]
+    last = active[len(active) - 1 - np.argmax(nonzero[:, ::-1], axis=1)]
+    lo = np.maximum(first - 1, 0)
+    lo_before = ((end_times[:, 0] - 0.5 * ctx.interval) - bin_vals[lo] / ctx.time_divisor) < iEnd
+    lo = np.where(lo_before, lo, first)
+    hi = np.minimum(len(bin_vals) - 1, last + 1)
+    return active, hs * ws, hs.sum(axis=1), found, lower_bin_vals[lo], upper_bin_vals[hi]
+
+def sum_by_file(fids, ws, nfiles):
+    """ Sum the rows of ws by the index of their file, as a matrix product
+        so it stays quick with many files. """
+    onehot = np.zeros((nfiles, len(fids)), dtype=ws.dtype)
+    onehot[fids.astype(int), np.arange(len(fids))] = 1
+    return onehot.dot(ws)
+
 def process_weighted_interval(ctx, samples, iStart, iEnd, printdirs):
     """ Construct the weighted histogram for the given interval by scanning
         through all the histograms and figuring out which of their bins have
         samples with latencies which overlap with the given interval
-        [iStart,iEnd].
+        [iStart,iEnd].  Rows are weighted a block at a time with array
+        operations, see weigh_histograms().
     """
 
-    times, files, dirs, sizes, hists = samples[:,0], samples[:,1], samples[:,2], samples[:,3], samples[:,4:]
-    iHist={}; ss_cnt = {}; mn_bin_val={}; mx_bin_val={}
+    times, fids, dirs, hists = samples[:,0], samples[:,1], samples[:,2], samples[:,4:]
+    iHist={}; ss_cnt = {}; mn_bin_val={}; mx_bin_val={}; fHist = {}
     for dir in printdirs:
         iHist[dir] = np.zeros(__HIST_COLUMNS, dtype=float)
         ss_cnt[dir] = 0 # number of samples affecting this interval
         mn_bin_val[dir] = None
         mx_bin_val[dir] = None
-
-    for end_time,file,dir,hist in zip(times,files,dirs,hists):
-
-        # Only look at bins of the current histogram sample which
-        # started before the end of the current time interval [start,end]
-        start_times = (end_time - 0.5 * ctx.interval) - bin_vals / ctx.time_divisor
-        idx = np.where(start_times < iEnd)
-        s_ts, l_bvs, u_bvs, hs = start_times[idx], lower_bin_vals[idx], upper_bin_vals[idx], hist[idx]
-
-        # Increment current interval histogram by weighted values of future histogram
-        # total number of samples
-        # and min and max values as necessary
-        textdir = dir_map[dir]
-        ws = hs * weights(s_ts, end_time, iStart, iEnd)
-        mmidx = np.where(hs != 0)[0]
-        if 'm' in printdirs:
-            iHist['m'][idx] += ws
-            ss_cnt['m'] += np.sum(hs)
-            if mmidx.size > 0:
-                mn_bin_val['m'] = update_extreme(mn_bin_val['m'], min, l_bvs[max(0,           mmidx[0]  - 1)])
-                mx_bin_val['m'] = update_extreme(mx_bin_val['m'], max, u_bvs[min(len(hs) - 1, mmidx[-1] + 1)])
-        if textdir in printdirs:
-            iHist[textdir][idx] += ws
-            ss_cnt[textdir] += np.sum(hs)  # Update total number of samples affecting current interval histogram:
-            if mmidx.size > 0:
-                mn_bin_val[textdir] = update_extreme(mn_bin_val[textdir], min, l_bvs[max(0,           mmidx[0]  - 1)])
-                mx_bin_val[textdir] = update_extreme(mx_bin_val[textdir], max, u_bvs[min(len(hs) - 1, mmidx[-1] + 1)])
+        fHist[dir] = np.zeros((len(ctx.FILE), __HIST_COLUMNS)) if ctx.per_file else None
+
+    step = max(1, WEIGHT_BLOCK_BINS // __HIST_COLUMNS)
+    for i in range(0, len(samples), step):
+        active, ws, counts, found, lows, highs = weigh_histograms(ctx, times[i:i+step], hists[i:i+step], iStart, iEnd)
+        for textdir in printdirs:
+            if textdir == 'm':
+                rows = np.ones(len(counts), dtype=bool)
+            else:
+                rows = dirs[i:i+step] == dir_map.index(textdir)
+            if not np.any(rows):
+                continue
+
+            # Summing the rows after the current histogram adds them in the
+            # same order as a row by row loop would
+            iHist[textdir][active] = np.concatenate((iHist[textdir][np.newaxis, active], ws[rows])).sum(axis=0)
+            if fHist[textdir] is not None:
+                fHist[textdir][:, active] += sum_by_file(fids[i:i+step][rows], ws[rows], len(ctx.FILE))
+            ss_cnt[textdir] += np.sum(counts[rows])  # Update total number of samples affecting current interval histogram:
+            rows &= found
+            if np.any(rows):
+                mn_bin_val[textdir] = update_extreme(mn_bin_val[textdir], min, np.min(lows[rows]))
+                mx_bin_val[textdir] = update_extreme(mx_bin_val[textdir], max, np.max(highs[rows]))
 
     for textdir in sorted(printdirs):
-        if ss_cnt[textdir] > 0: print_all_stats(ctx, iEnd, mn_bin_val[textdir], ss_cnt[textdir], bin_vals, iHist[textdir], mx_bin_val[textdir], dir=textdir)
+        if ss_cnt[textdir] > 0: report_interval(ctx, iEnd, textdir, mn_bin_val[textdir], ss_cnt[textdir], iHist[textdir], mx_bin_val[textdir], fHist[textdir])
 
 def guess_max_from_bins(ctx, hist_cols):
     """ Try to guess the GROUP_NR from given # of histogram
@@ -362,53 +722,278 @@ def guess_max_from_bins(ctx, hist_cols):
 
     return bins[idx[1][0]]
 
-def output_weighted_interval_data(ctx,printdirs):
+def process_weighted_intervals(ctx, printdirs, fps, start, end, count=None, after=None):
+    """ Print the weighted statistics of the intervals from [start,end]
+        on, until the data runs out or after count intervals.  With after,
+        rows ending at or before it are ignored, as they would have been
+        thrown away by the intervals before start. """
 
-    fps = [open(f, 'r') for f in ctx.FILE]
     gen = histogram_generator(ctx, fps, ctx.buff_size)
+    buf = HistBuffer(__TOTAL_COLUMNS + 1, ctx.buff_size)
+    more_data = True
+    while (more_data or len(buf) > 0) and count != 0:
+
+        # Read up to ctx.max_latency (default 20 seconds) of data from end of current interval.
+        limit = ctx.max_latency * 1000 + end
+        while len(buf) == 0 or buf.last_time < limit:
+            try:
+                new_arr = next(gen)
+            except StopIteration:
+                more_data = False
+                break
+            buf.append(new_arr)
+        if after is not None:
+            buf.expire(after)
+
+        if len(buf) > 0:
+            # Blocks may overshoot, only look at the rows up to the
+            # first one past the limit
+            arr = buf.upto(limit)
+            # Jump immediately to the start of the input, rounding
+            # down to the nearest multiple of the interval (useful when --log_unix_epoch
+            # was used to create these histograms):
+            if start == 0 and arr[0][0] - ctx.max_latency > end:
+                start = arr[0][0] - ctx.max_latency
+                start = start - (start % ctx.interval)
+                end = start + ctx.interval
+
+            process_weighted_interval(ctx, arr, start, end, printdirs)
+
+            # Throw away samples we no longer need - samples which end
+            # before the start of the next interval, i.e. the end of the
+            # current interval:
+            buf.expire(end)
+
+        start += ctx.interval
+        end = start + ctx.interval
+        if count is not None:
+            count -= 1
+
+def output_weighted_interval_data(ctx,printdirs):
 
     print(', '.join(columns))
 
+    if ctx.jobs > 1:
+        output_parallel_interval_data(ctx, printdirs)
+        return
+
+    fps = [open_log(f) for f in ctx.FILE]
     try:
-        start, end = 0, ctx.interval
-        arr = np.empty(shape=(0,__TOTAL_COLUMNS + 1),dtype=int)
-        more_data = True
-        while more_data or len(arr) > 0:
+        process_weighted_intervals(ctx, printdirs, fps, 0, ctx.interval)
+    finally:
+        for fp in fps:
+            fp.close()
 
-            # Read up to ctx.max_latency (default 20 seconds) of data from end of current interval.
-            while len(arr) == 0 or arr[-1][0] < ctx.max_latency * 1000 + end:
-                try:
-                    new_arr = next(gen)
-                except StopIteration:
-                    more_data = False
-                    break
-                nashape  = new_arr.reshape((1,__TOTAL_COLUMNS + 1))
-                arr = np.append(arr, nashape, axis=0)
-            #arr = arr.astype(int)
-            
-            if arr.size > 0:
-                # Jump immediately to the start of the input, rounding
-                # down to the nearest multiple of the interval (useful when --log_unix_epoch
-                # was used to create these histograms):
-                if start == 0 and arr[0][0] - ctx.max_latency > end:
-                    start = arr[0][0] - ctx.max_latency
-                    start = start - (start % ctx.interval)
-                    end = start + ctx.interval
-
-                process_weighted_interval(ctx, arr, start, end, printdirs)
-                
-                # Update arr to throw away samples we no longer need - samples which
-                # end before the start of the next interval, i.e. the end of the
-                # current interval:
-                idx = np.where(arr[:,0] > end)
-                arr = arr[idx]
-            
-            start += ctx.interval
-            end = start + ctx.interval
+# With --align, when --interval is a multiple of the log_hist_msec the logs
+# were written with and every row is logged on a multiple of it, each row is
+# put in a single interval: the one holding the period it was logged for.
+# Its bins are then added as they are, which is much quicker than weighting
+# them.  The rows of fio may be logged a little late, up to ALIGN_SLACK of
+# the period.  Weighting spreads a row over the intervals its samples may
+# have started in, back to half an interval plus their latency before it, so
+# the output is only the same when rows are logged exactly at the end of
+# intervals and latencies are under half an interval.
+
+ALIGN_SLACK = 0.05
+# rows the period is guessed from
+ALIGN_PERIOD_ROWS = 64
+# rows checked at a time
+ALIGN_BLOCK_ROWS = 1 << 16
+
+def get_log_period(fn):
+    """ Return the log_hist_msec a histogram log was written with, if every
+        one of its rows is logged on a multiple of it, None otherwise.  fio
+        keeps a histogram window per direction, so the rows of different
+        directions may be a few ms apart and the period is guessed from the
+        time between the rows of each direction. """
+    with open_log(fn) as fp:
+        rows = (line.split(',', 2)[:2] for line in fp if line.strip())
+        rows = ((int(ts), int(dir)) for (ts, dir) in rows)
+        head = np.array(list(itertools.islice(rows, ALIGN_PERIOD_ROWS)), dtype=np.int64).reshape((-1, 2))
+        diffs = [np.diff(np.unique(head[head[:,1] == dir, 0])) for dir in np.unique(head[:,1])]
+        diffs = np.concatenate([np.zeros(0, dtype=np.int64)] + diffs)
+        if not diffs.size:
+            return None
+        period = int(round(np.median(diffs)))
+        if period <= 0:
+            return None
+        block = head
+        while len(block):
+            times = block[:,0]
+            slack = np.abs(times - np.round(times / float(period)) * period)
+            if slack.max() > ALIGN_SLACK * period:
+                return None
+            block = np.array(list(itertools.islice(rows, ALIGN_BLOCK_ROWS)), dtype=np.int64).reshape((-1, 2))
+    return period
+
+def get_aligned_period(ctx):
+    """ Return the log_hist_msec of the logs if they all share it, every
+        row is aligned on it and --interval is a multiple of it, None if
+        they must be weighted. """
+    periods = set(map(get_log_period, ctx.FILE))
+    if len(periods) != 1:
+        return None
+    period = periods.pop()
+    if period is None or ctx.interval % period:
+        return None
+    return period
+
+def output_aligned_interval_data(ctx, printdirs, period):
+    """ Print the statistics of the intervals of logs aligned on them, see
+        get_aligned_period(), by adding up the integer bins of the rows of
+        each interval.  min and max are those process_weighted_interval()
+        gives, the edges of the bins next to the first and last non-empty
+        ones. """
+    print(', '.join(columns))
+
+    fps = [open_log(f) for f in ctx.FILE]
+    iEnd, iHist, fHist = None, {}, {}
+
+    def flush():
+        for textdir in sorted(printdirs):
+            hist = iHist[textdir]
+            idxs = np.flatnonzero(hist)
+            if idxs.size:
+                lo = max(idxs[0] - 1, 0)
+                hi = min(idxs[-1] + 1, len(bin_vals) - 1)
+                report_interval(ctx, iEnd, textdir, lower_bin_vals[lo], hist.sum(), hist,
+                                upper_bin_vals[hi], fHist[textdir])
+
+    try:
+        for block in histogram_generator(ctx, fps, ctx.buff_size):
+            # Interval holding the period each row was logged for
+            slots = np.round(block[:,0] / float(period)).astype(np.int64) * period
+            ends = -(-slots // ctx.interval) * ctx.interval
+            bounds = np.flatnonzero(np.diff(ends)) + 1
+            for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(block)]):
+                if ends[lo] != iEnd:
+                    if iEnd is not None:
+                        flush()
+                    iEnd = ends[lo]
+                    for textdir in printdirs:
+                        iHist[textdir] = np.zeros(__HIST_COLUMNS, dtype=np.int64)
+                        fHist[textdir] = np.zeros((len(ctx.FILE), __HIST_COLUMNS), dtype=np.int64) if ctx.per_file else None
+                fids, dirs, hists = block[lo:hi,1], block[lo:hi,2], block[lo:hi,4:]
+                for textdir in printdirs:
+                    if textdir == 'm':
+                        rows = np.ones(hi - lo, dtype=bool)
+                    else:
+                        rows = dirs == dir_map.index(textdir)
+                    if not np.any(rows):
+                        continue
+                    iHist[textdir] += hists[rows].sum(axis=0)
+                    if fHist[textdir] is not None:
+                        fHist[textdir] += sum_by_file(fids[rows], hists[rows], len(ctx.FILE))
+        if iEnd is not None:
+            flush()
     finally:
         for fp in fps:
             fp.close()
 
+# With --jobs, the intervals are split into chunks, each printed by a worker
+# process reading the logs from the start of its chunk to --max_latency past
+# its end.  The rows of an interval only depend on the time it starts, so the
+# chunks give the same output as a single pass.
+
+def get_log_span(fn):
+    """ Return the first and last timestamps of a histogram log, or None
+        if it is empty.  Plain text logs are read from their last index
+        entry, see load_index(). """
+    with open_log(fn) as fp:
+        line = fp.readline()
+    if not line.strip():
+        return None
+    first = last = int(line.split(',', 1)[0])
+
+    offset = 0
+    if is_indexable(fn):
+        index = load_index(fn)
+        if index:
+            offset = index[-1][1]
+    with open_log(fn, offset=offset) as fp:
+        for line in fp:
+            if line.strip():
+                last = int(line.split(',', 1)[0])
+    return first, last
+
+def open_log_at(fn, start):
+    """ Open a histogram log from a line at or before time start, the
+        start of the log if it cannot be seeked into. """
+    offset = 0
+    if start > 0 and is_indexable(fn):
+        for (ts, off) in load_index(fn):
+            if ts > start:
+                break
+            offset = off
+    return open_log(fn, offset=offset)
+
+def get_chunk_output(ctx, printdirs, chunk):
+    """ Return the output of the count intervals from start on, chunk
+        being (start, count, after). """
+    global merged_out
+    start, count, after = chunk
+    fps = [open_log_at(f, start) for f in ctx.FILE]
+    out = io.StringIO()
+    merged_out = io.BytesIO() if ctx.merged_output else None
+    try:
+        with contextlib.redirect_stdout(out):
+            process_weighted_intervals(ctx, printdirs, fps, start, start + ctx.interval, count, after)
+        merged = merged_out.getvalue() if merged_out else b''
+    finally:
+        for fp in fps:
+            fp.close()
+        if merged_out is not None:
+            merged_out.close()
+            merged_out = None
+    return out.getvalue(), merged
+
+def init_chunk_process(ctx):
+    """ Pool initializer of output_parallel_interval_data(): a forked
+        worker closes its copy of the --merged-output file, which only the
+        parent writes to, the merged histograms of each chunk being
+        returned with its output. """
+    global merged_out
+    init_globals(ctx)
+    if merged_out is not None:
+        merged_out.close()
+        merged_out = None
+
+def output_parallel_interval_data(ctx, printdirs):
+    spans = [span for span in map(get_log_span, ctx.FILE) if span is not None]
+    if not spans:
+        return
+    first = min([span[0] for span in spans])
+    last = max([span[1] for span in spans])
+
+    # Same jump to the start of the input as in process_weighted_intervals()
+    start = 0
+    if first - ctx.max_latency > ctx.interval:
+        start = first - ctx.max_latency
+        start = start - (start % ctx.interval)
+
+    # Intervals up to the first one ending at or after the last row
+    total = max(1, int(-(-(last - start) // ctx.interval)))
+    size = max(-(-total // (ctx.jobs * 4)),
+               int(2 * ctx.max_latency * 1000 // ctx.interval))
+    # The first chunk starts from 0 and jumps by itself, like a single pass
+    chunks = [(start + i * ctx.interval if i else 0, min(size, total - i),
+               start + i * ctx.interval if i else None)
+              for i in range(0, total, size)]
+
+    # Forked workers must not write out what is still buffered
+    sys.stdout.flush()
+    if merged_out is not None:
+        merged_out.flush()
+    pool = multiprocessing.Pool(ctx.jobs, init_chunk_process, (ctx,))
+    try:
+        for out, merged in pool.imap(functools.partial(get_chunk_output, ctx, printdirs), chunks):
+            sys.stdout.write(out)
+            if merged_out is not None:
+                merged_out.write(merged)
+    finally:
+        pool.close()
+        pool.join()
+
 def output_interval_data(ctx,directions):
     fps = [HistFileRdr(f) for f in ctx.FILE]
 
@@ -467,6 +1052,30 @@ def output_interval_data(ctx,directions):
         start += ctx.interval
         end = start + ctx.interval
 
+def init_globals(ctx):
+    """ Set up the output columns and bin values, also run by each worker
+        process with --jobs. """
+    gen_output_columns(ctx)
+
+    # Automatically detect how many columns are in the input files,
+    # calculate the corresponding 'coarseness' parameter used to generate
+    # those files, and calculate the appropriate bin latency values:
+    global bin_vals,lower_bin_vals,upper_bin_vals,__HIST_COLUMNS,__TOTAL_COLUMNS,__MAX_COLUMNS
+    if is_merged_file(ctx.FILE[0]):
+        with open(ctx.FILE[0], 'rb') as fp:
+            __HIST_COLUMNS, __MAX_COLUMNS, dirs = read_merged_header(fp, ctx.FILE[0])
+        __TOTAL_COLUMNS = __HIST_COLUMNS + __NON_HIST_COLUMNS
+    else:
+        with open_log(ctx.FILE[0]) as fp:
+            __TOTAL_COLUMNS = len(fp.readline().split(','))
+        __HIST_COLUMNS = __TOTAL_COLUMNS - __NON_HIST_COLUMNS
+        __MAX_COLUMNS = guess_max_from_bins(ctx, __HIST_COLUMNS)
+
+    coarseness = int(np.log2(float(__MAX_COLUMNS) / __HIST_COLUMNS))
+    group_nr = __MAX_COLUMNS >> FIO_IO_U_PLAT_BITS
+    bin_vals = get_bin_values(group_nr, coarseness=coarseness, legacy=True)
+    lower_bin_vals, upper_bin_vals = get_bin_edges(group_nr, coarseness=coarseness, legacy=True)
+
 def main(ctx):
 
     if ctx.job_file:
@@ -489,6 +1098,26 @@ def main(ctx):
     if not hasattr(ctx, 'percentiles'):
         ctx.percentiles = "90,95,99"
 
+    if not hasattr(ctx, 'jobs'):
+        ctx.jobs = 1
+
+    if not hasattr(ctx, 'merged_output'):
+        ctx.merged_output = None
+
+    if not hasattr(ctx, 'align'):
+        ctx.align = False
+
+    if not hasattr(ctx, 'spikes'):
+        ctx.spikes = False
+
+    if not hasattr(ctx, 'job_shares'):
+        ctx.job_shares = None
+
+    # A spike window depends on all the intervals before it
+    if ctx.spikes:
+        ctx.jobs = 1
+    ctx.per_file = ctx.spikes or ctx.job_shares is not None
+
     if ctx.directions:
         ctx.directions = ctx.directions.lower()
 
@@ -500,22 +1129,34 @@ def main(ctx):
     else:
         ctx.time_divisor = 1000000.0     # bins are in ns
 
-    gen_output_columns(ctx)
+    # The first lines of the logs are read more than once
+    if '-' in ctx.FILE:
+        errmsg = "histogram logs cannot be read from stdin, give their file names.\n"
+        if runascmd:
+            err(errmsg)
+            exit(1)
+        else:
+            raise RuntimeError(errmsg)
 
+    stored = [f for f in ctx.FILE if is_stored_log(f)]
+    if stored:
+        errmsg = ("%s: histogram logs stored with log_store_compressed=1 have no bins, "
+                  "log them uncompressed or compress them with gzip or zstd.\n" % stored[0])
+        if runascmd:
+            err(errmsg)
+            exit(1)
+        else:
+            raise RuntimeError(errmsg)
 
-    # Automatically detect how many columns are in the input files,
-    # calculate the corresponding 'coarseness' parameter used to generate
-    # those files, and calculate the appropriate bin latency values:
-    with open(ctx.FILE[0], 'r') as fp:
-        global bin_vals,lower_bin_vals,upper_bin_vals,__HIST_COLUMNS,__TOTAL_COLUMNS
-        __TOTAL_COLUMNS = len(fp.readline().split(','))
-        __HIST_COLUMNS = __TOTAL_COLUMNS - __NON_HIST_COLUMNS
+    init_globals(ctx)
 
-        max_cols = guess_max_from_bins(ctx, __HIST_COLUMNS)
-        coarseness = int(np.log2(float(max_cols) / __HIST_COLUMNS))
-        bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness) for x in np.arange(__HIST_COLUMNS)], dtype=float)
-        lower_bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness, 0.0) for x in np.arange(__HIST_COLUMNS)], dtype=float)
-        upper_bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness, 1.0) for x in np.arange(__HIST_COLUMNS)], dtype=float)
+    if ctx.job_shares is not None and (ctx.noweight or is_merged_file(ctx.FILE[0])):
+        errmsg = "--job-shares needs histogram logs, and cannot be used with --noweight.\n"
+        if runascmd:
+            err(errmsg)
+            exit(1)
+        else:
+            raise RuntimeError(errmsg)
 
     # indicate which directions to output (read(0), write(1), trim(2), mixed(3))
     directions = set()
@@ -524,15 +1165,47 @@ def main(ctx):
     if ctx.directions and 'w' in ctx.directions:    directions.add('w')
     if ctx.directions and 't' in ctx.directions:    directions.add('t')
 
-    if ctx.noweight:
-        output_interval_data(ctx, directions)
-    else:
-        output_weighted_interval_data(ctx, directions)
+    if ctx.align and (ctx.noweight or ctx.jobs > 1):
+        errmsg = "--align cannot be used with --noweight or --jobs.\n"
+        if runascmd:
+            err(errmsg)
+            exit(1)
+        else:
+            raise RuntimeError(errmsg)
+
+    period = None
+    if ctx.align and not is_merged_file(ctx.FILE[0]):
+        period = get_aligned_period(ctx)
+        if period is None:
+            err("WARNING: --align: the rows of the logs are not all logged on multiples "
+                "of a period dividing --interval, weighting them instead.\n")
+
+    global merged_out, spikes
+    if ctx.merged_output:
+        merged_out = open(ctx.merged_output, 'wb')
+        write_merged_header(merged_out, __HIST_COLUMNS, __MAX_COLUMNS, directions)
+    if ctx.spikes:
+        spikes = SpikeDetector(ctx)
+    try:
+        if is_merged_file(ctx.FILE[0]):
+            output_merged_data(ctx, directions)
+        elif ctx.noweight:
+            output_interval_data(ctx, directions)
+        elif period is not None:
+            output_aligned_interval_data(ctx, directions, period)
+        else:
+            output_weighted_interval_data(ctx, directions)
+        if spikes is not None:
+            spikes.finish()
+    finally:
+        if merged_out is not None:
+            merged_out.close()
+            merged_out = None
+        spikes = None
 
 
-if __name__ == '__main__':
+def parse_args(argv=None):
     import argparse
-    runascmd = True
     p = argparse.ArgumentParser()
     arg = p.add_argument
     arg("FILE", help='space separated list of latency log filenames', nargs='+')
@@ -541,6 +1214,12 @@ if __name__ == '__main__':
         type=int,
         help='number of samples to buffer into numpy at a time')
 
+    arg('-j', '--jobs',
+        default=1,
+        type=int,
+        help='number of processes weighting intervals in parallel, '
+             'not used with --noweight')
+
     arg('--max_latency',
         default=20,
         type=float,
@@ -555,6 +1234,13 @@ if __name__ == '__main__':
         default=False,
         help='do not perform weighting of samples between output intervals')
 
+    arg('--align',
+        action='store_true',
+        default=False,
+        help='when --interval is a multiple of the log_hist_msec of the logs '
+             'and every row is logged on a multiple of it, add up the rows of '
+             'each interval instead of weighting them, which is much quicker')
+
     arg('-d', '--divisor',
         required=False,
         type=int,
@@ -590,6 +1276,54 @@ if __name__ == '__main__':
         help='Optional argument of comma or colon separated percentiles to print. '
              'The default is "90.0:95.0:99.0".  min, median(50%%) and max percentiles are always printed')
 
+    arg('--merged-output',
+        default=None,
+        type=str,
+        help='also write the merged histogram of each interval to this file, '
+             'in a compact binary format. Given back as FILE, the statistics are '
+             'printed from it without reading the histogram logs again. Its intervals '
+             'and directions are fixed, --percentiles, --divisor and --decimals may change.')
+
+    arg('--job-shares',
+        default=None,
+        type=float,
+        help='for each interval, also print the share (in %%) of each input file '
+             'in the samples above this percentile, one column per file')
+
+    arg('--spikes',
+        default=False,
+        action='store_true',
+        help='instead of the statistics of each interval, print the windows of '
+             'intervals whose --spike-percentile is more than --spike-factor times '
+             'its rolling baseline, with the share of each job in the samples above '
+             'it. Done in a single pass, so --jobs is ignored.')
+
+    arg('--spike-percentile',
+        default=99.9,
+        type=float,
+        help='percentile watched for spikes, default 99.9')
+
+    arg('--spike-window',
+        default=60,
+        type=int,
+        help='number of intervals the baseline is computed over, default 60')
+
+    arg('--spike-baseline',
+        default='median',
+        choices=['median', 'mean'],
+        help='statistic used as the baseline, default median')
+
+    arg('--spike-factor',
+        default=2.0,
+        type=float,
+        help='an interval is a spike when its percentile is more than this '
+             'times the baseline, default 2')
+
+    arg('--spike-jobs',
+        default=3,
+        type=int,
+        help='number of jobs listed for each spike window, default 3')
+
     arg('--usbin',
         default=False,
         action='store_true',
@@ -605,5 +1339,236 @@ if __name__ == '__main__':
              'adds a "dir" field to the output content, and separate rows for each of the indicated '
              'directions.')
 
-    main(p.parse_args())
+    return p.parse_args(argv)
+
+
+##### below are unit tests ##############
+
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+class Test(unittest.TestCase):
+    tempdir = None
+
+    @classmethod
+    def setUpClass(cls):
+        Test.tempdir = tempfile.mkdtemp()
+
+    # remove anything left by unit test environment
+    # unless user sets UNITTEST_LEAVE_FILES environment variable
+
+    @classmethod
+    def tearDownClass(cls):
+        if not os.getenv("UNITTEST_LEAVE_FILES"):
+            shutil.rmtree(cls.tempdir)
+
+    def write_log(self, name, rows):
+        """ Write a histogram log of (time, dir, bins) rows, returning its name """
+        fn = join(Test.tempdir, name)
+        with open(fn, 'w') as f:
+            for (time, dir, bins) in rows:
+                f.write('%d, %d, 4096, %s\n' % (time, dir, ', '.join(['%d' % b for b in bins])))
+        return fn
+
+    def random_logs(self, prefix, nfiles, nrows, times, max_bin=900, seed=1, lag=lambda i, dir: 0):
+        """ Logs of nrows rows per direction at times(row, file) plus
+            lag(row, direction), with random counts in the bins
+            below max_bin, i.e. latencies under 8 ms """
+        rs = np.random.RandomState(seed)
+        files = []
+        for j in range(nfiles):
+            rows = []
+            for i in range(nrows):
+                for dir in (0, 1):
+                    bins = np.zeros(1856, dtype=int)
+                    idx = rs.randint(100, max_bin, size=20)
+                    bins[idx] = rs.randint(0, 50, size=20)
+                    rows.append((times(i, j) + lag(i, dir), dir, bins))
+            files.append(self.write_log('%s%d.log' % (prefix, j), rows))
+        return files
+
+    def run_main(self, args):
+        """ Return the output of fiologparser_hist.py args """
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            main(parse_args(args))
+        return out.getvalue()
+
+    def test_a1_align_matches_weighted(self):
+        files = self.random_logs('aligned', 3, 150, lambda i, j: (i + 1) * 100)
+        ctx = parse_args(['-i', '100'] + files)
+        ctx.interval = 100
+        self.assertEqual(get_aligned_period(ctx), 100)
+        for opts in (['-i', '100'], ['-i', '100', '--directions', 'rwm'],
+                     ['-i', '100', '--job-shares', '99', '--percentiles', '50,99.9']):
+            expected = self.run_main(opts + files)
+            self.assertTrue(len(expected.splitlines()) > 100)
+            self.assertEqual(self.run_main(['--align'] + opts + files), expected)
+
+    def test_a2_align_checks_every_row(self):
+        # a single late row, after the rows the period is guessed from
+        late = lambda i, j: (i + 1) * 100 + (30 if i == 120 else 0)
+        files = self.random_logs('late', 1, 150, late)
+        self.assertEqual(get_log_period(files[0]), None)
+        # falls back to weighting
+        self.assertEqual(self.run_main(['--align', '-i', '200'] + files),
+                         self.run_main(['-i', '200'] + files))
+        with self.assertRaises(RuntimeError):
+            self.run_main(['--align', '-j', '2'] + files)
+
+    def test_a3_align_randrw(self):
+        # fio keeps a window per direction, writes are logged a few ms
+        # after reads, and rows a ms late now and then
+        period = lambda i, j: (i + 1) * 100
+        lag = lambda i, dir: 3 * dir + (i % 5 == 0)
+        files = self.random_logs('randrw', 2, 150, period, lag=lag)
+        self.assertEqual(get_log_period(files[0]), 100)
+        # the same as the rows logged on the period
+        exact = self.random_logs('exact', 2, 150, period)
+        for opts in (['-i', '100', '--directions', 'rwm'], ['-i', '300']):
+            self.assertEqual(self.run_main(['--align'] + opts + files),
+                             self.run_main(['--align'] + opts + exact))
+        self.assertEqual(self.run_main(['--align', '-i', '100'] + files),
+                         self.run_main(['-i', '100'] + exact))
+        # the rows of a direction too far from the period
+        files = self.random_logs('randrw_late', 1, 150, period, lag=lambda i, dir: 6 * dir)
+        self.assertEqual(get_log_period(files[0]), None)
+
+    def jittered_logs(self, prefix, nfiles=3, nrows=150):
+        """ Logs whose rows are not logged on interval boundaries """
+        return self.random_logs(prefix, nfiles, nrows,
+                                lambda i, j: (i + 1) * 100 + (i * 37 + j * 11) % 50)
+
+    def test_b1_jobs_matches_serial(self):
+        files = self.jittered_logs('jobs', nrows=80)
+        for opts in (['-i', '100'], ['-i', '250', '--directions', 'rwm'],
+                     ['-i', '100', '--job-shares', '99']):
+            opts = opts + ['--max_latency', '1']
+            expected = self.run_main(opts + files)
+            self.assertTrue(len(expected.splitlines()) > 50)
+            for jobs in ('2', '5'):
+                self.assertEqual(self.run_main(['-j', jobs] + opts + files), expected)
+
+    def test_c1_merged_output_round_trip(self):
+        files = self.jittered_logs('merged')
+        merged = join(Test.tempdir, 'merged.bin')
+        opts = ['-i', '200', '--directions', 'rwm']
+        for jobs in ('1', '3'):
+            expected = self.run_main(['-j', jobs, '--merged-output', merged] + opts + files)
+            self.assertTrue(is_merged_file(merged))
+            self.assertEqual(self.run_main(opts + [merged]), expected)
+        # other percentiles, divisor and directions than the file was written with
+        opts = ['-i', '200', '--directions', 'w', '--percentiles', '10,99.9', '-d', '1000']
+        self.assertEqual(self.run_main(opts + [merged]), self.run_main(opts + files))
+        with self.assertRaises(RuntimeError):
+            self.run_main(['--directions', 't', merged])
+
+    def spike_logs(self, prefix, spiking, nfiles=3, nrows=100):
+        """ Logs of rows logged every 100 ms, with latencies of about 1 ms
+            apart from the rows of file j in the intervals spiking(i, j),
+            holding latencies of about 100 ms """
+        files = []
+        for j in range(nfiles):
+            rows = []
+            for i in range(nrows):
+                bins = np.zeros(1856, dtype=int)
+                bins[400 + (i + j) % 20] = 100
+                if spiking(i, j):
+                    bins[820] = 10
+                rows.append(((i + 1) * 100, 0, bins))
+            files.append(self.write_log('%s%d.log' % (prefix, j), rows))
+        return files
+
+    def test_d1_spikes(self):
+        files = self.spike_logs('spike', lambda i, j: j == 1 and 60 <= i < 64)
+        out = self.run_main(['--spikes', '-i', '100', '--spike-window', '20',
+                             '--percentiles', '99'] + files).splitlines()
+        self.assertEqual(out[0], 'start-time, end-time, intervals, samples, peak, baseline, jobs')
+        self.assertEqual(len(out), 2)
+        row = out[1].split(', ')
+        # the intervals ending with the spiking rows, 6100 to 6400
+        self.assertEqual([int(x) for x in row[:4]], [6000, 6400, 4, 1240])
+        self.assertTrue(float(row[4]) > 2 * float(row[5]))
+        self.assertTrue(row[6].startswith('spike1.log:'))
+        # no spike when the factor is too high
+        out = self.run_main(['--spikes', '-i', '100', '--spike-window', '20',
+                             '--spike-factor', '1000'] + files).splitlines()
+        self.assertEqual(len(out), 1)
+
+    def test_e1_job_shares(self):
+        files = self.spike_logs('shares', lambda i, j: j == 2 and i % 10 == 5)
+        out = self.run_main(['-i', '100', '--job-shares', '99', '--percentiles', '99'] + files).splitlines()
+        header = out[0].split(', ')
+        self.assertEqual(header[-3:], ['shares0.log', 'shares1.log', 'shares2.log'])
+        for line in out[1:]:
+            row = line.split(', ')
+            end = int(row[0])
+            shares = [float(x) for x in row[-3:]]
+            self.assertAlmostEqual(sum(shares), 100.0, places=2)
+            if end % 1000 == 600:
+                self.assertEqual(shares[2], 100.0)
+        with self.assertRaises(RuntimeError):
+            self.run_main(['--noweight', '--job-shares', '99'] + files)
+    def test_f1_read_int_chunks(self):
+        rs = np.random.RandomState(17)
+        rows = rs.randint(0, 1 << 40, size=(1000, 20))
+        fn = join(Test.tempdir, 'ints.csv')
+        with open(fn, 'w') as f:
+            for i, row in enumerate(rows):
+                f.write(', '.join(['%d' % x for x in row]) + '\n')
+                if i % 97 == 0:
+                    f.write('\n')
+        global fast_loadtxt, pandas_imported, pandas
+        saved = (fast_loadtxt, pandas_imported)
+        # numpy's loadtxt, its string parser, and pandas when installed
+        parsers = [(True, False), (False, False)]
+        try:
+            import pandas
+            parsers.append((False, True))
+        except ImportError:
+            pass
+        try:
+            for parser in parsers:
+                (fast_loadtxt, pandas_imported) = parser
+                for sz in (1, 64, 5000):
+                    with open(fn) as fp:
+                        chunks = list(read_int_chunks(fp, sz))
+                    self.assertTrue(all([len(c) <= sz and c.flags['C_CONTIGUOUS'] for c in chunks]))
+                    self.assertTrue(np.array_equal(np.concatenate(chunks), rows))
+            (fast_loadtxt, pandas_imported) = (False, False)
+            with self.assertRaises(ValueError):
+                list(read_int_chunks(io.StringIO('1, 2, 3\n4, 5\n'), 10))
+        finally:
+            (fast_loadtxt, pandas_imported) = saved
+
+    def test_f2_histogram_generator(self):
+        # rows of several files merged in (time, file index) order, rows of
+        # a file keeping their order, whatever the chunk size
+        rs = np.random.RandomState(3)
+        logs = []
+        for j in range(4):
+            times = np.sort(rs.randint(0, 2000, size=300 + 50 * j))
+            rows = np.column_stack((times, rs.randint(0, 3, size=len(times)),
+                                    np.full(len(times), 4096), rs.randint(0, 100, size=(len(times), 8))))
+            logs.append(rows)
+        expected = sorted([(row[0], j, k) for j, rows in enumerate(logs) for k, row in enumerate(rows)])
+        expected = np.array([np.concatenate(([t, j], logs[j][k][1:])) for (t, j, k) in expected])
+        for sz in (1, 7, 100, 10000):
+            fps = [io.StringIO(''.join([', '.join(['%d' % x for x in row]) + '\n' for row in rows]))
+                   for rows in logs]
+            blocks = list(histogram_generator(parse_args(['x']), fps, sz))
+            self.assertTrue(np.array_equal(np.concatenate(blocks), expected))
+
+    def test_g1_stdin_rejected(self):
+        # logs are read more than once, so not from stdin
+        with self.assertRaises(RuntimeError):
+            self.run_main(['-'])
+
 
+if __name__ == '__main__':
+    if os.getenv('UNITTEST'):
+        sys.exit(unittest.main())
+    runascmd = True
+    main(parse_args())